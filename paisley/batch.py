@@ -0,0 +1,271 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_batch -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Batching of individual document requests into bulk requests.
+"""
+
+import copy
+
+from twisted.internet import defer
+
+from paisley.client import json, MISSING, DELETED, BulkDocsError
+
+# HTTP codes for the errors reported per document by _bulk_docs
+BULK_ERROR_CODES = {
+    'conflict': 409,
+    'forbidden': 403,
+    'unauthorized': 401,
+    'not_found': 404,
+}
+
+
+def bulkError(result):
+    """
+    Convert an error reported by _bulk_docs for one document to the
+    L{twisted.web.error.Error} the single document request would fail with.
+    """
+    # twisted.web.error imports reactor
+    from twisted.web import error as tw_error
+
+    body = json.dumps({'error': result['error'],
+        'reason': result.get('reason', '')})
+    return tw_error.Error(BULK_ERROR_CODES.get(result['error'], 500), body)
+
+
+class WriteBatcher(object):
+    """
+    I collect saveDoc calls and send them as a single _bulk_docs request per
+    database.
+
+    Pending documents are sent C{window} seconds after the first of them was
+    queued, or as soon as C{maxDocs} documents or C{maxBytes} bytes are
+    pending for a database, whichever comes first.
+
+    Saves of the same document are kept in order: a second save is sent in
+    a later batch, which is only sent once the batch with the first save
+    was answered.
+
+    @ivar flushes: number of _bulk_docs requests sent.
+    @ivar saved:   number of documents sent.
+    """
+
+    def __init__(self, db, window=0.01, maxDocs=100, maxBytes=1024 * 1024,
+                 clock=None):
+        """
+        @type  db: L{paisley.client.CouchDB}
+        @param clock: provider of L{twisted.internet.interfaces.IReactorTime},
+            the reactor by default.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._db = db
+        self._clock = clock
+        self.window = window
+        self.maxDocs = maxDocs
+        self.maxBytes = maxBytes
+
+        # dbName -> list of (encoded document, deferred)
+        self._pending = {}
+        self._pendingIds = {}
+        self._pendingBytes = {}
+        self._call = None
+        # dbName -> list of (document ids, deferred) of the batches sent
+        # and not answered yet; the deferreds fire once they are
+        self._inFlight = {}
+
+        self.flushes = 0
+        self.saved = 0
+
+    def saveDoc(self, dbName, body, docId=None):
+        """
+        Queue a document to be saved.
+
+        @return: a deferred firing with the result for this document, or
+            failing with L{twisted.web.error.Error} as saveDoc would.
+        """
+        if isinstance(body, (str, unicode)) and docId is not None:
+            body = json.loads(body)
+        if isinstance(body, dict):
+            body = dict(body)
+            if docId is not None:
+                body['_id'] = unicode(docId)
+            docId = body.get('_id', None)
+        if not isinstance(body, (str, unicode)):
+            body = json.dumps(body)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        if docId is not None and docId in self._pendingIds.get(dbName, ()):
+            # keep saves of the same document in separate batches
+            self.flush(dbName)
+
+        d = defer.Deferred()
+        self._pending.setdefault(dbName, []).append((body, d))
+        self._pendingIds.setdefault(dbName, set()).add(docId)
+        self._pendingBytes[dbName] = self._pendingBytes.get(dbName, 0) + \
+            len(body)
+
+        if len(self._pending[dbName]) >= self.maxDocs or \
+                self._pendingBytes[dbName] >= self.maxBytes:
+            self.flush(dbName)
+        elif self._call is None:
+            self._call = self._clock.callLater(self.window, self._timeout)
+        return d
+
+    def _timeout(self):
+        self._call = None
+        self.flush()
+
+    def flush(self, dbName=None):
+        """
+        Send the pending documents now.
+
+        @param dbName: if specified, only send the documents for this
+            database.
+
+        @return: a deferred firing when the results have been dispatched.
+        """
+        if dbName is None:
+            dbNames = self._pending.keys()
+        else:
+            dbNames = [dbName]
+
+        dl = []
+        for name in dbNames:
+            pending = self._pending.pop(name, [])
+            ids = self._pendingIds.pop(name, set())
+            self._pendingBytes.pop(name, None)
+            if pending:
+                dl.append(self._send(name, pending, ids))
+
+        if not self._pending and self._call is not None:
+            self._call.cancel()
+            self._call = None
+        return defer.DeferredList(dl)
+
+    def _send(self, dbName, pending, ids):
+        self.flushes += 1
+        self.saved += len(pending)
+
+        # wait for the batches saving the same documents to be answered
+        ids.discard(None)
+        inFlight = self._inFlight.setdefault(dbName, [])
+        previous = [done for sentIds, done in inFlight if sentIds & ids]
+        entry = (ids, defer.Deferred())
+        inFlight.append(entry)
+
+        def answered(result):
+            inFlight.remove(entry)
+            if not inFlight:
+                del self._inFlight[dbName]
+            entry[1].callback(None)
+            return result
+
+        d = defer.DeferredList(previous)
+        d.addCallback(lambda _: self._db._bulkDocs(dbName,
+            [p[0] for p in pending], chunkSize=len(pending),
+            maxChunkBytes=None, concurrency=1))
+        d.addBoth(answered)
+
+        def dispatch(results):
+            for (_, deferred), result in zip(pending, results):
+                if 'error' in result:
+                    deferred.errback(bulkError(result))
+                else:
+                    deferred.callback(result)
+
+        def failed(failure):
+            # the batch is a single chunk; fail as saveDoc would
+            if failure.check(BulkDocsError):
+                failure = failure.value.failure
+            for _, deferred in pending:
+                deferred.errback(failure)
+        return d.addCallbacks(dispatch, failed)
+
+
+class ReadBatcher(object):
+    """
+    I collect openDoc calls made during one reactor iteration and fetch the
+    documents with a single bulk request per database.
+
+    @ivar loads:   number of documents requested.
+    @ivar flushes: number of batches fetched.
+    """
+
+    def __init__(self, db, clock=None):
+        """
+        @type  db: L{paisley.client.CouchDB}
+        @param clock: provider of L{twisted.internet.interfaces.IReactorTime},
+            the reactor by default.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._db = db
+        self._clock = clock
+
+        # dbName -> docId -> list of deferreds
+        self._pending = {}
+        self._call = None
+
+        self.loads = 0
+        self.flushes = 0
+
+    def openDoc(self, dbName, docId):
+        """
+        Queue a document to be fetched.
+
+        @return: a deferred firing with the document, or failing with
+            L{twisted.web.error.Error} as openDoc would.
+        """
+        self.loads += 1
+        d = defer.Deferred()
+        self._pending.setdefault(dbName, {}).setdefault(docId, []).append(d)
+        if self._call is None:
+            self._call = self._clock.callLater(0, self._timeout)
+        return d
+
+    def _timeout(self):
+        self._call = None
+        self.flush()
+
+    def flush(self):
+        """
+        Fetch the pending documents now.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+        pending, self._pending = self._pending, {}
+        for dbName, waiting in pending.items():
+            self.flushes += 1
+            d = self._db._openDocs(dbName, waiting.keys())
+            d.addCallbacks(self._dispatch, self._failed,
+                callbackArgs=(waiting, ), errbackArgs=(waiting, ))
+
+    def _dispatch(self, results, waiting):
+        # twisted.web.error imports reactor
+        from twisted.web import error as tw_error
+
+        for docId, deferreds in waiting.iteritems():
+            doc = results.get(docId, MISSING)
+            if doc is MISSING or doc is DELETED:
+                body = json.dumps({'error': 'not_found',
+                    'reason': doc is DELETED and 'deleted' or 'missing'})
+                for d in deferreds:
+                    d.errback(tw_error.Error(404, body))
+                continue
+
+            # callers asking for the same document each get their own copy
+            for d in deferreds[1:]:
+                d.callback(copy.deepcopy(doc))
+            deferreds[0].callback(doc)
+
+    def _failed(self, failure, waiting):
+        for deferreds in waiting.itervalues():
+            for d in deferreds:
+                d.errback(failure)
@@ -0,0 +1,285 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Caches for CouchDB results.
+"""
+
+import time
+
+from collections import OrderedDict
+
+from paisley import changes
+
+
+class LRUCache(object):
+    """
+    I am a cache evicting the least recently used entries when it holds more
+    than C{maxEntries} entries or more than approximately C{maxBytes} bytes.
+
+    I can be registered with L{paisley.changes.ChangeNotifier.addCache},
+    which deletes the entry for each changed document id, or the entries of
+    a whole batch of changes at once with L{deleteMany}.
+
+    A value fetched while its entry got deleted may be stale, so fetches
+    are bracketed by L{fetching} and L{fetched}, which tells whether the
+    value can be stored.
+
+    @ivar hits:        number of successful lookups.
+    @ivar misses:      number of failed lookups, including expired entries.
+    @ivar evictions:   number of entries dropped to respect the bounds.
+    @ivar expirations: number of entries dropped because of their age.
+    """
+
+    def __init__(self, maxEntries=1000, maxBytes=None, ttl=None, sizeof=len,
+                 clock=time.time):
+        """
+        @param maxEntries: maximum number of entries, or None.
+        @param maxBytes:   maximum total size of entries, or None.
+        @param ttl:        if specified, number of seconds after which an
+                           entry expires.
+        @param sizeof:     called with values stored without an explicit
+                           size to find their size.
+        @param clock:      returns the current time in seconds.
+        """
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self._sizeof = sizeof
+        self._clock = clock
+
+        # key -> (value, size, expiry time)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # key -> [fetches in flight, deletions since the first one started]
+        self._fetching = {}
+        self._clears = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        """
+        Return the keys of all entries, least recently used first.
+        """
+        return self._entries.keys()
+
+    def get(self, key, default=None):
+        """
+        Return the value for the given key, or C{default}.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, size, expires = entry
+        if expires is not None and expires <= self._clock():
+            self._bytes -= size
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        # move to the most recently used end
+        self._entries[key] = entry
+        self.hits += 1
+        return value
+
+    def set(self, key, value, size=None):
+        """
+        Store a value for the given key.
+
+        @param size: the size of the value; by default, computed with the
+            C{sizeof} function given at creation.
+        """
+        if size is None:
+            size = self._sizeof(value)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+
+        expires = None
+        if self.ttl is not None:
+            expires = self._clock() + self.ttl
+        self._entries[key] = (value, size, expires)
+        self._bytes += size
+
+        while self._entries and (
+                (self.maxEntries is not None and
+                 len(self._entries) > self.maxEntries) or
+                (self.maxBytes is not None and self._bytes > self.maxBytes)):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove the entry for the given key, if any.
+        """
+        fetching = self._fetching.get(key, None)
+        if fetching is not None:
+            fetching[1] += 1
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def deleteMany(self, keys):
+        """
+        Remove the entries for the given keys, if any.
+        """
+        for key in keys:
+            self.delete(key)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        self._clears += 1
+        self._entries.clear()
+        self._bytes = 0
+
+    def fetching(self, key):
+        """
+        Note that the value for the given key is being fetched.
+
+        @return: a token to pass to L{fetched} once the fetch is done.
+        """
+        fetching = self._fetching.setdefault(key, [0, 0])
+        fetching[0] += 1
+        return (self._clears, fetching[1])
+
+    def fetched(self, key, token):
+        """
+        Note that a fetch started with L{fetching} is done, successful or
+        not.
+
+        @return: whether the value fetched can be stored, because the entry
+            was not deleted since the fetch started.
+        @rtype: C{bool}
+        """
+        fetching = self._fetching[key]
+        fetching[0] -= 1
+        if not fetching[0]:
+            del self._fetching[key]
+        return token == (self._clears, fetching[1])
+
+    def getStats(self):
+        """
+        Return a dictionary of cache statistics.
+
+        @rtype: C{dict} of C{str} -> C{int}
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+        }
+
+
+class ViewCache(object):
+    """
+    I cache view results until the update sequence of their database moves.
+
+    The current update sequence of a database comes from a listener
+    returned by L{listenerFor} registered with a running
+    L{paisley.changes.ChangeNotifier}, or else from the database info.
+
+    @ivar entries: the L{LRUCache} holding (update sequence, body) per query.
+    """
+
+    def __init__(self, maxEntries=100, maxBytes=None, ttl=None):
+        self.entries = LRUCache(maxEntries=maxEntries, maxBytes=maxBytes,
+            ttl=ttl, sizeof=lambda entry: len(entry[1]))
+        # dbName -> update sequence, for databases followed by a listener
+        self._seqs = {}
+
+    def key(self, dbName, docId, viewId, query, body=None):
+        """
+        Return the cache key for a view query.
+
+        @param query: the query arguments, JSON-encoded.
+        @type  query: C{dict}
+        @param body:  the keys body of the query, if any.
+        """
+        return (dbName, docId, viewId, tuple(sorted(query.items())), body)
+
+    def get(self, key, seq):
+        """
+        Return the cached result body for the given key if it was stored for
+        the given update sequence, or None.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != seq:
+            return None
+        return entry[1]
+
+    def set(self, key, seq, body):
+        """
+        Store the result body for the given key, as of the given update
+        sequence.
+        """
+        self.entries.set(key, (seq, body))
+
+    def getSeq(self, dbName):
+        """
+        Return the update sequence of the given database as last reported by
+        its listener, or None if it is not followed.
+        """
+        return self._seqs.get(dbName, None)
+
+    def invalidate(self, dbName):
+        """
+        Remove all entries for the given database.
+        """
+        for key in self.entries.keys():
+            if key[0] == dbName:
+                self.entries.delete(key)
+
+    def listenerFor(self, dbName):
+        """
+        Return a listener to register with a L{paisley.changes.ChangeNotifier}
+        for the given database, which tracks its update sequence and
+        invalidates entries as soon as the database changes.
+        """
+        return _ViewCacheListener(self, dbName)
+
+
+class _ViewCacheListener(changes.ChangeListener):
+
+    def __init__(self, cache, dbName):
+        self._cache = cache
+        self._dbName = dbName
+
+    def changed(self, change):
+        self._cache.invalidate(self._dbName)
+        if 'seq' in change:
+            self._cache._seqs[self._dbName] = change['seq']
+
+    def changedBatch(self, changes):
+        # invalidating once is enough
+        self._cache.invalidate(self._dbName)
+        for change in changes:
+            if 'seq' in change:
+                self._cache._seqs[self._dbName] = change['seq']
+
+    def connectionLost(self, reason):
+        # we can no longer tell when the database changes
+        self._cache._seqs.pop(self._dbName, None)
+
+    def reconnecting(self, reason, delay):
+        # nor can we until the feed resumes
+        self._cache._seqs.pop(self._dbName, None)
@@ -8,8 +8,11 @@ from urllib import urlencode
 
 from twisted.internet import error, defer
 from twisted.protocols import basic
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
 
-from paisley.client import json
+from paisley.client import json, StringProducer
 
 
 class ChangeReceiver(basic.LineReceiver):
@@ -17,8 +20,25 @@ class ChangeReceiver(basic.LineReceiver):
     # lines
     delimiter = '\n'
 
-    def __init__(self, notifier):
+    def __init__(self, notifier, batch=False):
+        """
+        @param batch: whether to hand the changes of each chunk of data
+            received to the notifier's C{changedBatch} at once, instead of
+            calling its C{changed} for each change.
+        """
         self._notifier = notifier
+        self._batch = None
+        if batch:
+            self._batch = []
+
+    def dataReceived(self, data):
+        # any data, heartbeat newlines included, shows the feed is alive
+        self._notifier.activity()
+        basic.LineReceiver.dataReceived(self, data)
+        if self._batch:
+            batch = self._batch
+            self._batch = []
+            self._notifier.changedBatch(batch)
 
     def lineReceived(self, line):
         if not line:
@@ -29,12 +49,22 @@ class ChangeReceiver(basic.LineReceiver):
         if not 'id' in change:
             return
 
-        self._notifier.changed(change)
+        if self._batch is not None:
+            self._batch.append(change)
+        else:
+            self._notifier.changed(change)
 
     def connectionLost(self, reason):
         self._notifier.connectionLost(reason)
 
 
+class FeedStalled(Exception):
+    """
+    Nothing was received on the change feed for several heartbeats, so its
+    connection was aborted.
+    """
+
+
 class ChangeListener:
     """
     I am an interface for receiving changes from a L{ChangeNotifier}.
@@ -55,16 +85,91 @@ class ChangeListener:
         """
         pass
 
+    def changedBatch(self, changes):
+        """
+        The given changes were received, in order, by a batching
+        L{ChangeNotifier}.
+
+        By default, I call L{changed} for each change; override me to handle
+        them at once.  Listeners without this method get C{changed} calls.
+
+        @type  changes: list of dict
+        """
+        for change in changes:
+            self.changed(change)
+
     def connectionLost(self, reason):
         """
         @type  reason: L{twisted.python.failure.Failure}
         """
         pass
 
+    def reconnecting(self, reason, delay):
+        """
+        The connection was lost, and a reconnecting L{ChangeNotifier} will
+        try to connect again in C{delay} seconds.
+
+        Listeners without this method are not told.
+
+        @type  reason: L{twisted.python.failure.Failure}
+        """
+        pass
+
+    def resumed(self, since):
+        """
+        A reconnecting L{ChangeNotifier} connected again, and will receive
+        the changes made after the sequence number C{since}.
+
+        Listeners without this method are not told.
+        """
+        pass
+
 
 class ChangeNotifier(object):
+    """
+    I notify caches and listeners of the changes made to a database.
+
+    @ivar reconnects:   number of attempts made to reconnect.
+    @ivar lastActivity: time when data was last received on the feed.
+    @ivar stallCount:   number of times the feed stalled.
+    @ivar checkpoints:  number of checkpoints saved.
+    """
 
-    def __init__(self, db, dbName, since=None):
+    def __init__(self, db, dbName, since=None, reconnect=None,
+                 minReconnectInterval=1, clock=None, heartbeat=None,
+                 stallFactor=3, checkpointStore=None, checkpointInterval=10,
+                 checkpointChanges=1000, batchWindow=None):
+        """
+        @param reconnect: if specified, a L{paisley.retry.RetryPolicy} whose
+            delays are used to reconnect when the connection is lost instead
+            of notifying listeners, resuming from the last change received.
+            I give up after C{maxRetries} failed attempts in a row, unless it
+            is None.
+        @param minReconnectInterval: minimum number of seconds between the
+            starts of two connections when reconnecting, whatever the delays
+            of the retry policy.
+        @param clock: provider of L{twisted.internet.interfaces.IReactorTime},
+            the reactor by default.
+        @param heartbeat: if specified, the number of seconds between the
+            empty lines the server sends when there are no changes.  When
+            nothing is received for C{stallFactor} heartbeats, the connection
+            is aborted with L{FeedStalled}, and reconnected if I reconnect.
+        @param checkpointStore: if specified, where to save the sequence
+            number of the last change processed by all caches and listeners,
+            and where L{start} resumes from unless C{since} is given.
+        @type  checkpointStore: L{paisley.checkpoint.CheckpointStore}
+        @param checkpointInterval: maximum number of seconds between a
+            change being processed and its checkpoint being saved.
+        @param checkpointChanges: number of changes processed after which a
+            checkpoint is saved without waiting for C{checkpointInterval}.
+        @param batchWindow: if specified, changes are delivered in batches:
+            caches get C{deleteMany} calls and listeners get C{changedBatch}
+            calls, when they have those methods.  With 0, a batch holds the
+            changes received in one chunk of data; otherwise, it holds those
+            received in up to C{batchWindow} seconds.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
         self._db = db
         self._dbName = dbName
 
@@ -73,8 +178,43 @@ class ChangeNotifier(object):
         self._prot = None
 
         self._since = since
+        self._kwargs = {}
 
         self._running = False
+        self._stopped = True
+
+        self._reconnect = reconnect
+        self.minReconnectInterval = minReconnectInterval
+        self._clock = clock
+        self._attempts = 0
+        self._lastConnect = None
+        self._reconnectCall = None
+        self.reconnects = 0
+
+        self.heartbeat = heartbeat
+        self.stallFactor = stallFactor
+        self.lastActivity = None
+        self.stallCount = 0
+        self._stallCall = None
+        self._stalled = False
+
+        self._checkpointStore = checkpointStore
+        self.checkpointInterval = checkpointInterval
+        self.checkpointChanges = checkpointChanges
+        self.checkpoints = 0
+        # last processed sequence number, and number of changes since the
+        # last checkpoint
+        self._processed = None
+        self._unsaved = 0
+        self._checkpointCall = None
+        self._saving = None
+
+        self.batchWindow = batchWindow
+        self._pending = []
+        self._batchCall = None
+
+        # deferreds to fire once reconnected with a new filter
+        self._restarts = []
 
     def addCache(self, cache):
         self._caches.append(cache)
@@ -90,40 +230,140 @@ class ChangeNotifier(object):
         Start listening and notifying of changes.
         Separated from __init__ so you can add caches and listeners.
 
-        By default, I will start listening from the most recent change.
+        By default, I will start listening from the checkpoint if I have a
+        checkpoint store, or else from the most recent change.
+
+        The keyword arguments are passed as query arguments of the
+        C{_changes} request, such as C{filter} and the parameters of the
+        named filter function, except for these, which are sent in the body
+        of a C{POST} request so that the server only sends the matching
+        changes:
+          - doc_ids:  a list of document ids
+          - selector: a Mango selector, as a dict
         """
         assert 'feed' not in kwargs, \
             "ChangeNotifier always listens continuously."
+        assert not ('doc_ids' in kwargs and 'selector' in kwargs), \
+            "_changes accepts either doc_ids or a selector, not both."
+
+        self._kwargs = kwargs
+        self._stopped = False
+        self._attempts = 0
 
         d = defer.succeed(None)
 
+        def setCheckpoint(seq):
+            if seq is not None:
+                self._since = seq
+
         def setSince(info):
             self._since = info['update_seq']
 
-        if self._since is None:
-            d.addCallback(lambda _: self._db.infoDB(self._dbName))
-            d.addCallback(setSince)
+        if self._since is None and self._checkpointStore is not None:
+            d.addCallback(lambda _: self._checkpointStore.load())
+            d.addCallback(setCheckpoint)
 
-        def requestChanges():
-            kwargs['feed'] = 'continuous'
-            kwargs['since'] = self._since
-            # FIXME: str should probably be unicode, as dbName can be
-            url = str(self._db.url_template %
-                '/%s/_changes?%s' % (self._dbName, urlencode(kwargs)))
-            return self._db.client.request('GET', url)
-        d.addCallback(lambda _: requestChanges())
+        def getSince(_):
+            if self._since is None:
+                d = self._db.infoDB(self._dbName)
+                return d.addCallback(setSince)
+        d.addCallback(getSince)
 
-        def requestCb(response):
-            self._prot = ChangeReceiver(self)
-            response.deliverBody(self._prot)
-            self._running = True
-        d.addCallback(requestCb)
+        d.addCallback(lambda _: self._connect())
 
         def returnCb(_):
             return self._since
         d.addCallback(returnCb)
         return d
 
+    def setFilter(self, **kwargs):
+        """
+        Replace the arguments given to L{start}, to follow other changes.
+
+        If I am connected, I reconnect with the new arguments, resuming
+        after the last change received; listeners are not told.
+
+        @return: a deferred firing with the sequence number I resumed from
+            once reconnected.
+        """
+        assert 'feed' not in kwargs, \
+            "ChangeNotifier always listens continuously."
+        assert not ('doc_ids' in kwargs and 'selector' in kwargs), \
+            "_changes accepts either doc_ids or a selector, not both."
+
+        self._kwargs = kwargs
+        if self._prot is None or self._stopped:
+            # the next connection will use them
+            return defer.succeed(self._since)
+
+        d = defer.Deferred()
+        if not self._restarts:
+            self._prot.stopProducing()
+        self._restarts.append(d)
+        return d
+
+    def _connect(self):
+        kwargs = dict(self._kwargs)
+        body = {}
+        if 'doc_ids' in kwargs:
+            body['doc_ids'] = kwargs.pop('doc_ids')
+            kwargs['filter'] = '_doc_ids'
+        if 'selector' in kwargs:
+            body['selector'] = kwargs.pop('selector')
+            kwargs['filter'] = '_selector'
+        kwargs['feed'] = 'continuous'
+        kwargs['since'] = self._since
+        if self.heartbeat is not None:
+            # in milliseconds
+            kwargs['heartbeat'] = int(self.heartbeat * 1000)
+        # FIXME: str should probably be unicode, as dbName can be
+        url = str(self._db.url_template %
+            '/%s/_changes?%s' % (self._dbName, urlencode(kwargs)))
+        self._lastConnect = self._clock.seconds()
+        if body:
+            d = self._db.client.request('POST', url,
+                Headers({'Content-Type': ['application/json']}),
+                StringProducer(json.dumps(body)))
+        else:
+            d = self._db.client.request('GET', url)
+
+        def requestCb(response):
+            self._prot = ChangeReceiver(self,
+                batch=self.batchWindow is not None)
+            self._stalled = False
+            self.activity()
+            if self.heartbeat is not None:
+                self._stallCall = self._clock.callLater(
+                    self.heartbeat * self.stallFactor, self._checkStall)
+            response.deliverBody(self._prot)
+            self._running = True
+        d.addCallback(requestCb)
+        return d
+
+    def activity(self):
+        """
+        Called by the receiver when data is received.
+        """
+        self.lastActivity = self._clock.seconds()
+
+    def _checkStall(self):
+        # rescheduled from the last activity, instead of at each activity
+        timeout = self.heartbeat * self.stallFactor
+        left = self.lastActivity + timeout - self._clock.seconds()
+        if left > 0:
+            self._stallCall = self._clock.callLater(left, self._checkStall)
+            return
+
+        self._stallCall = None
+        self.stallCount += 1
+        self._stalled = True
+        self._prot.stopProducing()
+
+    def _cancelStallCheck(self):
+        if self._stallCall is not None:
+            self._stallCall.cancel()
+            self._stallCall = None
+
     def stop(self):
         # FIXME: this should produce a clean stop, but it does not.
         # From http://twistedmatrix.com/documents/current/web/howto/client.html
@@ -131,7 +371,131 @@ class ChangeNotifier(object):
         # stopProducing can be used to stop delivery permanently; after this,
         # the protocol's connectionLost method will be called."
         self._running = False
-        self._prot.stopProducing()
+        self._stopped = True
+        self._cancelStallCheck()
+        self._flushBatch()
+        if self._reconnectCall is not None:
+            # waiting to reconnect, so no connection will tell listeners
+            self._reconnectCall.cancel()
+            self._reconnectCall = None
+            self._notify('connectionLost', Failure(error.ConnectionDone()))
+        elif self._prot is not None:
+            self._prot.stopProducing()
+        return self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Save the sequence number of the last change processed now, if it was
+        not saved yet.
+
+        @return: a deferred firing once it is saved.
+        """
+        if self._checkpointCall is not None:
+            self._checkpointCall.cancel()
+            self._checkpointCall = None
+        if self._checkpointStore is None or not self._unsaved:
+            return defer.succeed(None)
+        if self._saving is not None:
+            # save again once the current save is done
+            return self._saving.addCallback(lambda _: self.checkpoint())
+
+        seq = self._processed
+        unsaved, self._unsaved = self._unsaved, 0
+        self.checkpoints += 1
+
+        def saved(result):
+            self._saving = None
+            return result
+
+        def failed(failure):
+            # still to be saved
+            self._unsaved += unsaved
+            return failure
+        d = self._checkpointStore.save(seq)
+        d.addErrback(failed)
+        d.addBoth(saved)
+        if not d.called:
+            self._saving = d
+        return d
+
+    def _processedChange(self, seq, count=1):
+        self._processed = seq
+        self._unsaved += count
+        if self._unsaved >= self.checkpointChanges:
+            self._checkpointLogged()
+        elif self._checkpointCall is None:
+            self._checkpointCall = self._clock.callLater(
+                self.checkpointInterval, self._checkpointLogged)
+
+    def _checkpointLogged(self):
+        self._checkpointCall = None
+        d = self.checkpoint()
+        d.addErrback(log.err, 'failed to save change feed checkpoint')
+
+    def _notify(self, name, *args):
+        for listener in self._listeners:
+            method = getattr(listener, name, None)
+            if method is not None:
+                method(*args)
+
+    def _scheduleReconnect(self, reason):
+        policy = self._reconnect
+        if policy.maxRetries is not None and \
+                self._attempts >= policy.maxRetries:
+            self._stopped = True
+            self._notify('connectionLost', reason)
+            return
+
+        delay = policy.delay(self._attempts)
+        # cap the reconnection rate, even when connections get dropped as
+        # soon as they are made
+        delay = max(delay, self._lastConnect + self.minReconnectInterval -
+            self._clock.seconds())
+        self._attempts += 1
+        self._notify('reconnecting', reason, delay)
+        self._reconnectCall = self._clock.callLater(delay, self._reconnectNow)
+
+    def _reconnectNow(self):
+        self._reconnectCall = None
+        self.reconnects += 1
+        d = self._connect()
+
+        def connected(_):
+            if self._stopped:
+                # stopped while connecting
+                self._running = False
+                self._prot.stopProducing()
+                return
+            self._attempts = 0
+            self._notify('resumed', self._since)
+
+        def failed(failure):
+            if self._stopped:
+                self._notify('connectionLost', failure)
+            else:
+                self._scheduleReconnect(failure)
+        d.addCallbacks(connected, failed)
+
+    def _restartNow(self, restarts):
+        d = self._connect()
+
+        def connected(_):
+            if self._stopped:
+                # stopped while connecting
+                self._running = False
+                self._prot.stopProducing()
+            for restart in restarts:
+                restart.callback(self._since)
+
+        def failed(failure):
+            if self._reconnect is not None and not self._stopped:
+                self._scheduleReconnect(failure)
+            else:
+                self._stopped = True
+                self._notify('connectionLost', failure)
+            for restart in restarts:
+                restart.errback(failure)
+        d.addCallbacks(connected, failed)
 
     # called by receiver
 
@@ -146,6 +510,56 @@ class ChangeNotifier(object):
         for listener in self._listeners:
             listener.changed(change)
 
+        if seq and self._checkpointStore is not None:
+            self._processedChange(seq)
+
+    def changedBatch(self, changes):
+        if not self.batchWindow:
+            self._dispatchBatch(changes)
+            return
+
+        self._pending.extend(changes)
+        if self._batchCall is None:
+            self._batchCall = self._clock.callLater(self.batchWindow,
+                self._flushBatch)
+
+    def _flushBatch(self):
+        if self._batchCall is not None:
+            if self._batchCall.active():
+                self._batchCall.cancel()
+            self._batchCall = None
+        if self._pending:
+            changes = self._pending
+            self._pending = []
+            self._dispatchBatch(changes)
+
+    def _dispatchBatch(self, changes):
+        seq = None
+        for change in changes:
+            seq = change.get('seq', None) or seq
+        if seq:
+            self._since = seq
+
+        ids = [change['id'] for change in changes]
+        for cache in self._caches:
+            deleteMany = getattr(cache, 'deleteMany', None)
+            if deleteMany is not None:
+                deleteMany(ids)
+            else:
+                for docId in ids:
+                    cache.delete(docId)
+
+        for listener in self._listeners:
+            changedBatch = getattr(listener, 'changedBatch', None)
+            if changedBatch is not None:
+                changedBatch(changes)
+            else:
+                for change in changes:
+                    listener.changed(change)
+
+        if seq and self._checkpointStore is not None:
+            self._processedChange(seq, len(changes))
+
     def connectionLost(self, reason):
         # even if we asked to stop, we still get
         # a twisted.web._newclient.ResponseFailed containing
@@ -161,7 +575,27 @@ class ChangeNotifier(object):
                 not self.isRunning():
                 reason = reason.value.reasons[0]
 
+        self._cancelStallCheck()
+        # deliver what was received before telling of the lost connection
+        self._flushBatch()
+        if self._stalled:
+            self._stalled = False
+            reason = Failure(FeedStalled(
+                "nothing received for %s seconds" % (
+                    self.heartbeat * self.stallFactor, )))
+
         self._prot = None
+        restarts, self._restarts = self._restarts, []
+        if restarts:
+            if not self._stopped:
+                self._restartNow(restarts)
+                return
+            for restart in restarts:
+                restart.errback(reason)
         self._running = False
+        if self._reconnect is not None and not self._stopped:
+            self._scheduleReconnect(reason)
+            return
+        self._stopped = True
         for listener in self._listeners:
             listener.connectionLost(reason)
@@ -0,0 +1,152 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_checkpoint -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Durable storage of the position of a change feed, so that a
+L{paisley.changes.ChangeNotifier} can resume where it stopped.
+"""
+
+import os
+
+from urllib import quote
+
+from twisted.internet import defer
+
+from paisley import pjson as json
+
+
+class CheckpointStore:
+    """
+    I am an interface for storing the sequence number of the last change
+    processed.
+
+    Sequence numbers are integers or, for CouchDB 2 and later, strings.
+    """
+
+    def load(self):
+        """
+        @return: a deferred firing with the stored sequence number, or None
+            if none was stored.
+        """
+        pass
+
+    def save(self, seq):
+        """
+        Store a sequence number, replacing the previous one.
+
+        @return: a deferred firing once it is stored.
+        """
+        pass
+
+
+class FileCheckpointStore(object):
+    """
+    I store the sequence number in a local file.
+
+    The file is replaced by renaming a temporary file over it, so it holds
+    either the previous or the new sequence number even if the process
+    dies while saving.
+    """
+
+    def __init__(self, path, fsync=True):
+        """
+        @param fsync: whether to flush the temporary file to disk before
+            renaming it, so the sequence number also survives a crash of the
+            machine.
+        """
+        self.path = path
+        self.fsync = fsync
+
+    def load(self):
+        try:
+            handle = open(self.path)
+        except IOError:
+            return defer.succeed(None)
+        try:
+            return defer.succeed(json.loads(handle.read())['seq'])
+        finally:
+            handle.close()
+
+    def save(self, seq):
+        tmp = self.path + '.tmp'
+        handle = open(tmp, 'w')
+        try:
+            handle.write(json.dumps({'seq': seq}))
+            handle.flush()
+            if self.fsync:
+                os.fsync(handle.fileno())
+        finally:
+            handle.close()
+        os.rename(tmp, self.path)
+        return defer.succeed(None)
+
+
+class LocalDocCheckpointStore(object):
+    """
+    I store the sequence number in a _local document of a database, which
+    is not replicated.
+
+    The document is read and written with plain requests, so that neither
+    the batchers nor the caches of the client get involved.
+    """
+
+    def __init__(self, db, dbName, name):
+        """
+        @type  db:   L{paisley.client.CouchDB}
+        @param name: the name of the checkpoint; the document id is
+            C{_local/} followed by it.
+        """
+        self._db = db
+        self._dbName = dbName
+        self.docId = u'_local/' + unicode(name)
+        self._uri = "/%s/%s" % (dbName, quote(self.docId.encode('utf-8')))
+        self._rev = None
+
+    def load(self):
+        # twisted.web.error imports reactor
+        from twisted.web import error as tw_error
+
+        def loaded(doc):
+            self._rev = doc['_rev']
+            return doc['seq']
+
+        def missing(failure):
+            failure.trap(tw_error.Error)
+            if int(failure.value.status) != 404:
+                return failure
+            self._rev = None
+            return None
+
+        d = self._db.get(self._uri, descr='loadCheckpoint')
+        d.addCallback(self._db.parseResult)
+        return d.addCallbacks(loaded, missing)
+
+    def save(self, seq):
+        # twisted.web.error imports reactor
+        from twisted.web import error as tw_error
+
+        def put():
+            doc = {'seq': seq}
+            if self._rev is not None:
+                doc['_rev'] = self._rev
+            d = self._db.put(self._uri, json.dumps(doc),
+                descr='saveCheckpoint')
+            return d.addCallback(self._db.parseResult)
+
+        def saved(result):
+            self._rev = result['rev']
+
+        def conflict(failure):
+            # someone else wrote it; overwrite with the current revision
+            failure.trap(tw_error.Error)
+            if int(failure.value.status) != 409:
+                return failure
+            d = self.load()
+            d.addCallback(lambda _: put())
+            return d.addCallback(saved)
+
+        d = put()
+        return d.addCallbacks(saved, conflict)
@@ -11,26 +11,42 @@ CouchDB client.
 from paisley import pjson as json
 
 from encodings import utf_8
+import hashlib
 import logging
 import new
+import os
+import re
+import time
+import uuid
 
+from collections import OrderedDict
 from urllib import urlencode, quote
 from zope.interface import implements
 
+from twisted.python.components import proxyForInterface
 from twisted.web.http_headers import Headers
-from twisted.web.iweb import IBodyProducer
-
-from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.defer import gatherResults, CancelledError
+from twisted.internet.defer import TimeoutError
+from twisted.internet.error import ConnectingCancelledError
+from twisted.internet.interfaces import IConsumer, IProtocol
 from twisted.internet.protocol import Protocol
+from twisted.internet import task
+from twisted.python.failure import Failure
 
 try:
-    from base64 import b64encode
+    from base64 import b64encode, b64decode
 except ImportError:
     import base64
 
     def b64encode(s):
         return "".join(base64.encodestring(s).split("\n"))
 
+    b64decode = base64.decodestring
+
 
 def short_print(body, trim=255):
     # don't go nuts on possibly huge log entries
@@ -64,6 +80,44 @@ except ImportError:
 
 SOCK_TIMEOUT = 300
 
+# defaults for splitting bulk requests
+BULK_CHUNK_SIZE = 500
+BULK_CHUNK_BYTES = 4 * 1024 * 1024
+BULK_CONCURRENCY = 4
+
+
+class _Marker(object):
+    """
+    A unique value with a readable representation.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __repr__(self):
+        return self._name
+
+# results of openDocs for documents that do not exist or were deleted
+MISSING = _Marker('MISSING')
+DELETED = _Marker('DELETED')
+
+
+class CachedBody(str):
+    """
+    A response body kept with its ETag, returned again when the server
+    answers a conditional request with 304 Not Modified.
+
+    It is parsed again each time, since keeping the parsed value would hold
+    several times the memory accounted for by the cache.
+    """
+
+    def __new__(cls, body, etag):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self = str.__new__(cls, body)
+        self.etag = etag
+        return self
+
 
 class StringProducer(object):
     """
@@ -85,6 +139,157 @@ class StringProducer(object):
         pass
 
 
+class IterableProducer(object):
+    """
+    Body producer for t.w.c.Agent writing the strings of an iterable, one
+    per cooperative iteration, so that they do not all need to be in memory.
+    """
+    implements(IBodyProducer)
+
+    def __init__(self, iterable, length, cooperator=task):
+        """
+        @param length: the total length of the strings.
+        """
+        self.length = length
+        self._iterator = iter(iterable)
+        self._cooperate = cooperator.cooperate
+        self._task = None
+
+    def startProducing(self, consumer):
+        self._task = self._cooperate(self._writeloop(consumer))
+        d = self._task.whenDone()
+
+        def maybeStopped(failure):
+            # like FileBodyProducer, never fire if we were stopped
+            failure.trap(task.TaskStopped)
+            return Deferred()
+        return d.addCallbacks(lambda ignored: None, maybeStopped)
+
+    def _writeloop(self, consumer):
+        written = 0
+        for data in self._iterator:
+            written += len(data)
+            if written > self.length:
+                raise ValueError("Body is longer than %d bytes" % (
+                    self.length, ))
+            consumer.write(data)
+            yield None
+        if written != self.length:
+            raise ValueError("Body is %d bytes instead of %d" % (
+                written, self.length))
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        self._task.stop()
+
+
+def _dataLength(data):
+    """
+    Return the length of a string, or of a file-like object from its
+    current position to its end.
+    """
+    if isinstance(data, str):
+        return len(data)
+    current = data.tell()
+    data.seek(0, os.SEEK_END)
+    end = data.tell()
+    data.seek(current, os.SEEK_SET)
+    return end - current
+
+
+def _dataChunks(data, readSize=2 ** 16):
+    if isinstance(data, str):
+        yield data
+        return
+    while True:
+        chunk = data.read(readSize)
+        if not chunk:
+            return
+        yield chunk
+
+
+def multipartRelated(document, attachments, boundary=None):
+    """
+    Build a C{multipart/related} body saving a document with its
+    attachments, which are streamed as raw bytes instead of being
+    base64-encoded into the document.
+
+    @param document: the document; it is not modified.
+    @type document: C{dict}
+
+    @param attachments: attachment name -> data or (content type, data),
+        where data is a C{str} or a seekable file-like object.
+    @type attachments: C{dict}
+
+    @return: the Content-Type of the body, and its producer.
+    @rtype: C{tuple} of (C{str}, L{IterableProducer})
+    """
+    if boundary is None:
+        boundary = uuid.uuid4().hex
+
+    document = dict(document)
+    # CouchDB matches the parts with the stubs in order
+    stubs = OrderedDict(document.get('_attachments', {}))
+    parts = []
+    for name in sorted(attachments):
+        data = attachments[name]
+        contentType = 'application/octet-stream'
+        if isinstance(data, tuple):
+            contentType, data = data
+        length = _dataLength(data)
+        # a replaced stub moves to the end, in the order of the parts
+        stubs.pop(name, None)
+        stubs[name] = {'follows': True, 'content_type': contentType,
+            'length': length}
+        parts.append((contentType, data, length))
+    document['_attachments'] = stubs
+
+    body = json.dumps(document)
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    head = "--%s\r\nContent-Type: application/json\r\n\r\n%s" % (
+        boundary, body)
+    separators = []
+    for contentType, data, length in parts:
+        separators.append("\r\n--%s\r\nContent-Type: %s\r\n\r\n" % (
+            boundary, contentType))
+    tail = "\r\n--%s--" % (boundary, )
+
+    def chunks():
+        yield head
+        for separator, (_, data, _) in zip(separators, parts):
+            yield separator
+            for chunk in _dataChunks(data):
+                yield chunk
+        yield tail
+
+    length = len(head) + len(tail) + sum(len(sep) for sep in separators) + \
+        sum(part[2] for part in parts)
+    return ('multipart/related; boundary="%s"' % (boundary, ),
+        IterableProducer(chunks(), length))
+
+
+class ByteCounter(proxyForInterface(IProtocol)):
+    """
+    Passes received data on to another protocol, counting its length.
+
+    @ivar length: number of bytes received so far.
+    """
+
+    def __init__(self, original):
+        self.original = original
+        self.length = 0
+
+    def dataReceived(self, data):
+        self.length += len(data)
+        self.original.dataReceived(data)
+
+
 class ResponseReceiver(Protocol):
     """
     Assembles HTTP response from return stream.
@@ -108,6 +313,243 @@ class ResponseReceiver(Protocol):
         if reason.check(ResponseDone) or reason.check(PotentialDataLoss):
             self.dataReceived('', final=True)
             self.deferred.callback(''.join(self.recv_chunks))
+        else:
+            self.recv_chunks = []
+            self.deferred.errback(reason)
+
+
+class RowReceiver(Protocol):
+    """
+    Parses a view or _all_docs response while it arrives, calling
+    C{rowCallback} with each row as soon as it is complete.
+
+    Only the row being received and the members of the response outside of
+    the rows array are kept in memory.
+
+    When the response is complete, C{deferred} fires with a dict of those
+    other members (total_rows, offset, ...).
+    """
+
+    # characters that matter outside and inside of strings
+    _structure = re.compile(r'[\[\]{}"]')
+    _string = re.compile(r'["\\]')
+    _rowsKey = re.compile(r'"rows"\s*:\s*$')
+
+    def __init__(self, deferred, rowCallback):
+        self.deferred = deferred
+        self.rowCallback = rowCallback
+
+        self._envelope = [] # text outside of the rows array
+        self._row = [] # text of the row being received
+        self._depth = 0
+        self._inString = False
+        self._escaped = False
+        self._inRows = False
+        self._rowsDone = False
+        self._failure = None
+
+    def dataReceived(self, bytes):
+        if self._failure:
+            return
+
+        # start of the text not yet added to the envelope or the row
+        start = 0
+        pos = 0
+        end = len(bytes)
+        while pos < end:
+            if self._escaped:
+                self._escaped = False
+                pos += 1
+                continue
+
+            if self._inString:
+                m = self._string.search(bytes, pos)
+                if not m:
+                    break
+                pos = m.end()
+                if m.group() == '\\':
+                    self._escaped = True
+                else:
+                    self._inString = False
+                continue
+
+            m = self._structure.search(bytes, pos)
+            if not m:
+                break
+            char = m.group()
+            pos = m.end()
+
+            if char == '"':
+                self._inString = True
+            elif char in '{[':
+                self._depth += 1
+                if self._inRows:
+                    if self._depth == 3:
+                        # a row starts; drop the separator before it
+                        start = pos - 1
+                elif self._depth == 2 and char == '[' and \
+                        not self._rowsDone:
+                    envelope = ''.join(self._envelope) + bytes[start:pos]
+                    if self._rowsKey.search(envelope[:-1]):
+                        self._envelope = [envelope]
+                        self._inRows = True
+                        start = pos
+            else:
+                self._depth -= 1
+                if self._inRows:
+                    if self._depth == 2:
+                        self._row.append(bytes[start:pos])
+                        start = pos
+                        row = ''.join(self._row)
+                        self._row = []
+                        if not self._rowReceived(row):
+                            return
+                    elif self._depth == 1:
+                        self._inRows = False
+                        self._rowsDone = True
+                        start = pos - 1
+
+        if self._inRows:
+            # between rows, only separators are left
+            if self._depth > 2:
+                self._row.append(bytes[start:])
+        else:
+            self._envelope.append(bytes[start:])
+
+    def _rowReceived(self, row):
+        try:
+            self.rowCallback(json.loads(row))
+        except:
+            self._failure = Failure()
+            self.transport.stopProducing()
+            return False
+        return True
+
+    def connectionLost(self, reason):
+        # _newclient and http import reactor
+        from twisted.web._newclient import ResponseDone
+        from twisted.web.http import PotentialDataLoss
+
+        if self._failure:
+            self.deferred.errback(self._failure)
+        elif reason.check(ResponseDone) or reason.check(PotentialDataLoss):
+            try:
+                envelope = json.loads(''.join(self._envelope))
+            except ValueError:
+                self.deferred.errback()
+                return
+            if isinstance(envelope, dict):
+                envelope.pop('rows', None)
+            self.deferred.callback(envelope)
+        else:
+            self.deferred.errback(reason)
+
+
+class RequestTimeout(TimeoutError):
+    """
+    A request did not complete before its deadline, and was aborted.
+    """
+
+
+class DigestMismatch(Exception):
+    """
+    The data received does not match the expected digest.
+    """
+
+
+class BulkDocsError(Exception):
+    """
+    A _bulk_docs request for a chunk of documents failed, so the chunks not
+    sent yet were not sent either.
+
+    @ivar results: the results in the order of the documents, as returned
+        on success for the chunks that were answered, and None for the
+        documents of the chunks that failed or were not sent.
+    @type results: C{list}
+    @ivar failure: the failure of the first chunk that failed.
+    @type failure: L{twisted.python.failure.Failure}
+    """
+
+    def __init__(self, results, failure):
+        Exception.__init__(self, results, failure)
+        self.results = results
+        self.failure = failure
+
+    def __str__(self):
+        return "%d of %d documents not saved: %s" % (
+            self.results.count(None), len(self.results),
+            self.failure.getErrorMessage())
+
+
+class AttachmentReceiver(Protocol):
+    """
+    Writes an attachment to a consumer as it arrives, instead of
+    assembling it in memory.
+
+    The consumer can be an L{IConsumer}, which is registered with the
+    transport as a streaming producer so it can pause and resume the
+    download, a file-like object, or a callable.
+
+    When the attachment is complete, C{deferred} fires with its length.
+    """
+
+    def __init__(self, deferred, consumer, digest=None):
+        """
+        @param digest: if specified, the digest of the attachment, as in
+            its stub in the document (C{md5-} followed by the base64 MD5).
+        """
+        self.deferred = deferred
+        self.consumer = consumer
+        self.length = 0
+        self._failure = None
+
+        if IConsumer.providedBy(consumer) or hasattr(consumer, 'write'):
+            self._write = consumer.write
+        else:
+            self._write = consumer
+
+        self._md5 = None
+        if digest:
+            algorithm, _, value = digest.partition('-')
+            if algorithm != 'md5':
+                raise ValueError("Unsupported digest %r" % (digest, ))
+            self._md5 = hashlib.md5()
+            self._expected = b64decode(value)
+
+    def connectionMade(self):
+        if IConsumer.providedBy(self.consumer):
+            self.consumer.registerProducer(self.transport, True)
+
+    def dataReceived(self, bytes):
+        if self._failure:
+            return
+        self.length += len(bytes)
+        if self._md5:
+            self._md5.update(bytes)
+        try:
+            self._write(bytes)
+        except:
+            self._failure = Failure()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        # _newclient and http import reactor
+        from twisted.web._newclient import ResponseDone
+        from twisted.web.http import PotentialDataLoss
+
+        if IConsumer.providedBy(self.consumer):
+            self.consumer.unregisterProducer()
+
+        if self._failure:
+            self.deferred.errback(self._failure)
+        elif reason.check(ResponseDone) or reason.check(PotentialDataLoss):
+            if self._md5 and self._md5.digest() != self._expected:
+                self.deferred.errback(DigestMismatch(
+                    "Received attachment has digest md5-%s, not md5-%s" % (
+                        b64encode(self._md5.digest()),
+                        b64encode(self._expected))))
+            else:
+                self.deferred.callback(self.length)
         else:
             self.deferred.errback(reason)
 
@@ -119,7 +561,10 @@ class CouchDB(object):
 
     def __init__(self, host, port=5984, dbName=None,
                  username=None, password=None, disable_log=False,
-                 version=(1, 0, 1)):
+                 version=(1, 0, 1), persistent=False, pool=None,
+                 maxPersistentPerHost=2, cachedConnectionTimeout=240,
+                 coalesce=False, compression=False, compressThreshold=4096,
+                 timeout=SOCK_TIMEOUT, clock=None, retryPolicy=None):
         """
         Initialize the client for given host.
 
@@ -132,11 +577,73 @@ class CouchDB(object):
         @param dbName: if specified, all calls needing a database name will use
             this one by default.
         @type dbName: C{str}
+
+        @param persistent: if True, keep connections alive between requests
+            in a new L{paisley.pool.ConnectionPool}.
+        @type persistent: C{bool}
+
+        @param pool: if specified, the connection pool to use; this allows
+            several clients to share their connections.  Implies persistent.
+        @type pool: L{twisted.web.client.HTTPConnectionPool}
+
+        @param maxPersistentPerHost: maximum number of idle connections kept
+            per host by a pool created because of C{persistent}.
+        @type maxPersistentPerHost: C{int}
+
+        @param cachedConnectionTimeout: number of seconds an idle connection
+            is kept by a pool created because of C{persistent}.
+        @type cachedConnectionTimeout: C{int}
+
+        @param coalesce: if True, concurrent identical C{GET} requests share
+            a single HTTP request.  A C{GET} started while a write is in
+            flight may then return the state from before that write.
+        @type coalesce: C{bool}
+
+        @param timeout: number of seconds after which a request is aborted
+            and fails with L{RequestTimeout}, unless the call specifies its
+            own; None for no deadline.  Streamed downloads and uploads, which
+            can take any time, only get the deadline their call specifies.
+        @type timeout: C{int}
+
+        @param clock: provider of L{twisted.internet.interfaces.IReactorTime}
+            used for deadlines and retries, the reactor by default.
+
+        @param retryPolicy: if specified, the policy deciding which requests
+            failing because of transient errors are retried.  A deadline
+            covers all attempts of a request.
+        @type retryPolicy: L{paisley.retry.RetryPolicy}
         """
         from twisted.internet import reactor
         # t.w.c imports reactor
         from twisted.web.client import Agent
-        self.client = Agent(reactor)
+        if pool is None and persistent:
+            from paisley.pool import ConnectionPool
+            pool = ConnectionPool(reactor,
+                maxPersistentPerHost=maxPersistentPerHost,
+                cachedConnectionTimeout=cachedConnectionTimeout)
+        self.pool = pool
+        self.client = Agent(reactor, pool=pool)
+        self.compression = compression
+        self.compressThreshold = compressThreshold
+        if compression:
+            from twisted.web.client import ContentDecoderAgent
+            from paisley.compress import CountingGzipDecoder
+            self.client = ContentDecoderAgent(self.client,
+                [('gzip', CountingGzipDecoder)])
+        self._writeBatcher = None
+        self._readBatcher = None
+        self._docCaches = {}
+        self._viewCache = None
+        self._etags = None
+        self._decodePool = None
+        self._decodeThreshold = None
+        self._decodeTrigger = None
+        self.coalesce = coalesce
+        self._inFlight = {}
+        self.timeout = timeout
+        self.clock = clock or reactor
+        self.retryPolicy = retryPolicy
+        self._stats = {}
         self.host = host
         self.port = int(port)
         self.username = username
@@ -169,11 +676,226 @@ class CouchDB(object):
                        dbName if dbName else '')
         self.version = version
 
+    def getStats(self):
+        """
+        Return a dictionary of statistics about this client.
+
+        Counters, such as C{coalesced}, only appear once they are non-zero.
+        C{bytesSent} and C{bytesReceived} count body bytes before
+        compression and after decompression, C{bytesSentWire} and
+        C{bytesReceivedWire} as they were on the wire.
+        C{decodeSeconds} is the time spent decoding JSON results in the
+        reactor thread, and C{threadDecodeSeconds} the time spent decoding
+        the C{threadDecodes} results decoded in threads.
+        C{retries} counts retry attempts, and C{retriesExhausted} requests
+        that still failed with a retryable error after their last retry.
+        If a connection pool is used, its statistics are under the C{pool}
+        key.
+        """
+        stats = dict(self._stats)
+        if self.pool is not None and hasattr(self.pool, 'getStats'):
+            stats['pool'] = self.pool.getStats()
+        return stats
+
+    def enableWriteBatching(self, window=0.01, maxDocs=100,
+                            maxBytes=1024 * 1024, clock=None):
+        """
+        Collect L{saveDoc} calls and send them together through _bulk_docs.
+
+        Documents are sent C{window} seconds after the first pending one,
+        or as soon as C{maxDocs} documents or C{maxBytes} bytes are pending
+        for a database.  Each saveDoc call still gets its own result, or
+        fails with the same L{twisted.web.error.Error} as without batching.
+        Calls with attachments or a timeout are not batched.
+
+        @rtype: L{paisley.batch.WriteBatcher}
+        """
+        from paisley.batch import WriteBatcher
+        if self._writeBatcher is not None:
+            self._writeBatcher.flush()
+        self._writeBatcher = WriteBatcher(self, window=window,
+            maxDocs=maxDocs, maxBytes=maxBytes, clock=clock)
+        return self._writeBatcher
+
+    def disableWriteBatching(self):
+        """
+        Send pending batched documents, and stop batching L{saveDoc} calls.
+
+        @return: a deferred firing when the pending documents are saved.
+        """
+        batcher, self._writeBatcher = self._writeBatcher, None
+        if batcher is None:
+            return succeed(None)
+        return batcher.flush()
+
+    def enableReadBatching(self, clock=None):
+        """
+        Collect L{openDoc} calls made during the same reactor iteration and
+        fetch the documents with a single bulk request per database.
+
+        Only calls without a revision, full, attachment or timeout argument,
+        and not for _local documents, are batched.  Missing and deleted
+        documents still fail with a 404 L{twisted.web.error.Error}.
+
+        @rtype: L{paisley.batch.ReadBatcher}
+        """
+        from paisley.batch import ReadBatcher
+        if self._readBatcher is not None:
+            self._readBatcher.flush()
+        self._readBatcher = ReadBatcher(self, clock=clock)
+        return self._readBatcher
+
+    def disableReadBatching(self):
+        """
+        Fetch pending batched documents, and stop batching L{openDoc} calls.
+        """
+        batcher, self._readBatcher = self._readBatcher, None
+        if batcher is not None:
+            batcher.flush()
+
+    def enableThreadedDecoding(self, threshold=1024 * 1024, poolSize=2):
+        """
+        Decode JSON results of at least C{threshold} bytes in a pool of
+        C{poolSize} threads instead of in the reactor thread, so that other
+        connections keep being served meanwhile.
+
+        They are decoded with L{paisley.pjson.loads_in_slices}: the C
+        decoder holds the GIL until it is done, which would block the
+        reactor thread just the same.  With a codec other than the stdlib
+        json, they are decoded whole, and a C decoder still blocks the
+        reactor thread meanwhile.
+
+        @rtype: L{twisted.python.threadpool.ThreadPool}
+        """
+        from twisted.internet import reactor
+        from twisted.python.threadpool import ThreadPool
+
+        self.disableThreadedDecoding()
+        self._decodeThreshold = threshold
+        self._decodePool = ThreadPool(minthreads=0, maxthreads=poolSize,
+            name='paisley-decode')
+        self._decodePool.start()
+        self._decodeTrigger = reactor.addSystemEventTrigger('during',
+            'shutdown', self._decodePool.stop)
+        return self._decodePool
+
+    def disableThreadedDecoding(self):
+        """
+        Decode all JSON results in the reactor thread again, and stop the
+        decoding threads once the results being decoded are done.
+        """
+        from twisted.internet import reactor
+
+        pool, self._decodePool = self._decodePool, None
+        if pool is not None:
+            reactor.removeSystemEventTrigger(self._decodeTrigger)
+            self._decodeTrigger = None
+            pool.stop()
+
+    def setDocCache(self, dbName, cache):
+        """
+        Read documents of the given database through a cache.
+
+        L{openDoc} calls without a revision, full or attachment argument
+        are answered from the cache when possible.  Documents written
+        through this client are removed from the cache; to also see writes
+        from other clients, register the cache with
+        L{paisley.changes.ChangeNotifier.addCache}.
+
+        @param cache: the cache, or None to stop caching.
+        @type  cache: L{paisley.cache.LRUCache}
+        """
+        if cache is None:
+            self._docCaches.pop(dbName, None)
+        else:
+            self._docCaches[dbName] = cache
+
+    def setViewCache(self, cache):
+        """
+        Answer L{openView} calls from a cache of results while the update
+        sequence of their database does not change.
+
+        Unless the database is followed by a listener from
+        L{paisley.cache.ViewCache.listenerFor}, its update sequence is
+        requested before each view query.
+
+        @param cache: the cache, or None to stop caching.
+        @type  cache: L{paisley.cache.ViewCache}
+        """
+        self._viewCache = cache
+
+    def enableConditionalRequests(self, maxEntries=1000,
+                                  maxBytes=16 * 1024 * 1024):
+        """
+        Remember the ETag and body of JSON C{GET} responses, and revalidate
+        them with C{If-None-Match} on later identical requests.
+
+        When the server answers 304 Not Modified, the remembered body is
+        used instead of downloading it again.  It is still parsed on each
+        revalidation, so only the transfer is saved.
+
+        @param maxEntries: maximum number of responses remembered.
+        @param maxBytes:   maximum total size of the responses remembered.
+        """
+        from paisley.cache import LRUCache
+        self._etags = LRUCache(maxEntries=maxEntries, maxBytes=maxBytes)
+
+    def disableConditionalRequests(self):
+        """
+        Forget remembered responses and stop sending conditional requests.
+        """
+        self._etags = None
+
+    def _invalidate(self, result, dbName, docIds):
+        """
+        Remove the given documents from the document cache, if any.
+
+        Returns C{result} so it can be used as a callback.
+        """
+        cache = self._docCaches.get(dbName, None)
+        if cache is not None:
+            for docId in docIds:
+                if docId is not None:
+                    cache.delete(docId)
+        return result
+
+    def _count(self, name, amount=1):
+        self._stats[name] = self._stats.get(name, 0) + amount
+
     def parseResult(self, result):
         """
         Parse JSON result from the DB.
+
+        With threaded decoding enabled, returns a deferred for results
+        decoded in a thread.
         """
-        return json.loads(result)
+        if self._decodePool is not None and \
+                len(result) >= self._decodeThreshold:
+            return self._parseInThread(result)
+
+        start = time.time()
+        try:
+            return json.loads(result)
+        finally:
+            self._count('decodeSeconds', time.time() - start)
+
+    def _parseInThread(self, result):
+        from twisted.internet import reactor
+        from twisted.internet.threads import deferToThreadPool
+
+        def decode():
+            start = time.time()
+            value = json.loads_in_slices(result)
+            return value, time.time() - start
+
+        def decoded((value, seconds)):
+            # back in the reactor thread
+            self._count('threadDecodes')
+            self._count('threadDecodeSeconds', seconds)
+            return value
+
+        return deferToThreadPool(reactor, self._decodePool,
+            decode).addCallback(decoded)
 
     def bindToDB(self, dbName):
         """
@@ -181,7 +903,9 @@ class CouchDB(object):
         """
         for methname in ["createDB", "deleteDB", "infoDB", "listDoc",
                          "openDoc", "saveDoc", "deleteDoc", "openView",
-                         "tempView"]:
+                         "tempView", "saveDocs", "deleteDocs", "openDocs",
+                         "streamDocs", "streamView", "openAttachment",
+                         "putAttachment"]:
             method = getattr(self, methname)
             newMethod = partial(method, dbName)
             setattr(self, methname, newMethod)
@@ -274,6 +998,37 @@ class CouchDB(object):
         if obsolete:
             raise AttributeError("Unknown attribute(s): %r" % (
                 obsolete.keys(), ))
+        return self.get(self._listDocUri(dbName, reverse, startkey, endkey,
+            include_docs, limit), descr='listDoc').addCallback(
+                self.parseResult)
+
+    def streamDocs(self, dbName, rowCallback, reverse=False, startkey=None,
+                   endkey=None, include_docs=False, limit=-1, timeout=None):
+        """
+        List all documents in a given database, calling C{rowCallback} with
+        each row as it arrives instead of keeping the whole result in memory.
+
+        @param rowCallback: called with each row.  If it raises, the request
+            is aborted and the returned deferred fails.
+        @type rowCallback: callable
+
+        @param timeout: if specified, the deadline of the whole listing in
+            seconds; by default, it has none.
+        @type timeout: C{int}
+
+        The other arguments are as for L{listDoc}.
+
+        @return: a deferred firing with a dict of the members of the result
+            other than rows, such as C{total_rows} and C{offset}.
+        @rtype: L{Deferred}
+        """
+        return self.get(self._listDocUri(dbName, reverse, startkey, endkey,
+            include_docs, limit), descr='streamDocs',
+            receiver=partial(RowReceiver, rowCallback=rowCallback),
+            timeout=timeout)
+
+    def _listDocUri(self, dbName, reverse, startkey, endkey, include_docs,
+                    limit):
         uri = "/%s/_all_docs" % (dbName, )
         args = {}
         if reverse:
@@ -288,9 +1043,10 @@ class CouchDB(object):
             args["limit"] = int(limit)
         if args:
             uri += "?%s" % (urlencode(args), )
-        return self.get(uri, descr='listDoc').addCallback(self.parseResult)
+        return uri
 
-    def openDoc(self, dbName, docId, revision=None, full=False, attachment=""):
+    def openDoc(self, dbName, docId, revision=None, full=False, attachment="",
+                timeout=None):
         """
         Open a document in a given database.
 
@@ -306,6 +1062,11 @@ class CouchDB(object):
         @param attachment: if specified, return the named attachment from the
             document.
         @type attachment: C{str}
+
+        @param timeout: if specified, the deadline of the request in seconds,
+            instead of the one of the client.
+        @type timeout: C{int}
+            Calls with a deadline are not batched.
         """
         # Responses: {u'_rev': -1825937535, u'_id': u'mydoc', ...}
         # 404 Object Not Found
@@ -320,6 +1081,40 @@ class CouchDB(object):
             assert type(revision) is unicode, \
                 'revision is %r instead of unicode' % (type(revision), )
 
+        # _all_docs never returns _local documents, which are not in the
+        # change feed either
+        plain = revision is None and not full and not attachment and \
+            not docId.startswith(u'_local/')
+        cache = None
+        if plain:
+            cache = self._docCaches.get(dbName, None)
+        if cache is not None:
+            body = cache.get(docId)
+            if body is not None:
+                return succeed(body).addCallback(self.parseResult)
+
+            # don't store what was fetched while the document changed
+            token = cache.fetching(docId)
+
+            def store(body):
+                if cache.fetched(docId, token):
+                    cache.set(docId, body)
+                return body
+
+            def failed(failure):
+                cache.fetched(docId, token)
+                return failure
+
+        if self._readBatcher is not None and plain and timeout is None:
+            d = self._readBatcher.openDoc(dbName, docId)
+            if cache is not None:
+
+                def storeDoc(doc):
+                    store(json.dumps(doc))
+                    return doc
+                d.addCallbacks(storeDoc, failed)
+            return d
+
         uri = "/%s/%s" % (dbName, quote(docId.encode('utf-8')))
         if revision is not None:
             uri += "?%s" % (urlencode({"rev": revision.encode('utf-8')}), )
@@ -328,8 +1123,118 @@ class CouchDB(object):
         elif attachment:
             uri += "/%s" % quote(attachment)
             # No parsing
-            return self.get(uri, descr='openDoc', isJson=False)
-        return self.get(uri, descr='openDoc').addCallback(self.parseResult)
+            return self.get(uri, descr='openDoc', isJson=False,
+                timeout=timeout)
+        d = self.get(uri, descr='openDoc', timeout=timeout)
+        if cache is not None:
+            d.addCallbacks(store, failed)
+        return d.addCallback(self.parseResult)
+
+    def openAttachment(self, dbName, docId, name, consumer, digest=None,
+                       timeout=None):
+        """
+        Write an attachment to a consumer while it is downloaded.
+
+        @param dbName: identifier of the database.
+        @type dbName: C{str}
+
+        @param docId: the identifier of the document.
+        @type docId: C{unicode}
+
+        @param name: the name of the attachment.
+        @type name: C{str}
+
+        @param consumer: where to write the attachment: an L{IConsumer},
+            which can pause and resume the download, a file-like object or a
+            callable.
+
+        @param digest: if specified, the digest of the attachment from its
+            stub, to verify the download against.
+        @type digest: C{str}
+
+        @param timeout: if specified, the deadline of the download in
+            seconds; by default, it has none.
+        @type timeout: C{int}
+
+        @return: a deferred firing with the length of the attachment, or
+            failing with L{DigestMismatch}.
+        @rtype: L{Deferred}
+        """
+        docId = unicode(docId)
+        uri = "/%s/%s/%s" % (dbName, quote(docId.encode('utf-8')),
+            quote(name))
+        return self.get(uri, descr='openAttachment', isJson=False,
+            receiver=partial(AttachmentReceiver, consumer=consumer,
+                digest=digest), timeout=timeout)
+
+    def putAttachment(self, dbName, docId, name, data, revision=None,
+                      contentType='application/octet-stream', length=None,
+                      timeout=None):
+        """
+        Upload an attachment as raw bytes, streamed instead of base64-encoded
+        into its document.
+
+        @param dbName: identifier of the database.
+        @type dbName: C{str}
+
+        @param docId: the identifier of the document, which is created if
+            it does not exist.
+        @type docId: C{unicode}
+
+        @param name: the name of the attachment.
+        @type name: C{str}
+
+        @param data: the attachment: a C{str}, a file-like object, which is
+            read in chunks, or an iterable of C{str}, in which case C{length}
+            is required.
+
+        @param revision: the current revision of the document, if it exists.
+        @type revision: C{unicode}
+
+        @param contentType: the MIME type of the attachment.
+        @type contentType: C{str}
+
+        @param length: the length of the attachment; by default, the length
+            of a file-like object is found by seeking to its end.
+        @type length: C{int}
+
+        @param timeout: if specified, the deadline of the upload in seconds;
+            by default, it has none.
+        @type timeout: C{int}
+
+        @return: a deferred firing with the new revision of the document, as
+            for L{saveDoc}.
+        @rtype: L{Deferred}
+        """
+        # Responses: {'ok': True, 'id': 'mydoc', 'rev': '2-...'}
+        # 409 Conflict if revision is not the current one
+        docId = unicode(docId)
+        uri = "/%s/%s/%s" % (dbName, quote(docId.encode('utf-8')),
+            quote(name))
+        if revision is not None:
+            uri += "?" + urlencode({'rev': unicode(revision).encode('utf-8')})
+
+        if isinstance(data, str):
+            producer = StringProducer(data)
+        elif hasattr(data, 'read'):
+            # t.w.c imports reactor
+            from twisted.web.client import FileBodyProducer
+            producer = FileBodyProducer(data)
+            if length is not None:
+                producer.length = length
+            if producer.length is UNKNOWN_LENGTH:
+                raise ValueError("Cannot find the length of %r" % (data, ))
+        else:
+            if length is None:
+                raise ValueError("length is required for an iterable")
+            producer = IterableProducer(data, length)
+
+        self._invalidate(None, dbName, [docId])
+        d = self.put(uri, producer, descr='putAttachment', headers={
+            "Accept": ["application/json"],
+            "Content-Type": [contentType]}, timeout=timeout)
+        d.addBoth(self._invalidate, dbName, [docId])
+        return d.addCallback(self.parseResult)
 
     def addAttachments(self, document, attachments):
         """
@@ -346,7 +1251,8 @@ class CouchDB(object):
             data = b64encode(data)
             document["_attachments"][name] = {"type": "base64", "data": data}
 
-    def saveDoc(self, dbName, body, docId=None):
+    def saveDoc(self, dbName, body, docId=None, attachments=None,
+                timeout=None):
         """
         Save/create a document to/in a given database.
 
@@ -358,6 +1264,17 @@ class CouchDB(object):
 
         @param docId: if specified, the identifier to be used in the database.
         @type docId: C{unicode}
+
+        @param attachments: if specified, attachments to save with the
+            document in a single streamed C{multipart/related} request, as
+            attachment name -> data or (content type, data), where data is a
+            C{str} or a seekable file-like object.  The document needs an id.
+        @type attachments: C{dict}
+
+        @param timeout: if specified, the deadline of the request in seconds,
+            instead of the one of the client.
+        @type timeout: C{int}
+            Calls with a deadline are not batched.
         """
         # Responses: {'rev': '1-9dd776365618752ddfaf79d9079edf84',
         #             'ok': True, 'id': '198abfee8852816bc112992564000295'}
@@ -370,16 +1287,49 @@ class CouchDB(object):
             assert type(docId) is unicode, \
                 'docId is %r instead of unicode' % (type(docId), )
 
+        cacheIds = [docId]
+        if docId is None and isinstance(body, dict):
+            cacheIds = [body.get('_id', None)]
+        self._invalidate(None, dbName, cacheIds)
+
+        if attachments:
+            return self._saveDocMultipart(dbName, body, docId, attachments,
+                timeout)
+
+        if self._writeBatcher is not None and timeout is None:
+            d = self._writeBatcher.saveDoc(dbName, body, docId)
+            return d.addBoth(self._invalidate, dbName, cacheIds)
+
         if not isinstance(body, (str, unicode)):
             body = json.dumps(body)
         if docId is not None:
             d = self.put("/%s/%s" % (dbName, quote(docId.encode('utf-8'))),
-                body, descr='saveDoc')
+                body, descr='saveDoc', timeout=timeout)
         else:
-            d = self.post("/%s/" % (dbName, ), body, descr='saveDoc')
+            d = self.post("/%s/" % (dbName, ), body, descr='saveDoc',
+                timeout=timeout)
+        d.addBoth(self._invalidate, dbName, cacheIds)
         return d.addCallback(self.parseResult)
 
-    def deleteDoc(self, dbName, docId, revision):
+    def _saveDocMultipart(self, dbName, body, docId, attachments, timeout):
+        if isinstance(body, (str, unicode)):
+            body = json.loads(body)
+        if docId is None:
+            docId = body.get('_id', None)
+            if docId is None:
+                raise ValueError(
+                    "saving attachments requires a document id")
+            docId = unicode(docId)
+
+        contentType, producer = multipartRelated(body, attachments)
+        d = self.put("/%s/%s" % (dbName, quote(docId.encode('utf-8'))),
+            producer, descr='saveDoc', headers={
+                "Accept": ["application/json"],
+                "Content-Type": [contentType]}, timeout=timeout)
+        d.addBoth(self._invalidate, dbName, [docId])
+        return d.addCallback(self.parseResult)
+
+    def deleteDoc(self, dbName, docId, revision, timeout=None):
         """
         Delete a document on given database.
 
@@ -392,6 +1342,9 @@ class CouchDB(object):
         @param revision: the revision of the document to delete.
         @type  revision: C{unicode}
 
+        @param timeout: if specified, the deadline of the request in seconds,
+            instead of the one of the client.
+        @type timeout: C{int}
         """
         # Responses: {u'_rev': 1469561101, u'ok': True}
         # 500 Internal Server Error
@@ -405,25 +1358,380 @@ class CouchDB(object):
             'revision is %r instead of unicode' % (type(revision), )
 
 
+        self._invalidate(None, dbName, [docId])
         return self.delete("/%s/%s?%s" % (
                 dbName,
                 quote(docId.encode('utf-8')),
-                urlencode({'rev': revision.encode('utf-8')}))).addCallback(
+                urlencode({'rev': revision.encode('utf-8')})),
+                timeout=timeout).addBoth(
+                    self._invalidate, dbName, [docId]).addCallback(
+                        self.parseResult)
+
+    # Bulk document operations
+
+    def saveDocs(self, dbName, docs, chunkSize=BULK_CHUNK_SIZE,
+                 maxChunkBytes=BULK_CHUNK_BYTES, concurrency=BULK_CONCURRENCY,
+                 timeout=None):
+        """
+        Save/create several documents in a given database using _bulk_docs.
+
+        The documents are sent in chunks of at most C{chunkSize} documents
+        and, unless a single document is bigger, at most C{maxChunkBytes}
+        bytes.  At most C{concurrency} chunks are sent at the same time.
+
+        @param dbName: identifier of the database.
+        @type dbName: C{str}
+
+        @param docs: the documents to save; each document is a C{str} or any
+            structured object, and can contain C{_id} and C{_rev}.
+        @type docs: C{list}
+
+        @param timeout: if specified, the deadline of each chunk's request
+            in seconds, instead of the one of the client.
+        @type timeout: C{int}
+
+        @return: a deferred firing with a list of results, in the order of
+            C{docs}: dicts with C{id} and either C{ok} and C{rev}, or
+            C{error} and C{reason} (for example a C{conflict}).  If a chunk
+            fails, it fails with a L{BulkDocsError} holding the results of
+            the other chunks.
+        @rtype: L{Deferred}
+        """
+        return self._bulkDocs(dbName, docs, chunkSize, maxChunkBytes,
+            concurrency, timeout)
+
+    def deleteDocs(self, dbName, docs, chunkSize=BULK_CHUNK_SIZE,
+                   maxChunkBytes=BULK_CHUNK_BYTES,
+                   concurrency=BULK_CONCURRENCY, timeout=None):
+        """
+        Delete several documents in a given database using _bulk_docs.
+
+        @param dbName: identifier of the database.
+        @type dbName: C{str}
+
+        @param docs: the documents to delete, either as dicts with C{_id} and
+            C{_rev}, or as C{(docId, revision)} tuples.
+        @type docs: C{list}
+
+        The other arguments are as for L{saveDocs}.
+
+        @return: a deferred firing with a list of results, in the order of
+            C{docs}, as for L{saveDocs}.
+        @rtype: L{Deferred}
+        """
+        deletions = []
+        for doc in docs:
+            if isinstance(doc, dict):
+                docId, revision = doc['_id'], doc['_rev']
+            else:
+                docId, revision = doc
+            deletions.append({'_id': unicode(docId), '_rev': unicode(revision),
+                '_deleted': True})
+        return self._bulkDocs(dbName, deletions, chunkSize, maxChunkBytes,
+            concurrency, timeout)
+
+    def openDocs(self, dbName, ids, chunkSize=BULK_CHUNK_SIZE,
+                 concurrency=BULK_CONCURRENCY, bulkGet=None, timeout=None):
+        """
+        Open several documents in a given database with as few requests as
+        possible.
+
+        The ids are requested in chunks of at most C{chunkSize} ids, with at
+        most C{concurrency} chunks requested at the same time.
+
+        @param dbName: identifier of the database.
+        @type dbName: C{str}
+
+        @param ids: the identifiers of the documents.
+        @type ids: C{list} of C{unicode}
+
+        @param bulkGet: if True, use _bulk_get; if False, use _all_docs with
+            a keys body.  By default, _bulk_get is used if the version of the
+            server, as last returned by L{getVersion}, is 2.0 or later.
+        @type bulkGet: C{bool}
+
+        @param timeout: if specified, the deadline of each chunk's request
+            in seconds, instead of the one of the client.
+        @type timeout: C{int}
+
+        @return: a deferred firing with a dict of document id to either the
+            document, L{MISSING} or L{DELETED}.
+        @rtype: L{Deferred}
+        """
+        return self._openDocs(dbName, ids, chunkSize, concurrency, bulkGet,
+            timeout)
+
+    def _openDocs(self, dbName, ids, chunkSize=BULK_CHUNK_SIZE,
+                  concurrency=BULK_CONCURRENCY, bulkGet=None, timeout=None):
+        # not bound by bindToDB, for the read batcher
+        if bulkGet is None:
+            bulkGet = self.version >= (2, 0)
+
+        # FIXME: remove these conversions and have our callers do them
+        unique = []
+        seen = set()
+        for docId in ids:
+            docId = unicode(docId)
+            if docId not in seen:
+                seen.add(docId)
+                unique.append(docId)
+
+        if bulkGet:
+            function = partial(self._openDocsBulkGet, dbName,
+                timeout=timeout)
+        else:
+            function = partial(self._openDocsAllDocs, dbName,
+                timeout=timeout)
+
+        d = self._runChunks(self._chunk(unique, chunkSize), function,
+            concurrency)
+        return d.addCallback(dict)
+
+    def _openDocsAllDocs(self, dbName, ids, timeout=None):
+        # Responses: {'total_rows': 2, 'offset': 0, 'rows': [
+        #   {'id': 'a', 'key': 'a', 'value': {'rev': '1-...'}, 'doc': {...}},
+        #   {'id': 'b', 'key': 'b',
+        #    'value': {'rev': '2-...', 'deleted': True}, 'doc': None},
+        #   {'key': 'c', 'error': 'not_found'}]}
+
+        def extract(result):
+            ret = []
+            for row in result['rows']:
+                if 'error' in row:
+                    ret.append((row['key'], MISSING))
+                elif row['value'].get('deleted', False):
+                    ret.append((row['key'], DELETED))
+                else:
+                    ret.append((row['key'], row['doc']))
+            return ret
+
+        return self.post("/%s/_all_docs?include_docs=true" % (dbName, ),
+            json.dumps({'keys': ids}), descr='openDocs',
+            timeout=timeout).addCallback(
+                self.parseResult).addCallback(extract)
+
+    def _openDocsBulkGet(self, dbName, ids, timeout=None):
+        # Responses: {'results': [
+        #   {'id': 'a', 'docs': [{'ok': {...}}]},
+        #   {'id': 'b', 'docs': [{'error': {'id': 'b', 'rev': 'undefined',
+        #       'error': 'not_found', 'reason': 'deleted'}}]}]}
+
+        def extract(result):
+            ret = []
+            for item in result['results']:
+                doc = item['docs'][0]
+                if 'ok' in doc:
+                    ret.append((item['id'], doc['ok']))
+                elif doc['error'].get('reason') == 'deleted':
+                    ret.append((item['id'], DELETED))
+                else:
+                    ret.append((item['id'], MISSING))
+            return ret
+
+        return self.post("/%s/_bulk_get" % (dbName, ),
+            json.dumps({'docs': [{'id': docId} for docId in ids]}),
+            descr='openDocs', timeout=timeout).addCallback(
+                self.parseResult).addCallback(extract)
+
+    def _bulkDocs(self, dbName, docs, chunkSize, maxChunkBytes, concurrency,
+                  timeout=None):
+        # not bound by bindToDB, so saveDocs and deleteDocs can share it
+        # Responses: [{'ok': True, 'id': 'a', 'rev': '1-...'},
+        #             {'id': 'b', 'error': 'conflict',
+        #              'reason': 'Document update conflict.'}]
+        # CouchDB 1.x does not send 'ok' for successful updates
+        encoded = []
+        for doc in docs:
+            if isinstance(doc, dict):
+                self._invalidate(None, dbName, [doc.get('_id', None)])
+            if not isinstance(doc, (str, unicode)):
+                doc = json.dumps(doc)
+            if isinstance(doc, unicode):
+                doc = doc.encode('utf-8')
+            encoded.append(doc)
+
+        def postChunk(chunk):
+            body = '{"docs": [%s]}' % (','.join(chunk), )
+            return self.post("/%s/_bulk_docs" % (dbName, ), body,
+                descr='bulkDocs', timeout=timeout).addCallback(
                     self.parseResult)
 
+        def normalize((chunkResults, failure)):
+            results = []
+            for chunk, chunkResult in zip(chunks, chunkResults):
+                if chunkResult is None:
+                    results.extend([None] * len(chunk))
+                    continue
+                for result in chunkResult:
+                    if 'error' not in result:
+                        result.setdefault('ok', True)
+                results.extend(chunkResult)
+            self._invalidate(None, dbName,
+                [result.get('id', None) for result in results if result])
+            if failure is not None:
+                raise BulkDocsError(results, failure)
+            return results
+
+        chunks = self._chunk(encoded, chunkSize, maxChunkBytes, len)
+        d = self._runChunksPartially(chunks, postChunk, concurrency)
+        return d.addCallback(normalize)
+
+    def _chunk(self, items, chunkSize, maxChunkBytes=None, size=None):
+        """
+        Split a list of items into lists of at most C{chunkSize} items, and of
+        at most C{maxChunkBytes} as measured by C{size}.
+
+        A single item bigger than C{maxChunkBytes} gets a chunk of its own.
+        """
+        chunks = []
+        chunk = []
+        chunkBytes = 0
+        for item in items:
+            itemBytes = size(item) if size else 0
+            if chunk and (len(chunk) >= chunkSize or (maxChunkBytes and
+                    chunkBytes + itemBytes > maxChunkBytes)):
+                chunks.append(chunk)
+                chunk = []
+                chunkBytes = 0
+            chunk.append(item)
+            chunkBytes += itemBytes
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _runChunks(self, chunks, function, concurrency):
+        """
+        Call C{function} on each chunk, with at most C{concurrency} calls
+        waiting for their result at any time.
+
+        @return: a deferred firing with the concatenation of the lists
+            returned for each chunk, in the order of C{chunks}, or failing
+            with the first failure.
+        """
+
+        def concatenate((results, failure)):
+            if failure is not None:
+                return failure
+            ret = []
+            for result in results:
+                ret.extend(result)
+            return ret
+
+        d = self._runChunksPartially(chunks, function, concurrency)
+        return d.addCallback(concatenate)
+
+    def _runChunksPartially(self, chunks, function, concurrency):
+        """
+        Call C{function} on each chunk, with at most C{concurrency} calls
+        waiting for their result at any time, until a call fails.
+
+        @return: a deferred firing with the list of the results of each
+            chunk, in the order of C{chunks}, with None for the chunks that
+            failed or were not started after a failure, and the first
+            failure or None.
+        """
+        semaphore = DeferredSemaphore(max(1, concurrency))
+        results = [None] * len(chunks)
+        failures = []
+
+        def run(index):
+            if failures:
+                # don't start more chunks after a failure
+                return
+
+            def done(result):
+                results[index] = result
+
+            d = maybeDeferred(function, chunks[index])
+            return d.addCallbacks(done, failures.append)
+
+        d = gatherResults([semaphore.run(run, index)
+            for index in range(len(chunks))])
+        return d.addCallback(lambda _: (results, failures and failures[0]
+            or None))
+
     # View operations
 
     def openView(self, dbName, docId, viewId, **kwargs):
         """
         Open a view of a document in a given database.
+
+        The keyword arguments are the query arguments of the view, except
+        for C{timeout}, which is the deadline of the request in seconds,
+        instead of the one of the client.
         """
         # Responses:
         # 500 Internal Server Error (illegal database name)
+        timeout = kwargs.pop('timeout', None)
+        uri, body = self._viewQuery(dbName, docId, viewId, kwargs)
+
+        def query():
+            # If there's a list of keys to send, POST the
+            # query so that we can upload the keys as the body of
+            # the POST request, otherwise use a GET request
+            if body:
+                return self.post(uri, body=body, descr='openView',
+                    timeout=timeout)
+            else:
+                return self.get(uri, descr='openView', timeout=timeout)
+
+        cache = self._viewCache
+        if cache is None:
+            return query().addCallback(self.parseResult)
+
+        key = cache.key(dbName, docId, viewId, kwargs, body)
+
+        def cachedQuery(seq):
+            result = cache.get(key, seq)
+            if result is not None:
+                return result
 
-        def buildUri(dbName=dbName, docId=docId, viewId=viewId, kwargs=kwargs):
-            return "/%s/_design/%s/_view/%s?%s" % (
-                dbName, quote(docId), viewId, urlencode(kwargs))
+            def store(result):
+                cache.set(key, seq, result)
+                return result
+            return query().addCallback(store)
 
+        seq = cache.getSeq(dbName)
+        if seq is not None:
+            d = succeed(seq)
+        else:
+            # not self.infoDB, which bindToDB may have replaced
+            d = self.get("/%s/" % (dbName, ), descr='openView',
+                timeout=timeout).addCallback(
+                self.parseResult).addCallback(lambda info: info['update_seq'])
+        return d.addCallback(cachedQuery).addCallback(self.parseResult)
+
+    def streamView(self, dbName, docId, viewId, rowCallback, **kwargs):
+        """
+        Open a view of a document in a given database, calling
+        C{rowCallback} with each row as it arrives instead of keeping the
+        whole result in memory.
+
+        @param rowCallback: called with each row.  If it raises, the request
+            is aborted and the returned deferred fails.
+        @type rowCallback: callable
+
+        The other arguments are as for L{openView}, except that without a
+        C{timeout}, streaming the view has no deadline.
+
+        @return: a deferred firing with a dict of the members of the result
+            other than rows, such as C{total_rows} and C{offset}.
+        @rtype: L{Deferred}
+        """
+        timeout = kwargs.pop('timeout', None)
+        uri, body = self._viewQuery(dbName, docId, viewId, kwargs)
+        receiver = partial(RowReceiver, rowCallback=rowCallback)
+        if body:
+            return self.post(uri, body=body, descr='streamView',
+                receiver=receiver, timeout=timeout)
+        else:
+            return self.get(uri, descr='streamView', receiver=receiver,
+                timeout=timeout)
+
+    def _viewQuery(self, dbName, docId, viewId, kwargs):
+        """
+        Return the uri and, if keys are given, the body to query a view.
+        """
         # if there is a "keys" argument, remove it from the kwargs
         # dictionary now so that it doesn't get double JSON-encoded
         body = None
@@ -433,25 +1741,14 @@ class CouchDB(object):
         # encode the rest of the values with JSON for use as query
         # arguments in the URI
         for k, v in kwargs.iteritems():
-            if k == 'keys': # we do this below, for the full body
-                pass
-            else:
-                kwargs[k] = json.dumps(v)
+            kwargs[k] = json.dumps(v)
         # we keep the paisley API, but couchdb uses limit now
         if 'count' in kwargs:
             kwargs['limit'] = kwargs.pop('count')
 
-        # If there's a list of keys to send, POST the
-        # query so that we can upload the keys as the body of
-        # the POST request, otherwise use a GET request
-        if body:
-            return self.post(
-                buildUri(), body=body, descr='openView').addCallback(
-                    self.parseResult)
-        else:
-            return self.get(
-                buildUri(), descr='openView').addCallback(
-                    self.parseResult)
+        uri = "/%s/_design/%s/_view/%s?%s" % (
+            dbName, quote(docId), viewId, urlencode(kwargs))
+        return uri, body
 
     def addViews(self, document, views):
         """
@@ -479,25 +1776,243 @@ class CouchDB(object):
     # Basic http methods
 
     def _getPage(self, uri, method="GET", postdata=None, headers=None,
-            isJson=True):
+            isJson=True, receiver=None, timeout=None, retry=None):
         """
         C{getPage}-like.
+
+        Cancelling the returned deferred aborts the request, unless it is
+        shared with other coalesced callers still waiting for it.
+
+        @param receiver: if specified, called with a deferred to create the
+            protocol that receives the body of a successful response; the
+            deferred is returned.
+        @param timeout: if specified, the deadline of this request in
+            seconds, instead of the one of the client.  Requests with a
+            receiver or a streamed body only have this deadline.
+        @param retry: if specified, the L{paisley.retry.RetryPolicy} of this
+            request instead of the one of the client, or False to not retry
+            it.  Requests with a receiver or a streamed body are never
+            retried, since they cannot be replayed.
+        """
+        uurl = unicode(self.url_template % (uri, ))
+        url = uurl.encode('utf-8')
+
+        if not headers:
+            headers = {}
+
+        if isJson:
+            headers["Accept"] = ["application/json"]
+            headers["Content-Type"] = ["application/json"]
+
+        if self.username:
+            headers["Authorization"] = ["Basic %s" % b64encode(
+                "%s:%s" % (self.username, self.password))]
+
+        conditional = self._etags is not None and method == "GET" and \
+            isJson and receiver is None
+        cached = None
+        if conditional:
+            cached = self._etags.get(url)
+            if cached is not None:
+                headers["If-None-Match"] = [cached.etag]
+
+        request = self._request
+        if retry is None:
+            retry = self.retryPolicy
+        if retry and receiver is None and \
+                not IBodyProducer.providedBy(postdata):
+            request = partial(self._retrying, retry)
+
+        if self.coalesce and method == "GET" and receiver is None:
+            key = (url, tuple(sorted(
+                (name, tuple(values)) for name, values in headers.items())))
+            d = self._coalesced(key, request, method, url, headers,
+                postdata, receiver, conditional, cached, isJson)
+        else:
+            d = request(method, url, headers, postdata, receiver,
+                conditional, cached, isJson)
+
+        if timeout is None and receiver is None and \
+                not IBodyProducer.providedBy(postdata):
+            timeout = self.timeout
+        if timeout is not None:
+            self._setDeadline(d, timeout, method, url)
+        return d
+
+    def _retrying(self, policy, method, url, *args):
+        """
+        Send a request with L{_request}, and send it again after a delay
+        each time it fails in a way the retry policy allows.
+
+        Cancelling the returned deferred cancels the current attempt, or
+        the pending retry.
+        """
+        attempts = [0]
+        # the deferred of the current attempt, or the call of the next one
+        current = [None]
+
+        def cancel(d):
+            current[0].cancel()
+
+        result = Deferred(cancel)
+
+        def send():
+            current[0] = self._request(method, url, *args)
+            current[0].addCallbacks(result.callback, failed)
+
+        def failed(failure):
+            if not policy.shouldRetry(method, failure):
+                result.errback(failure)
+            elif policy.maxRetries is not None and \
+                    attempts[0] >= policy.maxRetries:
+                self._count('retriesExhausted')
+                result.errback(failure)
+            else:
+                delay = policy.delay(attempts[0])
+                attempts[0] += 1
+                self._count('retries')
+                self.log.debug("[%s:%s%s] retrying %s in %.3f seconds: %s",
+                    self.host, self.port, short_print(url), method, delay,
+                    failure.getErrorMessage())
+                current[0] = self.clock.callLater(delay, send)
+
+        send()
+        return result
+
+    def _setDeadline(self, d, timeout, method, url):
+        """
+        Cancel C{d} if it has not fired after C{timeout} seconds, making it
+        fail with L{RequestTimeout}.
+        """
+        expired = []
+
+        def expire():
+            expired.append(True)
+            self._count('timeouts')
+            d.cancel()
+
+        call = self.clock.callLater(timeout, expire)
+
+        def done(result):
+            if call.active():
+                call.cancel()
+            if expired and isinstance(result, Failure) and \
+                    result.check(CancelledError):
+                raise RequestTimeout("%s %s took more than %s seconds" % (
+                    method, url, timeout))
+            return result
+        d.addBoth(done)
+
+    def _coalesced(self, key, function, *args):
+        """
+        Call C{function}, unless a call with the same key is still waiting
+        for its result, in which case wait for that result instead.
+
+        Results are response bodies, which are immutable, so each caller
+        still parses its own copy.  Each caller can cancel its deferred;
+        the call is only cancelled once all of them did.
+        """
+        entry = self._inFlight.get(key, None)
+        if entry is None:
+            # the deferred of the call, and the deferreds of the callers
+            entry = self._inFlight[key] = [None, []]
+        else:
+            self._count('coalesced')
+        waiting = entry[1]
+
+        def cancel(d):
+            waiting.remove(d)
+            if not waiting:
+                entry[0].cancel()
+
+        d = Deferred(cancel)
+        waiting.append(d)
+        if entry[0] is not None:
+            return d
+
+        def fanOut(result):
+            if self._inFlight.get(key, None) is entry:
+                del self._inFlight[key]
+            for d in waiting[:]:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+        entry[0] = function(*args).addBoth(fanOut)
+        return d
+
+    def _request(self, method, url, headers, postdata, receiver,
+                 conditional=False, cached=None, isJson=True):
+        """
+        Send a request and return a deferred firing with the response body.
+
+        @param conditional: whether to remember the response with its ETag.
+        @param cached:      the remembered response this request revalidates.
+        @type  cached:      L{CachedBody}
+        @param isJson:      whether the body is parsed as JSON, in which case
+                            a JSON body is returned undecoded.
         """
 
         def cb_recv_resp(response):
-            d_resp_recvd = Deferred()
+
+            def abort(d):
+                # drop the connection, and with it the body received so far
+                counter.original.transport.stopProducing()
+
+            # receivers fire d_body, which still happens after an abort
+            d_body = Deferred()
+            d_resp_recvd = Deferred(abort)
+
+            def forward(result):
+                if not d_resp_recvd.called:
+                    if isinstance(result, Failure):
+                        d_resp_recvd.errback(result)
+                    else:
+                        d_resp_recvd.callback(result)
+            d_body.addBoth(forward)
+
+            if receiver is not None and response.code < 300:
+                counter = ByteCounter(receiver(d_body))
+                response.deliverBody(counter)
+                return d_resp_recvd.addBoth(cb_count, response, counter)
+
             content_type = response.headers.getRawHeaders('Content-Type',
                     [''])[0].lower().strip()
-            decode_utf8 = 'charset=utf-8' in content_type or \
-                    content_type == 'application/json'
-            response.deliverBody(ResponseReceiver(d_resp_recvd,
+            # JSON to be parsed is kept as the bytes received and decoded by
+            # json.loads directly, which avoids a unicode copy of the body
+            decode_utf8 = 'charset=utf-8' in content_type and not (isJson and
+                    content_type.split(';')[0].strip() == 'application/json')
+            counter = ByteCounter(ResponseReceiver(d_body,
                 decode_utf8=decode_utf8))
+            response.deliverBody(counter)
+            d_resp_recvd.addBoth(cb_count, response, counter)
             return d_resp_recvd.addCallback(cb_process_resp, response)
 
+        def cb_count(result, response, counter):
+            wire = getattr(response, 'wireCounter', None) or counter
+            self._count('bytesReceived', counter.length)
+            self._count('bytesReceivedWire', wire.length)
+            self.log.debug("[%s:%s%s] %s received %d bytes (%d on the wire)",
+                self.host, self.port, short_print(url), method,
+                counter.length, wire.length)
+            return result
+
         def cb_process_resp(body, response):
             # twisted.web.error imports reactor
             from twisted.web import error as tw_error
 
+            if response.code == 304 and cached is not None:
+                self._count('notModified')
+                return cached
+
+            etags = self._etags
+            if conditional and etags is not None and response.code == 200:
+                etag = response.headers.getRawHeaders('ETag', [None])[0]
+                if etag:
+                    etags.set(url, CachedBody(body, etag))
+                elif cached is not None:
+                    etags.delete(url)
+
             # Emulate HTTPClientFactory and raise t.w.e.Error
             # and PageRedirect if we have errors.
             if response.code > 299 and response.code < 400:
@@ -507,58 +2022,86 @@ class CouchDB(object):
 
             return body
 
-        uurl = unicode(self.url_template % (uri, ))
-        url = uurl.encode('utf-8')
-
-        if not headers:
-            headers = {}
-
-        if isJson:
-            headers["Accept"] = ["application/json"]
-            headers["Content-Type"] = ["application/json"]
-
-        if self.username:
-            headers["Authorization"] = ["Basic %s" % b64encode(
-                "%s:%s" % (self.username, self.password))]
-
-        body = StringProducer(postdata) if postdata else None
+        body = None
+        if IBodyProducer.providedBy(postdata):
+            # streamed as is
+            if postdata.length is not UNKNOWN_LENGTH:
+                self._count('bytesSent', postdata.length)
+                self._count('bytesSentWire', postdata.length)
+            body = postdata
+        elif postdata:
+            self._count('bytesSent', len(postdata))
+            if self.compression and len(postdata) >= self.compressThreshold:
+                from paisley.compress import gzip
+                if isinstance(postdata, unicode):
+                    postdata = postdata.encode('utf-8')
+                postdata = gzip(postdata)
+                headers = dict(headers)
+                headers["Content-Encoding"] = ["gzip"]
+            self._count('bytesSentWire', len(postdata))
+            body = StringProducer(postdata)
+
+        def eb_cancelled(failure):
+            # _newclient imports reactor
+            from twisted.web._newclient import ResponseNeverReceived
+
+            # the Agent reports the cancellation of a request not answered
+            # yet in its own ways
+            if failure.check(ConnectingCancelledError):
+                return Failure(CancelledError())
+            if failure.check(ResponseNeverReceived) and \
+                    failure.value.reasons[0].check(CancelledError):
+                return failure.value.reasons[0]
+            return failure
 
         d = self.client.request(method, url, Headers(headers), body)
 
-        d.addCallback(cb_recv_resp)
+        d.addCallbacks(cb_recv_resp, eb_cancelled)
 
         return d
 
-    def get(self, uri, descr='', isJson=True):
+    def get(self, uri, descr='', isJson=True, receiver=None, timeout=None,
+            retry=None):
         """
         Execute a C{GET} at C{uri}.
         """
         self.log.debug("[%s:%s%s] GET %s",
                        self.host, self.port, short_print(uri), descr)
-        return self._getPage(uri, method="GET", isJson=isJson)
+        return self._getPage(uri, method="GET", isJson=isJson,
+            receiver=receiver, timeout=timeout, retry=retry)
 
-    def post(self, uri, body, descr=''):
+    def post(self, uri, body, descr='', receiver=None, timeout=None,
+             retry=None):
         """
         Execute a C{POST} of C{body} at C{uri}.
         """
         self.log.debug("[%s:%s%s] POST %s: %s",
                       self.host, self.port, short_print(uri), descr,
                       short_print(repr(body)))
-        return self._getPage(uri, method="POST", postdata=body)
+        return self._getPage(uri, method="POST", postdata=body,
+            receiver=receiver, timeout=timeout, retry=retry)
 
-    def put(self, uri, body, descr=''):
+    def put(self, uri, body, descr='', headers=None, timeout=None,
+            retry=None):
         """
         Execute a C{PUT} of C{body} at C{uri}.
+
+        @param body: a string, or an L{IBodyProducer} to stream.
+        @param headers: if specified, the headers to send instead of JSON
+            content headers.
         """
         self.log.debug("[%s:%s%s] PUT %s: %s",
                        self.host, self.port, short_print(uri), descr,
                        short_print(repr(body)))
-        return self._getPage(uri, method="PUT", postdata=body)
+        return self._getPage(uri, method="PUT", postdata=body,
+            headers=headers, isJson=headers is None, timeout=timeout,
+            retry=retry)
 
-    def delete(self, uri, descr=''):
+    def delete(self, uri, descr='', timeout=None, retry=None):
         """
         Execute a C{DELETE} at C{uri}.
         """
         self.log.debug("[%s:%s%s] DELETE %s",
                        self.host, self.port, short_print(uri), descr)
-        return self._getPage(uri, method="DELETE")
+        return self._getPage(uri, method="DELETE", timeout=timeout,
+            retry=retry)
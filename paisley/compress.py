@@ -0,0 +1,53 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_client -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Compression of HTTP bodies.
+"""
+
+import zlib
+
+from twisted.python.components import proxyForInterface
+from twisted.web.iweb import IResponse
+# t.w.c imports reactor, so only import this module from code that runs
+# after the reactor has been chosen
+from twisted.web.client import GzipDecoder
+
+from paisley.client import ByteCounter
+
+
+def gzip(data, level=6):
+    """
+    Return C{data} compressed in the gzip format.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _CountingResponse(proxyForInterface(IResponse)):
+
+    def __init__(self, original, decoder):
+        self.original = original
+        self._decoder = decoder
+
+    def deliverBody(self, protocol):
+        self._decoder.wireCounter = ByteCounter(protocol)
+        self.original.deliverBody(self._decoder.wireCounter)
+
+
+class CountingGzipDecoder(GzipDecoder):
+    """
+    I decode a gzip'ed response body, counting the bytes received on the
+    wire.
+
+    @ivar wireCounter: the L{ByteCounter} for the body before decoding,
+                       once it is being delivered.
+    """
+
+    wireCounter = None
+
+    def __init__(self, response):
+        GzipDecoder.__init__(self, _CountingResponse(response, self))
@@ -19,14 +19,142 @@ instead of
   u"abc"
 when using the C implementation, but not the python implementation.
 
-If json is not installed, this falls back to simplejson, which is
-also not strict and will return str instead of unicode.
+The C scanner only returns str for text when given a str, so strict
+loads decodes str input to unicode first instead of falling back to the
+much slower python scanner, which is only used without the C extension.
 
-In that case, STRICT will be set to True.
+Other JSON libraries can be plugged in with register_codec or
+register_module.  At import, the codec with the highest priority that
+supports strict loads is used; json and simplejson are registered by
+default, simplejson being preferred when it has its C extension.
+If no codec supports strict loads, STRICT will be set to False.
 """
 
 STRICT = True
 
+# the name of the codec in use
+CODEC = None
+
+# name -> _Codec
+_codecs = {}
+# name of the codec chosen with use_codec, if any
+_chosen = None
+
+
+class _Codec(object):
+
+    def __init__(self, name, loads, dumps, priority, strictLoads):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.priority = priority
+        # a loads returning unicode for all text, or None
+        self.strictLoads = strictLoads
+
+
+def _is_strict(loads):
+    try:
+        result = loads('{"key": ["str"]}')
+        key = result.keys()[0]
+        return type(key) is unicode and type(result[key][0]) is unicode
+    except Exception:
+        return False
+
+
+def _unicode_wrapper(loads):
+
+    def unicode_loads(s, *args, **kwargs):
+        if isinstance(s, str):
+            s = s.decode(kwargs.pop('encoding', None) or 'utf-8')
+        return loads(s, *args, **kwargs)
+    return unicode_loads
+
+
+def register_codec(name, loads, dumps, priority=0, strictLoads=None):
+    """
+    Register a JSON codec, which can be selected with L{use_codec}.
+
+    The loads and dumps functions must accept and produce the same JSON as
+    the stdlib ones.  Codecs with a higher priority are preferred, so it
+    should reflect their speed.
+
+    @param strictLoads: a loads function always returning unicode for text.
+        By default, loads is used if it does, or else loads given input
+        decoded to unicode if that does.
+    """
+    if strictLoads is None:
+        if _is_strict(loads):
+            strictLoads = loads
+        else:
+            strictLoads = _unicode_wrapper(loads)
+            if not _is_strict(strictLoads):
+                strictLoads = None
+    _codecs[name] = _Codec(name, loads, dumps, priority, strictLoads)
+
+
+def register_module(name, priority=0):
+    """
+    Register a module providing loads and dumps functions as a JSON codec
+    named after it, if it can be imported.
+
+    @return: whether the module was registered.
+    @rtype:  C{bool}
+    """
+    try:
+        module = __import__(name, {}, {}, ['loads', 'dumps'])
+    except ImportError:
+        return False
+    register_codec(name, module.loads, module.dumps, priority)
+    return True
+
+
+def available_codecs(strict=None):
+    """
+    Return the names of the registered codecs, preferred first.
+
+    @param strict: if True, only return codecs supporting strict loads; by
+        default, the current strictness.
+    """
+    if strict is None:
+        strict = STRICT
+    codecs = [c for c in _codecs.values()
+        if not strict or c.strictLoads is not None]
+    codecs.sort(key=lambda c: (-c.priority, c.name))
+    return [c.name for c in codecs]
+
+
+def use_codec(name=None):
+    """
+    Use the given codec, or the preferred one meeting the strictness
+    requirement if name is None.
+
+    If no codec supports strict loads, STRICT will be set to False.
+    """
+    global _chosen
+    _chosen = name
+    _select(STRICT)
+
+
+def _select(strict):
+    global loads, dumps, CODEC, STRICT
+
+    if _chosen is not None:
+        codec = _codecs[_chosen]
+        if strict and codec.strictLoads is None:
+            raise ValueError("codec %s does not support strict loads" % (
+                _chosen, ))
+    else:
+        names = available_codecs(strict) or available_codecs(False)
+        codec = _codecs[names[0]]
+
+    STRICT = strict and codec.strictLoads is not None
+    if STRICT:
+        loads = codec.strictLoads
+    else:
+        loads = codec.loads
+    dumps = codec.dumps
+    CODEC = codec.name
+
 
 def set_strict(strict=True):
     """
@@ -35,28 +163,11 @@ def set_strict(strict=True):
 
     Recommended to use only at startup.
     """
-    global loads
-    loads = _get_loads(strict)
-    global STRICT
-    STRICT = strict
+    _select(strict)
 
 
-def _get_loads(strict=STRICT):
-    if not strict:
-        try:
-            from simplejson import loads
-        except ImportError:
-            from json import loads
-        return loads
-
-    # If we don't have json, we can only fall back to simplejson, non-strict
-    try:
-        from json import decoder
-    except ImportError:
-        global STRICT
-        STRICT = False
-        from simplejson import loads
-        return loads
+def _stdlib_strict_loads():
+    from json import decoder
     try:
         res = decoder.c_scanstring('"str"', 1)
     except TypeError:
@@ -67,8 +178,32 @@ def _get_loads(strict=STRICT):
         from json import loads
         return loads
 
-    import json as _myjson
     from json import scanner
+    if decoder.c_scanstring is not None and \
+            scanner.c_make_scanner is not None:
+        return _unicode_loads
+
+    return _make_py_loads()
+
+
+def _unicode_loads(s, *args, **kwargs):
+    """
+    Strict loads using the C scanner, which returns unicode for text when
+    given unicode.
+    """
+    import json as _myjson
+
+    if isinstance(s, str):
+        s = s.decode(kwargs.pop('encoding', None) or 'utf-8')
+    return _myjson.loads(s, *args, **kwargs)
+
+
+def _make_py_loads():
+    """
+    Return a strict loads using the python scanner.
+    """
+    import json as _myjson
+    from json import decoder, scanner
 
     class MyJSONDecoder(_myjson.JSONDecoder):
 
@@ -87,23 +222,98 @@ def _get_loads(strict=STRICT):
     return loads
 
 
-def _get_dumps(strict=STRICT):
-    if not strict:
-        try:
-            from simplejson import dumps
-        except ImportError:
-            from json import dumps
-        return dumps
+def loads_in_slices(s):
+    """
+    loads decoding the members of a top-level object, and the items of
+    top-level arrays and of arrays in a top-level object, one at a time.
+
+    The C scanner holds the GIL for the whole of each call, so a thread
+    decoding a big view result with loads blocks all other threads until
+    it is done, while one using this function lets them run between rows.
+
+    Only the stdlib json codec can decode slices; with any other codec in
+    use, this is loads.
+    """
+    if CODEC != 'json':
+        return loads(s)
+
+    import json as _myjson
+    import re
+
+    if STRICT and isinstance(s, str):
+        s = s.decode('utf-8')
+    decoder = _myjson.JSONDecoder()
+    decode = decoder.raw_decode
+    space = re.compile(r'\s*')
+    skip = lambda idx: space.match(s, idx).end()
 
+    def expect(char, idx):
+        if s[idx:idx + 1] != char:
+            raise ValueError("Expecting %r at char %d" % (char, idx))
+        return skip(idx + 1)
+
+    def array(idx):
+        # idx is after [
+        ret = []
+        idx = skip(idx)
+        if s[idx:idx + 1] == ']':
+            return ret, idx + 1
+        while True:
+            value, idx = decode(s, idx)
+            ret.append(value)
+            idx = skip(idx)
+            if s[idx:idx + 1] == ']':
+                return ret, idx + 1
+            idx = expect(',', idx)
+
+    def value(idx):
+        if s[idx:idx + 1] == '[':
+            return array(idx + 1)
+        return decode(s, idx)
+
+    idx = skip(0)
+    if s[idx:idx + 1] == '{':
+        result = {}
+        idx = skip(idx + 1)
+        if s[idx:idx + 1] != '}':
+            while True:
+                key, idx = decode(s, idx)
+                if not isinstance(key, basestring):
+                    raise ValueError("Expecting property name at char %d" % (
+                        idx, ))
+                idx = expect(':', skip(idx))
+                result[key], idx = value(idx)
+                idx = skip(idx)
+                if s[idx:idx + 1] == '}':
+                    break
+                idx = expect(',', idx)
+        idx += 1
+    elif s[idx:idx + 1] == '[':
+        result, idx = array(idx + 1)
+    else:
+        result, idx = decode(s, idx)
+
+    if skip(idx) != len(s):
+        raise ValueError("Extra data at char %d" % (idx, ))
+    return result
+
+
+def _register_defaults():
+    try:
+        import json
+    except ImportError:
+        pass
+    else:
+        register_codec('json', json.loads, json.dumps,
+            strictLoads=_stdlib_strict_loads())
 
+    # simplejson is only faster than json with its C extension
     try:
-        from json import dumps
-        return dumps
+        from simplejson import _speedups
     except ImportError:
-        global STRICT
-        STRICT = False
-        from simplejson import dumps
-        return dumps
+        register_module('simplejson', priority=-10)
+    else:
+        register_module('simplejson', priority=10)
 
-dumps = _get_dumps()
-loads = _get_loads()
+_register_defaults()
+_select(STRICT)
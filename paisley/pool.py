@@ -0,0 +1,79 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_client -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Persistent HTTP connection pool.
+"""
+
+# t.w.c imports reactor, so only import this module from code that runs
+# after the reactor has been chosen
+from twisted.web.client import HTTPConnectionPool
+
+
+class ConnectionPool(HTTPConnectionPool):
+    """
+    I keep HTTP connections alive between requests, and count how often
+    cached connections get reused.
+
+    I can be shared by several L{paisley.client.CouchDB} instances.
+
+    @ivar hits:      number of requests sent over a cached connection
+    @ivar misses:    number of requests that needed a new connection
+    @ivar evictions: number of cached connections closed by the pool, either
+                     because they were idle for longer than
+                     C{cachedConnectionTimeout} or because the host already
+                     had C{maxPersistentPerHost} cached connections
+    """
+
+    def __init__(self, reactor, maxPersistentPerHost=2,
+                 cachedConnectionTimeout=240):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = maxPersistentPerHost
+        self.cachedConnectionTimeout = cachedConnectionTimeout
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getConnection(self, key, endpoint):
+        # _newConnection is called synchronously when nothing usable is
+        # cached, so if it did not count a miss we got a cached connection
+        misses = self.misses
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.misses == misses:
+            self.hits += 1
+        return d
+
+    def getStats(self):
+        """
+        Return a dictionary of pool statistics.
+
+        @rtype: C{dict} of C{str} -> C{int}
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'cached': sum(len(c) for c in self._connections.values()),
+        }
+
+    # FIXME: the following override private methods of HTTPConnectionPool,
+    # which is the only place where connections get created and dropped
+
+    def _newConnection(self, key, endpoint):
+        self.misses += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def _removeConnection(self, key, connection):
+        # idle timeout expired
+        self.evictions += 1
+        return HTTPConnectionPool._removeConnection(self, key, connection)
+
+    def _putConnection(self, key, connection):
+        if len(self._connections.get(key, [])) >= self.maxPersistentPerHost:
+            # the base class drops the oldest cached connection
+            self.evictions += 1
+        return HTTPConnectionPool._putConnection(self, key, connection)
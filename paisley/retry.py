@@ -0,0 +1,105 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_retry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Retrying of requests that failed because of transient errors.
+"""
+
+import random
+
+from paisley import pjson as json
+
+
+def backoff(attempt, initialDelay=0.1, maxDelay=10, factor=2, jitter=1.0,
+            random=random.random):
+    """
+    Return the number of seconds to wait before the given retry attempt.
+
+    The delay grows exponentially from C{initialDelay} up to C{maxDelay},
+    and is then reduced by a random part of up to C{jitter} times itself,
+    so that clients failing together do not retry together.
+
+    @param attempt: the number of retries made so far.
+    @type  attempt: C{int}
+    """
+    delay = min(maxDelay, initialDelay * factor ** attempt)
+    return delay * (1 - jitter * random())
+
+
+class RetryPolicy(object):
+    """
+    I decide which failed requests get retried, and when.
+
+    By default, only requests with idempotent methods are retried: a C{PUT}
+    always names the document or database it writes.  A C{PUT} whose first
+    attempt was applied before the connection failed can still fail on
+    retry with a conflict.
+
+    @ivar maxRetries: number of retries after the first attempt, or None
+                      to retry for as long as it takes.
+    @ivar methods:    the HTTP methods of the requests to retry.
+    @ivar statuses:   the HTTP status codes of the responses to retry.
+    @ivar serverTimeouts: whether to retry 500 responses for a CouchDB
+                          C{timeout} error.
+    """
+
+    def __init__(self, maxRetries=3, initialDelay=0.1, maxDelay=10,
+                 factor=2, jitter=1.0, methods=('GET', 'HEAD', 'PUT'),
+                 statuses=(502, 503), serverTimeouts=True,
+                 random=random.random):
+        self.maxRetries = maxRetries
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.jitter = jitter
+        self.methods = frozenset(methods)
+        self.statuses = frozenset(statuses)
+        self.serverTimeouts = serverTimeouts
+        self._random = random
+
+    def delay(self, attempt):
+        """
+        Return the number of seconds to wait before the given retry attempt.
+        """
+        return backoff(attempt, self.initialDelay, self.maxDelay,
+            self.factor, self.jitter, self._random)
+
+    def shouldRetry(self, method, failure):
+        """
+        Return whether a request failing with the given failure should be
+        retried, if attempts are left.
+
+        Connection failures are retried, as well as responses with one of
+        the C{statuses}, and CouchDB timeouts if C{serverTimeouts} is set.
+
+        @type failure: L{twisted.python.failure.Failure}
+        """
+        # twisted.web.error and _newclient import reactor
+        from twisted.internet import error
+        from twisted.web import error as tw_error
+        from twisted.web._newclient import RequestTransmissionFailed
+        from twisted.web._newclient import ResponseFailed
+        from twisted.web._newclient import ResponseNeverReceived
+
+        if method not in self.methods:
+            return False
+
+        if failure.check(tw_error.Error):
+            status = int(failure.value.status)
+            if status in self.statuses:
+                return True
+            if status == 500 and self.serverTimeouts:
+                try:
+                    body = json.loads(failure.value.message)
+                except ValueError:
+                    return False
+                return isinstance(body, dict) and \
+                    body.get('error') == 'timeout'
+            return False
+
+        return failure.check(error.ConnectError, error.ConnectionLost,
+            RequestTransmissionFailed, ResponseFailed,
+            ResponseNeverReceived) is not None
@@ -0,0 +1,169 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_batch -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for batching of document requests.
+"""
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error
+
+from paisley import pjson as json
+
+from paisley.test.test_client import RecordingCouchDB
+
+
+class WriteBatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = RecordingCouchDB("localhost")
+        self.batcher = self.client.enableWriteBatching(window=0.5,
+            maxDocs=3, clock=self.clock)
+
+    def _posted(self, index):
+        uri, kwargs, _ = self.client.calls[index]
+        self.assertEquals(uri, "/mydb/_bulk_docs")
+        return json.loads(kwargs["postdata"])["docs"]
+
+    def _respond(self, index, result):
+        self.client.calls[index][2].callback(json.dumps(result))
+
+    def test_window(self):
+        d1 = self.client.saveDoc("mydb", {"a": 1})
+        d2 = self.client.saveDoc("mydb", '{"b": 2}', docId="b")
+        self.assertEquals(self.client.calls, [])
+        self.clock.advance(0.5)
+        self.assertEquals(self._posted(0), [{"a": 1}, {"_id": "b", "b": 2}])
+
+        self._respond(0, [{"id": "x", "rev": "1-x"},
+            {"id": "b", "error": "conflict", "reason": "conflict"}])
+        d1.addCallback(self.assertEquals,
+            {"id": "x", "rev": "1-x", "ok": True})
+        self.assertFailure(d2, error.Error)
+        d2.addCallback(lambda e: self.assertEquals(int(e.status), 409))
+        return d1.addCallback(lambda _: d2)
+
+    def test_maxDocs(self):
+        self.client.bindToDB("mydb")
+        for i in range(4):
+            self.client.saveDoc({"i": i})
+        self.assertEquals(len(self.client.calls), 1)
+        self.assertEquals(len(self._posted(0)), 3)
+        self.clock.advance(0.5)
+        self.assertEquals(len(self._posted(1)), 1)
+        self.assertEquals(self.batcher.flushes, 2)
+
+    def test_maxBytes(self):
+        self.batcher.maxBytes = 20
+        self.client.saveDoc("mydb", {"a": "x" * 20})
+        self.assertEquals(len(self.client.calls), 1)
+
+    def test_sameDocumentKeepsOrder(self):
+        self.client.saveDoc("mydb", {"_id": "a", "v": 1})
+        self.client.saveDoc("mydb", {"_id": "a", "v": 2})
+        self.assertEquals(len(self.client.calls), 1)
+        self.assertEquals(self._posted(0), [{"_id": "a", "v": 1}])
+
+        # the second save waits for the first one to be answered
+        self.clock.advance(0.5)
+        self.assertEquals(len(self.client.calls), 1)
+        self._respond(0, [{"id": "a", "rev": "1-a"}])
+        self.assertEquals(self._posted(1), [{"_id": "a", "v": 2}])
+        self._respond(1, [{"id": "a", "rev": "2-a"}])
+        self.assertEquals(self.batcher._inFlight, {})
+
+    def test_otherDocumentsNotDelayed(self):
+        self.client.saveDoc("mydb", {"_id": "a"})
+        self.batcher.flush("mydb")
+        self.client.saveDoc("mydb", {"_id": "b"})
+        self.client.saveDoc("mydb", {})
+        self.batcher.flush("mydb")
+        self.assertEquals(len(self.client.calls), 2)
+
+    def test_callerDocumentUnchanged(self):
+        doc = {"a": 1}
+        self.client.saveDoc("mydb", doc, docId="a")
+        self.assertEquals(doc, {"a": 1})
+
+    def test_requestFailure(self):
+        d = self.client.saveDoc("mydb", {"a": 1})
+        self.clock.advance(0.5)
+        self.client.calls[0][2].errback(error.Error(404, "not found"))
+        return self.assertFailure(d, error.Error)
+
+    def test_disable(self):
+        self.client.saveDoc("mydb", {"a": 1})
+        self.client.disableWriteBatching()
+        self.assertEquals(len(self.client.calls), 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.client.saveDoc("mydb", {"a": 1})
+        self.assertEquals(self.client.calls[1][0], "/mydb/")
+
+
+class ReadBatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = RecordingCouchDB("localhost")
+        self.batcher = self.client.enableReadBatching(clock=self.clock)
+
+    def test_batched(self):
+        d1 = self.client.openDoc("mydb", "a")
+        d2 = self.client.openDoc("mydb", "b")
+        d3 = self.client.openDoc("mydb", "a")
+        d4 = self.client.openDoc("mydb", "c")
+        self.assertEquals(self.client.calls, [])
+        self.clock.advance(0)
+
+        self.assertEquals(len(self.client.calls), 1)
+        uri, kwargs, d = self.client.calls[0]
+        self.assertEquals(uri, "/mydb/_all_docs?include_docs=true")
+        self.assertEquals(sorted(json.loads(kwargs["postdata"])["keys"]),
+            ["a", "b", "c"])
+        d.callback(json.dumps({"rows": [
+            {"id": "a", "key": "a", "value": {"rev": "1-a"},
+             "doc": {"_id": "a", "_rev": "1-a"}},
+            {"id": "b", "key": "b", "value": {"rev": "2-b", "deleted": True},
+             "doc": None},
+            {"key": "c", "error": "not_found"}]}))
+
+        results = []
+        d1.addCallback(results.append)
+        d3.addCallback(results.append)
+        self.assertEquals(results, [{"_id": "a", "_rev": "1-a"}] * 2)
+        self.failIf(results[0] is results[1])
+
+        def checkNotFound(failure, reason):
+            failure.trap(error.Error)
+            self.assertEquals(int(failure.value.status), 404)
+            self.assertEquals(json.loads(failure.value.message)["reason"],
+                reason)
+        d2.addErrback(checkNotFound, "deleted")
+        d4.addErrback(checkNotFound, "missing")
+        return defer.gatherResults([d2, d4])
+
+    def test_notBatched(self):
+        self.client.openDoc("mydb", "a", revision="1-a")
+        self.client.openDoc("mydb", "a", attachment="file")
+        self.assertEquals(len(self.client.calls), 2)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_localNotBatched(self):
+        d = self.client.openDoc("mydb", "_local/ckpt")
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        uri, kwargs, request = self.client.calls[0]
+        self.assertEquals(uri, "/mydb/_local/ckpt")
+        request.callback('{"_id": "_local/ckpt", "seq": 3}')
+        return d.addCallback(self.assertEquals,
+            {"_id": "_local/ckpt", "seq": 3})
+
+    def test_failure(self):
+        d = self.client.openDoc("mydb", "a")
+        self.clock.advance(0)
+        self.client.calls[0][2].errback(error.Error(500, "oops"))
+        return self.assertFailure(d, error.Error)
@@ -0,0 +1,278 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for the caches.
+"""
+
+from twisted.internet import error, task
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+
+from paisley import cache, changes, retry
+
+from paisley.test.test_changes import FakeDB
+from paisley.test.test_client import RequestRecordingCouchDB
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_getSet(self):
+        c = cache.LRUCache()
+        self.assertEquals(c.get('a'), None)
+        c.set('a', 'value')
+        self.assertEquals(c.get('a'), 'value')
+        self.failUnless('a' in c)
+        self.assertEquals(c.getStats(), {'hits': 1, 'misses': 1,
+            'evictions': 0, 'expirations': 0, 'entries': 1, 'bytes': 5})
+
+    def test_maxEntries(self):
+        c = cache.LRUCache(maxEntries=2)
+        c.set('a', 'a')
+        c.set('b', 'b')
+        c.get('a')
+        c.set('c', 'c')
+        # b was the least recently used
+        self.failIf('b' in c)
+        self.failUnless('a' in c)
+        self.failUnless('c' in c)
+        self.assertEquals(c.evictions, 1)
+
+    def test_maxBytes(self):
+        c = cache.LRUCache(maxBytes=10)
+        c.set('a', 'x' * 4)
+        c.set('b', 'x' * 4)
+        c.set('c', 'x' * 4)
+        self.assertEquals(len(c), 2)
+        self.assertEquals(c.getStats()['bytes'], 8)
+        c.set('d', 'x', size=20)
+        self.assertEquals(len(c), 0)
+        self.assertEquals(c.evictions, 4)
+
+    def test_replace(self):
+        c = cache.LRUCache()
+        c.set('a', 'xxx')
+        c.set('a', 'x')
+        self.assertEquals(c.getStats()['bytes'], 1)
+
+    def test_ttl(self):
+        clock = task.Clock()
+        c = cache.LRUCache(ttl=10, clock=clock.seconds)
+        c.set('a', 'a')
+        clock.advance(5)
+        self.assertEquals(c.get('a'), 'a')
+        clock.advance(5)
+        self.assertEquals(c.get('a'), None)
+        self.assertEquals(c.expirations, 1)
+        self.assertEquals(c.getStats()['bytes'], 0)
+
+    def test_delete(self):
+        c = cache.LRUCache()
+        c.set('a', 'a')
+        c.delete('a')
+        c.delete('b')
+        self.assertEquals(len(c), 0)
+
+    def test_deletedWhileFetching(self):
+        c = cache.LRUCache()
+        a = c.fetching('a')
+        b = c.fetching('b')
+        c.delete('a')
+        self.failIf(c.fetched('a', a))
+        self.failUnless(c.fetched('b', b))
+
+        # only fetches overlapping the deletion are affected
+        first = c.fetching('a')
+        c.delete('a')
+        second = c.fetching('a')
+        self.failIf(c.fetched('a', first))
+        self.failUnless(c.fetched('a', second))
+        self.assertEquals(c._fetching, {})
+
+    def test_clearedWhileFetching(self):
+        c = cache.LRUCache()
+        a = c.fetching('a')
+        c.clear()
+        self.failIf(c.fetched('a', a))
+
+    def test_deleteMany(self):
+        c = cache.LRUCache()
+        c.set('a', 'a')
+        c.set('b', 'bb')
+        c.set('c', 'c')
+        c.deleteMany(['a', 'b', 'd'])
+        self.assertEquals(c.keys(), ['c'])
+        self.assertEquals(c.getStats()['bytes'], 1)
+
+    def test_changeNotifier(self):
+        c = cache.LRUCache()
+        c.set('a', 'a')
+        notifier = changes.ChangeNotifier(None, 'mydb')
+        notifier.addCache(c)
+        notifier.changed({'id': 'a', 'seq': 2, 'changes': []})
+        self.failIf('a' in c)
+
+    def test_changeNotifierBatch(self):
+        c = cache.LRUCache()
+        c.set('a', 'a')
+        c.set('b', 'b')
+        notifier = changes.ChangeNotifier(None, 'mydb', batchWindow=0)
+        notifier.addCache(c)
+        notifier.changedBatch([{'id': 'a', 'seq': 2, 'changes': []},
+                               {'id': 'b', 'seq': 3, 'changes': []}])
+        self.assertEquals(len(c), 0)
+
+
+class DocCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.client = RequestRecordingCouchDB("localhost")
+        self.cache = cache.LRUCache()
+        self.client.setDocCache("mydb", self.cache)
+
+    def test_readThrough(self):
+        d = self.client.openDoc("mydb", "a")
+        self.client.requests[0][3].callback('{"_id": "a"}')
+        d.addCallback(self.assertEquals, {"_id": "a"})
+
+        d = self.client.openDoc("mydb", "a")
+        self.assertEquals(len(self.client.requests), 1)
+        d.addCallback(self.assertEquals, {"_id": "a"})
+        self.assertEquals(self.cache.hits, 1)
+
+    def test_notCached(self):
+        self.client.openDoc("mydb", "a", revision="1-a")
+        self.client.requests[0][3].callback('{"_id": "a"}')
+        self.client.openDoc("otherdb", "a")
+        self.client.requests[1][3].callback('{"_id": "a"}')
+        self.assertEquals(len(self.cache), 0)
+
+    def test_invalidatedByWrites(self):
+        self.cache.set(u"a", '{}')
+        self.cache.set(u"b", '{}')
+        self.cache.set(u"c", '{}')
+        self.client.saveDoc("mydb", {"_id": "a"})
+        self.client.deleteDoc("mydb", "b", "1-b")
+        self.client.saveDocs("mydb", [{"_id": "c"}])
+        self.assertEquals(len(self.cache), 0)
+
+    def test_changedWhileFetching(self):
+        d = self.client.openDoc("mydb", "a")
+        self.cache.delete("a")
+        self.client.requests[0][3].callback('{"_id": "a"}')
+        self.assertEquals(len(self.cache), 0)
+        return d
+
+    def test_otherChangedWhileFetching(self):
+        d = self.client.openDoc("mydb", "a")
+        self.cache.delete("b")
+        self.client.requests[0][3].callback('{"_id": "a"}')
+        self.failUnless("a" in self.cache)
+        return d
+
+    def test_failedFetch(self):
+        from twisted.web import error as tw_error
+        d = self.client.openDoc("mydb", "a")
+        self.client.requests[0][3].errback(tw_error.Error(404, ""))
+        self.assertEquals(self.cache._fetching, {})
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_readBatching(self):
+        clock = task.Clock()
+        self.client.enableReadBatching(clock=clock)
+        self.client.openDoc("mydb", "a")
+        clock.advance(0)
+        self.client.requests[0][3].callback(
+            '{"rows": [{"id": "a", "key": "a", "value": {"rev": "1-a"}, '
+            '"doc": {"_id": "a"}}]}')
+        self.assertEquals(self.cache.get("a"), '{"_id": "a"}')
+
+
+class ViewCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.client = RequestRecordingCouchDB("localhost")
+        self.cache = cache.ViewCache()
+        self.client.setViewCache(self.cache)
+
+    def _respond(self, index, body):
+        self.client.requests[index][3].callback(body)
+
+    def _openView(self, seq, **kwargs):
+        count = len(self.client.requests)
+        d = self.client.openView("mydb", "design", "view", **kwargs)
+        self.assertEquals(self.client.requests[count][1],
+            "http://localhost:5984/mydb/")
+        self._respond(count, '{"update_seq": %d}' % seq)
+        return d
+
+    def test_key(self):
+        self.assertEquals(
+            self.cache.key("db", "d", "v", {"b": "1", "a": "2"}),
+            self.cache.key("db", "d", "v", {"a": "2", "b": "1"}))
+        self.failIfEquals(
+            self.cache.key("db", "d", "v", {}, '{"keys": [1]}'),
+            self.cache.key("db", "d", "v", {}, '{"keys": [2]}'))
+
+    def test_reusedUntilSeqMoves(self):
+        d = self._openView(5, limit=2)
+        self._respond(1, '{"rows": []}')
+        d.addCallback(self.assertEquals, {"rows": []})
+
+        d = self._openView(5, limit=2)
+        self.assertEquals(len(self.client.requests), 3)
+        d.addCallback(self.assertEquals, {"rows": []})
+
+        # another query is not cached
+        self._openView(5, limit=3)
+        self.assertEquals(len(self.client.requests), 5)
+
+        # nor is the first one once the database changed
+        self._openView(6, limit=2)
+        self.assertEquals(len(self.client.requests), 7)
+
+    def test_listener(self):
+        listener = self.cache.listenerFor("mydb")
+        notifier = changes.ChangeNotifier(None, "mydb")
+        notifier.addListener(listener)
+        notifier.changed({"id": "a", "seq": 7, "changes": []})
+
+        self.client.openView("mydb", "design", "view")
+        self._respond(0, '{"rows": []}')
+        self.client.openView("mydb", "design", "view")
+        self.assertEquals(len(self.client.requests), 1)
+        self.assertEquals(len(self.cache.entries), 1)
+
+        notifier.changed({"id": "a", "seq": 8, "changes": []})
+        self.assertEquals(len(self.cache.entries), 0)
+        listener.changedBatch([{"id": "b", "seq": 9, "changes": []},
+                               {"id": "c", "seq": 10, "changes": []}])
+        self.assertEquals(self.cache.getSeq("mydb"), 10)
+        self.client.openView("mydb", "design", "view")
+        self.assertEquals(len(self.client.requests), 2)
+
+        # without a feed, fall back to the database info
+        listener.connectionLost(None)
+        self._openView(8)
+
+    def test_listenerReconnecting(self):
+        clock = task.Clock()
+        listener = self.cache.listenerFor("mydb")
+        notifier = changes.ChangeNotifier(FakeDB(), "mydb", clock=clock,
+            reconnect=retry.RetryPolicy(jitter=0))
+        notifier.addListener(listener)
+        notifier.start()
+        protocol = notifier._db.client.respond()
+        notifier.changed({"id": "a", "seq": 11, "changes": []})
+        self.assertEquals(self.cache.getSeq("mydb"), 11)
+
+        # changes made while disconnected would go unnoticed
+        protocol.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(self.cache.getSeq("mydb"), None)
+        clock.advance(1)
+        notifier._db.client.respond()
+        notifier.changed({"id": "a", "seq": 12, "changes": []})
+        self.assertEquals(self.cache.getSeq("mydb"), 12)
@@ -6,10 +6,12 @@
 
 import os
 
-from twisted.internet import defer, reactor, error
+from twisted.internet import defer, reactor, error, task
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
 from twisted.trial import unittest
 
-from paisley import client, changes
+from paisley import client, changes, retry
 
 from paisley.test import util
 
@@ -23,6 +25,67 @@ class FakeNotifier(object):
         self.changes.append(change)
 
 
+class FakeResponse(object):
+
+    def __init__(self):
+        self.protocol = None
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(proto_helpers.StringTransport())
+
+
+class FakeAgent(object):
+    """
+    @ivar requests: list of (method, url, headers, body, deferred)
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append((method, url, headers, bodyProducer, d))
+        return d
+
+    def respond(self, index=-1):
+        """
+        Answer a request, and return the protocol receiving its body.
+        """
+        response = FakeResponse()
+        self.requests[index][4].callback(response)
+        return response.protocol
+
+
+class FakeDB(object):
+    url_template = "http://localhost:5984%s"
+
+    def __init__(self, update_seq=10):
+        self.client = FakeAgent()
+        self.update_seq = update_seq
+
+    def infoDB(self, dbName):
+        return defer.succeed({'update_seq': self.update_seq})
+
+
+class RecordingListener(changes.ChangeListener):
+
+    def __init__(self):
+        self.events = []
+
+    def changed(self, change):
+        self.events.append(('changed', change['id']))
+
+    def connectionLost(self, reason):
+        self.events.append(('connectionLost', reason.type))
+
+    def reconnecting(self, reason, delay):
+        self.events.append(('reconnecting', delay))
+
+    def resumed(self, since):
+        self.events.append(('resumed', since))
+
+
 class TestStubChangeReceiver(unittest.TestCase):
 
     def testChanges(self):
@@ -362,3 +425,292 @@ class ConnectionLostTestCase(BaseTestCase, changes.ChangeListener):
         self.expect_tearing = True
         self.wrapper.process.terminate()
         return self.waitForNextCycle()
+
+
+class ReconnectingNotifierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = FakeDB()
+        self.listener = RecordingListener()
+        self.notifier = self._notifier(retry.RetryPolicy(maxRetries=2,
+            initialDelay=1, jitter=0))
+
+    def _notifier(self, policy, **kwargs):
+        notifier = changes.ChangeNotifier(self.db, 'test', reconnect=policy,
+            clock=self.clock, **kwargs)
+        notifier.addListener(self.listener)
+        notifier.start()
+        return notifier
+
+    def _lose(self, protocol):
+        protocol.connectionLost(Failure(error.ConnectionLost()))
+
+    def test_resume(self):
+        protocol = self.db.client.respond()
+        protocol.dataReceived('{"seq": 11, "id": "a", "changes": []}\n')
+        self._lose(protocol)
+        self.failIf(self.notifier.isRunning())
+        self.assertEquals(self.listener.events,
+            [('changed', 'a'), ('reconnecting', 1)])
+
+        self.clock.advance(1)
+        self.assertEquals(len(self.db.client.requests), 2)
+        self.failUnless('since=11' in self.db.client.requests[1][1])
+        self.db.client.respond()
+        self.failUnless(self.notifier.isRunning())
+        self.assertEquals(self.listener.events[-1], ('resumed', 11))
+        self.assertEquals(self.notifier.reconnects, 1)
+
+    def test_backoff(self):
+        self._lose(self.db.client.respond())
+        self.clock.advance(1)
+        self.db.client.requests[1][4].errback(error.ConnectionRefusedError())
+        self.assertEquals(self.listener.events[-1], ('reconnecting', 2))
+        self.clock.advance(2)
+        protocol = self.db.client.respond()
+        self.assertEquals(self.listener.events[-1], ('resumed', 10))
+
+        # attempts in a row start again after a successful connection
+        self._lose(protocol)
+        self.assertEquals(self.listener.events[-1], ('reconnecting', 1))
+
+    def test_rateCap(self):
+        self.notifier.stop()
+        notifier = self._notifier(retry.RetryPolicy(initialDelay=0.1,
+            jitter=0), minReconnectInterval=5)
+        self.clock.advance(2)
+        self._lose(self.db.client.respond())
+        self.assertEquals(self.listener.events[-1], ('reconnecting', 3))
+        notifier.stop()
+
+    def test_giveUp(self):
+        self._lose(self.db.client.respond())
+        self.clock.advance(1)
+        self.db.client.requests[1][4].errback(error.ConnectionRefusedError())
+        self.clock.advance(2)
+        self.db.client.requests[2][4].errback(error.ConnectionRefusedError())
+        self.assertEquals(self.listener.events[-1],
+            ('connectionLost', error.ConnectionRefusedError))
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_stopWhileWaiting(self):
+        self._lose(self.db.client.respond())
+        self.notifier.stop()
+        self.assertEquals(self.listener.events[-1],
+            ('connectionLost', error.ConnectionDone))
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_stopped(self):
+        protocol = self.db.client.respond()
+        self.notifier.stop()
+        protocol.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(self.listener.events,
+            [('connectionLost', error.ConnectionDone)])
+
+    def test_notByDefault(self):
+        notifier = changes.ChangeNotifier(self.db, 'test', clock=self.clock)
+        notifier.addListener(self.listener)
+        notifier.start()
+        self._lose(self.db.client.respond())
+        self.assertEquals(self.listener.events,
+            [('connectionLost', error.ConnectionLost)])
+
+
+class HeartbeatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = FakeDB()
+        self.listener = RecordingListener()
+
+    def _notifier(self, **kwargs):
+        notifier = changes.ChangeNotifier(self.db, 'test', clock=self.clock,
+            heartbeat=10, **kwargs)
+        notifier.addListener(self.listener)
+        notifier.start()
+        return notifier
+
+    def test_requested(self):
+        self._notifier()
+        self.failUnless('heartbeat=10000' in self.db.client.requests[0][1])
+
+    def test_alive(self):
+        notifier = self._notifier()
+        protocol = self.db.client.respond()
+        for i in range(10):
+            self.clock.advance(10)
+            protocol.dataReceived('\n')
+        self.assertEquals(notifier.lastActivity, 100)
+        self.assertEquals(notifier.stallCount, 0)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.assertEquals(self.listener.events, [])
+
+    def test_stalled(self):
+        notifier = self._notifier()
+        protocol = self.db.client.respond()
+        self.clock.advance(20)
+        protocol.dataReceived('\n')
+        self.clock.advance(29)
+        self.assertEquals(notifier.stallCount, 0)
+        self.clock.advance(1)
+        self.assertEquals(notifier.stallCount, 1)
+        self.assertEquals(protocol.transport.producerState, 'stopped')
+
+        protocol.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(self.listener.events,
+            [('connectionLost', changes.FeedStalled)])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_reconnect(self):
+        notifier = self._notifier(reconnect=retry.RetryPolicy(
+            initialDelay=1, jitter=0), minReconnectInterval=0)
+        protocol = self.db.client.respond()
+        self.clock.advance(30)
+        protocol.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(self.listener.events, [('reconnecting', 1)])
+        self.clock.advance(1)
+        self.db.client.respond()
+        self.assertEquals(self.listener.events[-1], ('resumed', 10))
+        self.assertEquals(notifier.lastActivity, 31)
+        # the new connection is watched too
+        self.clock.advance(30)
+        self.assertEquals(notifier.stallCount, 2)
+
+    def test_stop(self):
+        notifier = self._notifier()
+        self.db.client.respond()
+        notifier.stop()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+class BatchingListener(RecordingListener):
+
+    def changedBatch(self, changes):
+        self.events.append(('changedBatch',
+            [change['id'] for change in changes]))
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = FakeDB()
+        self.listener = BatchingListener()
+
+    def _notifier(self, **kwargs):
+        notifier = changes.ChangeNotifier(self.db, 'test', clock=self.clock,
+            **kwargs)
+        notifier.addListener(self.listener)
+        notifier.start()
+        return notifier
+
+    def _lines(self, *seqs):
+        return ''.join([client.json.dumps({'seq': seq, 'id': 'doc%d' % seq,
+            'changes': []}) + '\n' for seq in seqs])
+
+    def test_perChunk(self):
+        notifier = self._notifier(batchWindow=0)
+        protocol = self.db.client.respond()
+        protocol.dataReceived(self._lines(11, 12) + self._lines(13)[:5])
+        protocol.dataReceived(self._lines(13)[5:])
+        protocol.dataReceived('\n')
+        self.assertEquals(self.listener.events, [
+            ('changedBatch', ['doc11', 'doc12']),
+            ('changedBatch', ['doc13'])])
+        self.assertEquals(notifier._since, 13)
+
+    def test_window(self):
+        notifier = self._notifier(batchWindow=1)
+        protocol = self.db.client.respond()
+        protocol.dataReceived(self._lines(11))
+        self.clock.advance(0.5)
+        protocol.dataReceived(self._lines(12))
+        self.assertEquals(self.listener.events, [])
+        self.clock.advance(0.5)
+        self.assertEquals(self.listener.events, [
+            ('changedBatch', ['doc11', 'doc12'])])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_flushedOnConnectionLost(self):
+        self._notifier(batchWindow=1)
+        protocol = self.db.client.respond()
+        protocol.dataReceived(self._lines(11))
+        protocol.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(self.listener.events, [
+            ('changedBatch', ['doc11']),
+            ('connectionLost', error.ConnectionDone)])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_unbatchedListener(self):
+        listener = RecordingListener()
+        notifier = self._notifier(batchWindow=0)
+        notifier.addListener(listener)
+        protocol = self.db.client.respond()
+        protocol.dataReceived(self._lines(11, 12))
+        self.assertEquals(listener.events, [
+            ('changed', 'doc11'), ('changed', 'doc12')])
+
+
+class FilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDB()
+        self.listener = RecordingListener()
+        self.notifier = changes.ChangeNotifier(self.db, 'test',
+            clock=task.Clock())
+        self.notifier.addListener(self.listener)
+
+    def _body(self, index=-1):
+        return client.json.loads(self.db.client.requests[index][3].body)
+
+    def test_docIds(self):
+        self.notifier.start(doc_ids=['a', 'b'])
+        method, url, headers, body, d = self.db.client.requests[0]
+        self.assertEquals(method, 'POST')
+        self.failUnless('filter=_doc_ids' in url)
+        self.assertEquals(headers.getRawHeaders('Content-Type'),
+            ['application/json'])
+        self.assertEquals(self._body(), {'doc_ids': ['a', 'b']})
+
+    def test_selector(self):
+        self.notifier.start(selector={'type': 'post'})
+        self.failUnless('filter=_selector' in self.db.client.requests[0][1])
+        self.assertEquals(self._body(), {'selector': {'type': 'post'}})
+
+    def test_docIdsAndSelector(self):
+        self.assertRaises(AssertionError, self.notifier.start,
+            doc_ids=['a'], selector={'type': 'post'})
+        self.assertRaises(AssertionError, self.notifier.setFilter,
+            doc_ids=['a'], selector={'type': 'post'})
+
+    def test_namedFilter(self):
+        self.notifier.start(filter='design/byType', type='post')
+        method, url = self.db.client.requests[0][:2]
+        self.assertEquals(method, 'GET')
+        self.failUnless('filter=design%2FbyType' in url)
+        self.failUnless('type=post' in url)
+
+    def test_setFilter(self):
+        self.notifier.start(doc_ids=['a'])
+        protocol = self.db.client.respond()
+        protocol.dataReceived(client.json.dumps(
+            {'seq': 12, 'id': 'a', 'changes': []}) + '\n')
+
+        d = self.notifier.setFilter(doc_ids=['a', 'b'])
+        self.assertEquals(protocol.transport.producerState, 'stopped')
+        protocol.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(len(self.db.client.requests), 2)
+        self.failUnless('since=12' in self.db.client.requests[1][1])
+        self.assertEquals(self._body(), {'doc_ids': ['a', 'b']})
+        self.failIf(d.called)
+
+        self.db.client.respond()
+        self.assertEquals(self.listener.events, [('changed', 'a')])
+        self.failUnless(self.notifier.isRunning())
+        return d.addCallback(self.assertEquals, 12)
+
+    def test_setFilterNotConnected(self):
+        d = self.notifier.setFilter(selector={'type': 'post'})
+        self.assertEquals(self.db.client.requests, [])
+        return d.addCallback(self.assertEquals, None)
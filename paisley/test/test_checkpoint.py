@@ -0,0 +1,198 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_checkpoint -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for change feed checkpoints.
+"""
+
+import os
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import changes, checkpoint
+from paisley.client import json
+
+from paisley.test.test_changes import FakeDB, RecordingListener
+from paisley.test.test_client import RequestRecordingCouchDB
+
+
+class MemoryCheckpointStore(object):
+    """
+    I store checkpoints in memory, and can fail saves or hold them until
+    they are released.
+    """
+
+    def __init__(self, seq=None):
+        self.seq = seq
+        self.saved = []
+        self.hold = False
+        self.pending = []
+        self.failures = 0
+
+    def load(self):
+        return defer.succeed(self.seq)
+
+    def save(self, seq):
+        self.saved.append(seq)
+        if self.failures:
+            self.failures -= 1
+            return defer.fail(IOError("disk full"))
+        self.seq = seq
+        if self.hold:
+            d = defer.Deferred()
+            self.pending.append(d)
+            return d
+        return defer.succeed(None)
+
+
+class FileCheckpointStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.store = checkpoint.FileCheckpointStore(self.path)
+
+    def test_missing(self):
+        d = self.store.load()
+        return d.addCallback(self.assertEquals, None)
+
+    def test_roundTrip(self):
+        self.store.save(5)
+        self.store.save(u'12-g1AAAA')
+        self.failIf(os.path.exists(self.path + '.tmp'))
+        d = checkpoint.FileCheckpointStore(self.path).load()
+        return d.addCallback(self.assertEquals, u'12-g1AAAA')
+
+
+class LocalDocCheckpointStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.client = RequestRecordingCouchDB("localhost")
+        self.store = checkpoint.LocalDocCheckpointStore(self.client,
+            "mydb", "indexer")
+
+    def test_loadMissing(self):
+        d = self.store.load()
+        self.assertEquals(self.client.requests[0][1],
+            "http://localhost:5984/mydb/_local/indexer")
+        self.client.requests[0][3].errback(
+            tw_error.Error(404, '{"error": "not_found"}'))
+        return d.addCallback(self.assertEquals, None)
+
+    def test_batchingBypassed(self):
+        self.client.enableReadBatching()
+        self.client.enableWriteBatching()
+        self.store.load()
+        self.store.save(7)
+        self.assertEquals([request[:2] for request in self.client.requests], [
+            ("GET", "http://localhost:5984/mydb/_local/indexer"),
+            ("PUT", "http://localhost:5984/mydb/_local/indexer")])
+
+    def test_saveAfterLoad(self):
+        d = self.store.load()
+        self.client.requests[0][3].callback(
+            '{"_id": "_local/indexer", "_rev": "0-1", "seq": 3}')
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda _: self.store.save(7))
+        self.assertEquals(self.client.requests[1][0], "PUT")
+        self.client.requests[1][3].callback('{"ok": true, "rev": "0-2"}')
+        d.addCallback(lambda _: self.assertEquals(self.store._rev, "0-2"))
+        return d
+
+    def test_saveConflict(self):
+        d = self.store.save(7)
+        self.client.requests[0][3].errback(
+            tw_error.Error(409, '{"error": "conflict"}'))
+        self.assertEquals(self.client.requests[1][0], "GET")
+        self.client.requests[1][3].callback(
+            '{"_id": "_local/indexer", "_rev": "0-5", "seq": 4}')
+        self.assertEquals(self.client.requests[2][0], "PUT")
+        self.client.requests[2][3].callback('{"ok": true, "rev": "0-6"}')
+        d.addCallback(lambda _: self.assertEquals(self.store._rev, "0-6"))
+        return d
+
+
+class CheckpointingNotifierTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = FakeDB()
+        self.listener = RecordingListener()
+
+    def _notifier(self, store, **kwargs):
+        notifier = changes.ChangeNotifier(self.db, 'test', clock=self.clock,
+            checkpointStore=store, **kwargs)
+        notifier.addListener(self.listener)
+        notifier.start()
+        return notifier
+
+    def _change(self, protocol, seq):
+        protocol.dataReceived(json.dumps(
+            {'seq': seq, 'id': 'doc%d' % seq, 'changes': []}) + '\n')
+
+    def test_resume(self):
+        self._notifier(MemoryCheckpointStore(4))
+        self.failUnless('since=4' in self.db.client.requests[0][1])
+
+    def test_noCheckpoint(self):
+        self._notifier(MemoryCheckpointStore())
+        self.failUnless('since=10' in self.db.client.requests[0][1])
+
+    def test_interval(self):
+        store = MemoryCheckpointStore()
+        self._notifier(store)
+        protocol = self.db.client.respond()
+        self._change(protocol, 11)
+        self._change(protocol, 12)
+        self.assertEquals(store.saved, [])
+        self.clock.advance(10)
+        self.assertEquals(store.saved, [12])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_changes(self):
+        store = MemoryCheckpointStore()
+        notifier = self._notifier(store, checkpointChanges=2)
+        protocol = self.db.client.respond()
+        for seq in range(11, 16):
+            self._change(protocol, seq)
+        self.assertEquals(store.saved, [12, 14])
+        self.assertEquals(notifier.checkpoints, 2)
+
+    def test_serialized(self):
+        store = MemoryCheckpointStore()
+        store.hold = True
+        notifier = self._notifier(store, checkpointChanges=1)
+        protocol = self.db.client.respond()
+        self._change(protocol, 11)
+        self._change(protocol, 12)
+        self._change(protocol, 13)
+        self.assertEquals(store.saved, [11])
+        store.pending.pop(0).callback(None)
+        self.assertEquals(store.saved, [11, 13])
+
+    def test_stop(self):
+        store = MemoryCheckpointStore()
+        notifier = self._notifier(store)
+        protocol = self.db.client.respond()
+        self._change(protocol, 11)
+        d = notifier.stop()
+        self.assertEquals(store.saved, [11])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return d
+
+    def test_failed(self):
+        store = MemoryCheckpointStore()
+        store.failures = 1
+        notifier = self._notifier(store)
+        protocol = self.db.client.respond()
+        self._change(protocol, 11)
+        d = notifier.checkpoint()
+        self.assertFailure(d, IOError)
+        d.addCallback(lambda _: notifier.stop())
+        d.addCallback(lambda _: self.assertEquals(store.saved, [11, 11]))
+        d.addCallback(lambda _: self.assertEquals(store.seq, 11))
+        return d
@@ -54,6 +54,46 @@ class TestableCouchDB(client.CouchDB):
         return self.deferred
 
 
+class RecordingCouchDB(client.CouchDB):
+    """
+    A couchdb client that records every getPage call, for methods issuing
+    several requests.
+
+    @ivar calls: list of (uri, kwargs, deferred) for each call.
+    """
+
+    def __init__(self, *args, **kwargs):
+        client.CouchDB.__init__(self, *args, **kwargs)
+        self.calls = []
+
+    def _getPage(self, uri, *args, **kwargs):
+        d = Deferred()
+        self.calls.append((uri, kwargs, d))
+        return d
+
+
+class RequestRecordingCouchDB(client.CouchDB):
+    """
+    A couchdb client that records the HTTP requests it would send.
+
+    Its requests have no deadline unless one is given, since tests usually
+    leave them pending.
+
+    @ivar requests: list of (method, url, headers, deferred) for each request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('timeout', None)
+        client.CouchDB.__init__(self, *args, **kwargs)
+        self.requests = []
+
+    def _request(self, method, url, headers, postdata, receiver,
+                 conditional=False, cached=None, isJson=True):
+        d = Deferred()
+        self.requests.append((method, url, headers, d))
+        return d
+
+
 class CouchDBTestCase(TestCase):
     """
     Test methods against a couchDB.
@@ -390,6 +430,322 @@ class CouchDBTestCase(TestCase):
         version = self.client._parseVersion('1.1.1a1162549')
         self.assertEquals(version, (1, 1, 1))
 
+    def test_streamView(self):
+        """
+        streamView queries like openView, with a row receiver.
+        """
+        self.client.streamView("mydb", "viewdoc", "myview", lambda row: None,
+            keys=[1, 2], limit=5)
+        self.assertEquals(self.client.uri,
+            "/mydb/_design/viewdoc/_view/myview?limit=5")
+        self.assertEquals(self.client.kwargs["method"], "POST")
+        self.assertEquals(self.client.kwargs["postdata"], '{"keys": [1, 2]}')
+        self.failUnless(self.client.kwargs["receiver"])
+
+    def test_streamDocs(self):
+        self.client.streamDocs("mydb", lambda row: None, include_docs=True)
+        self.assertEquals(self.client.uri,
+            "/mydb/_all_docs?include_docs=True")
+        self.assertEquals(self.client.kwargs["method"], "GET")
+        self.failUnless(self.client.kwargs["receiver"])
+
+
+class BulkCouchDBTestCase(TestCase):
+    """
+    Test bulk document methods.
+    """
+
+    def setUp(self):
+        self.client = RecordingCouchDB("localhost")
+
+    def _posted(self, index):
+        uri, kwargs, _ = self.client.calls[index]
+        self.assertEquals(uri, "/mydb/_bulk_docs")
+        self.assertEquals(kwargs["method"], "POST")
+        return json.loads(kwargs["postdata"])["docs"]
+
+    def _respond(self, index, result):
+        self.client.calls[index][2].callback(json.dumps(result))
+
+    def test_saveDocsChunked(self):
+        docs = [{"_id": unicode(i)} for i in range(5)]
+        d = self.client.saveDocs("mydb", docs, chunkSize=2)
+        self.assertEquals(len(self.client.calls), 3)
+        self.assertEquals(self._posted(0), docs[:2])
+        self.assertEquals(self._posted(2), docs[4:])
+
+        # answer out of order, results should still be in input order
+        self._respond(2, [{"id": "4", "rev": "1-d"}])
+        self._respond(0, [{"id": "0", "rev": "1-a"},
+            {"id": "1", "error": "conflict", "reason": "conflict"}])
+        self._respond(1, [{"id": "2", "rev": "1-b", "ok": True},
+            {"id": "3", "rev": "1-c"}])
+
+        def cb(results):
+            self.assertEquals([r["id"] for r in results],
+                ["0", "1", "2", "3", "4"])
+            self.assertEquals(results[0], {"id": "0", "rev": "1-a",
+                "ok": True})
+            self.assertEquals(results[1]["error"], "conflict")
+            self.failIf("ok" in results[1])
+        return d.addCallback(cb)
+
+    def test_saveDocsChunkBytes(self):
+        docs = ['{"a": "%s"}' % ("x" * 10, )] * 4
+        self.client.saveDocs("mydb", docs, maxChunkBytes=40)
+        self.assertEquals(len(self.client.calls), 2)
+        self.assertEquals(len(self._posted(0)), 2)
+
+    def test_saveDocsConcurrency(self):
+        docs = [{"_id": unicode(i)} for i in range(3)]
+        d = self.client.saveDocs("mydb", docs, chunkSize=1, concurrency=1)
+        self.assertEquals(len(self.client.calls), 1)
+        self._respond(0, [{"id": "0", "rev": "1-a"}])
+        self.assertEquals(len(self.client.calls), 2)
+        self._respond(1, [{"id": "1", "rev": "1-a"}])
+        self._respond(2, [{"id": "2", "rev": "1-a"}])
+        return d.addCallback(lambda r: self.assertEquals(len(r), 3))
+
+    def test_saveDocsFailure(self):
+        from twisted.web import error
+        d = self.client.saveDocs("mydb", [{}, {}], chunkSize=1)
+        self.client.calls[1][2].errback(error.Error(404, "not found"))
+        self._respond(0, [{"id": "0", "rev": "1-a"}])
+        self.assertFailure(d, client.BulkDocsError)
+
+        def check(e):
+            self.assertEquals(e.results,
+                [{"id": "0", "rev": "1-a", "ok": True}, None])
+            self.failUnless(e.failure.check(error.Error))
+        return d.addCallback(check)
+
+    def test_saveDocsFailureStops(self):
+        from twisted.web import error
+        docs = [{"_id": unicode(i)} for i in range(3)]
+        d = self.client.saveDocs("mydb", docs, chunkSize=1, concurrency=1)
+        self.client.calls[0][2].errback(error.Error(503, "unavailable"))
+        # the other chunks are not sent
+        self.assertEquals(len(self.client.calls), 1)
+        self.assertFailure(d, client.BulkDocsError)
+        return d.addCallback(lambda e: self.assertEquals(e.results,
+            [None, None, None]))
+
+    def test_saveDocsEmpty(self):
+        d = self.client.saveDocs("mydb", [])
+        self.assertEquals(self.client.calls, [])
+        return d.addCallback(self.assertEquals, [])
+
+    def test_deleteDocs(self):
+        self.client.bindToDB("mydb")
+        self.client.deleteDocs([{"_id": "a", "_rev": "1-a"}, ("b", "2-b")])
+        self.assertEquals(self._posted(0), [
+            {"_id": "a", "_rev": "1-a", "_deleted": True},
+            {"_id": "b", "_rev": "2-b", "_deleted": True}])
+
+    def test_openDocsAllDocs(self):
+        d = self.client.openDocs("mydb", ["a", "b", "c", "a"])
+        self.assertEquals(len(self.client.calls), 1)
+        uri, kwargs, _ = self.client.calls[0]
+        self.assertEquals(uri, "/mydb/_all_docs?include_docs=true")
+        self.assertEquals(kwargs["method"], "POST")
+        self.assertEquals(json.loads(kwargs["postdata"]),
+            {"keys": ["a", "b", "c"]})
+        self._respond(0, {"total_rows": 2, "offset": 0, "rows": [
+            {"id": "a", "key": "a", "value": {"rev": "1-a"},
+             "doc": {"_id": "a", "_rev": "1-a"}},
+            {"id": "b", "key": "b", "value": {"rev": "2-b", "deleted": True},
+             "doc": None},
+            {"key": "c", "error": "not_found"}]})
+
+        def cb(result):
+            self.assertEquals(result, {"a": {"_id": "a", "_rev": "1-a"},
+                "b": client.DELETED, "c": client.MISSING})
+        return d.addCallback(cb)
+
+    def test_openDocsChunked(self):
+        self.client.bindToDB("mydb")
+        d = self.client.openDocs(["a", "b", "c"], chunkSize=2)
+        self.assertEquals(len(self.client.calls), 2)
+        self.assertEquals(json.loads(self.client.calls[1][1]["postdata"]),
+            {"keys": ["c"]})
+        self._respond(1, {"rows": [{"key": "c", "error": "not_found"}]})
+        self._respond(0, {"rows": [{"key": "a", "error": "not_found"},
+            {"key": "b", "error": "not_found"}]})
+        return d.addCallback(lambda r: self.assertEquals(sorted(r.keys()),
+            ["a", "b", "c"]))
+
+    def test_openDocsBulkGet(self):
+        self.client.version = (2, 1, 0)
+        d = self.client.openDocs("mydb", ["a", "b", "c"])
+        uri, kwargs, _ = self.client.calls[0]
+        self.assertEquals(uri, "/mydb/_bulk_get")
+        self.assertEquals(json.loads(kwargs["postdata"]),
+            {"docs": [{"id": "a"}, {"id": "b"}, {"id": "c"}]})
+        self._respond(0, {"results": [
+            {"id": "a", "docs": [{"ok": {"_id": "a", "_rev": "1-a"}}]},
+            {"id": "b", "docs": [{"error": {"id": "b", "rev": "undefined",
+                "error": "not_found", "reason": "deleted"}}]},
+            {"id": "c", "docs": [{"error": {"id": "c", "rev": "undefined",
+                "error": "not_found", "reason": "missing"}}]}]})
+
+        def cb(result):
+            self.assertEquals(result, {"a": {"_id": "a", "_rev": "1-a"},
+                "b": client.DELETED, "c": client.MISSING})
+        return d.addCallback(cb)
+
+
+class CoalescingTestCase(TestCase):
+    """
+    Test sharing of identical concurrent GET requests.
+    """
+
+    def setUp(self):
+        self.client = RequestRecordingCouchDB("localhost", coalesce=True)
+
+    def test_notByDefault(self):
+        db = RequestRecordingCouchDB("localhost")
+        db.openDoc("mydb", "a")
+        db.openDoc("mydb", "a")
+        self.assertEquals(len(db.requests), 2)
+
+    def test_coalesced(self):
+        d1 = self.client.openDoc("mydb", "a")
+        d2 = self.client.openDoc("mydb", "a")
+        self.assertEquals(len(self.client.requests), 1)
+        self.assertEquals(self.client.getStats(), {"coalesced": 1})
+
+        self.client.requests[0][3].callback('{"_id": "a"}')
+        results = []
+        d1.addCallback(results.append)
+        d2.addCallback(results.append)
+        self.assertEquals(results, [{"_id": "a"}, {"_id": "a"}])
+        self.failIf(results[0] is results[1])
+
+        # once answered, a new request is sent
+        self.client.openDoc("mydb", "a")
+        self.assertEquals(len(self.client.requests), 2)
+
+    def test_differentRequests(self):
+        self.client.openDoc("mydb", "a")
+        self.client.openDoc("mydb", "b")
+        self.client.get("/mydb/a", isJson=False)
+        self.client.saveDoc("mydb", {}, "a")
+        self.client.saveDoc("mydb", {}, "a")
+        self.assertEquals(len(self.client.requests), 5)
+
+    def test_failure(self):
+        from twisted.web import error
+        d1 = self.client.openDoc("mydb", "a")
+        d2 = self.client.openDoc("mydb", "a")
+        self.client.requests[0][3].errback(error.Error(404, "not found"))
+        self.assertFailure(d1, error.Error)
+        self.assertFailure(d2, error.Error)
+        return defer.gatherResults([d1, d2])
+
+
+class DeadlineTestCase(TestCase):
+    """
+    Test request deadlines and cancellation.
+    """
+
+    def setUp(self):
+        from twisted.internet import task
+        self.clock = task.Clock()
+        self.client = RequestRecordingCouchDB("localhost", timeout=10,
+            clock=self.clock, coalesce=True)
+
+    def test_timeout(self):
+        d = self.client.get("/mydb/a")
+        self.clock.advance(9)
+        self.failIf(self.client.requests[0][3].called)
+        self.clock.advance(1)
+        # the request was cancelled
+        self.failUnless(self.client.requests[0][3].called)
+        self.assertEquals(self.client.getStats()["timeouts"], 1)
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_perCall(self):
+        d = self.client.get("/mydb/a", timeout=1)
+        self.clock.advance(1)
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_noTimeout(self):
+        db = RequestRecordingCouchDB("localhost", clock=self.clock)
+        db.get("/mydb/a")
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_streamedNoDefaultTimeout(self):
+        from StringIO import StringIO
+        self.client.openAttachment("mydb", "a", "file", StringIO())
+        self.client.putAttachment("mydb", "a", "file", StringIO("data"),
+            revision="1-abc")
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        d = self.client.openAttachment("mydb", "a", "file", StringIO(),
+            timeout=1)
+        self.clock.advance(1)
+        return self.assertFailure(d, client.RequestTimeout)
+
+    def test_streamTimeout(self):
+        self.client.streamDocs("mydb", lambda row: None)
+        self.client.streamView("mydb", "design", "view", lambda row: None)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        d1 = self.client.streamDocs("mydb", lambda row: None, timeout=1)
+        d2 = self.client.streamView("mydb", "design", "view",
+            lambda row: None, timeout=1, limit=2)
+        self.failIf("timeout" in self.client.requests[3][1])
+        self.clock.advance(1)
+        self.assertFailure(d1, client.RequestTimeout)
+        return self.assertFailure(d2, client.RequestTimeout)
+
+    def test_documentTimeout(self):
+        self.client.enableReadBatching()
+        self.client.enableWriteBatching()
+        d1 = self.client.openDoc("mydb", "a", timeout=1)
+        d2 = self.client.saveDoc("mydb", '{"a": 1}', "b", timeout=1)
+        d3 = self.client.openView("mydb", "design", "view", timeout=1)
+        # calls with a deadline are not batched
+        self.assertEquals([request[:2] for request in self.client.requests], [
+            ("GET", "http://localhost:5984/mydb/a"),
+            ("PUT", "http://localhost:5984/mydb/b"),
+            ("GET",
+             "http://localhost:5984/mydb/_design/design/_view/view?")])
+        self.clock.advance(1)
+        self.assertFailure(d1, client.RequestTimeout)
+        self.assertFailure(d2, client.RequestTimeout)
+        return self.assertFailure(d3, client.RequestTimeout)
+
+    def test_answered(self):
+        d = self.client.openDoc("mydb", "a")
+        self.client.requests[0][3].callback('{"_id": "a"}')
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return d
+
+    def test_cancel(self):
+        d = self.client.get("/mydb/a")
+        d.cancel()
+        self.failUnless(self.client.requests[0][3].called)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancelCoalesced(self):
+        d1 = self.client.openDoc("mydb", "a")
+        d2 = self.client.openDoc("mydb", "a")
+        d3 = self.client.openDoc("mydb", "a")
+        request = self.client.requests[0][3]
+
+        d1.cancel()
+        self.assertFailure(d1, defer.CancelledError)
+        self.failIf(request.called)
+        self.clock.advance(10)
+        self.failUnless(request.called)
+        self.assertFailure(d2, client.RequestTimeout)
+        self.assertFailure(d3, client.RequestTimeout)
+
+        # a new request is sent afterwards
+        self.client.openDoc("mydb", "a")
+        self.assertEquals(len(self.client.requests), 2)
+        return defer.gatherResults([d1, d2, d3])
+
 
 class FakeCouchDBResource(resource.Resource):
     """
@@ -441,6 +797,531 @@ class ConnectedCouchDBTestCase(TestCase):
         d.addCallback(cb)
         return d
 
+    @defer.inlineCallbacks
+    def test_jsonBytes(self):
+        data = {
+            "_id": u"\u201cI\xf1t\xebrn\xe2ti\xf4n\xe0liz\xe6ti\xf8n\u201d"}
+        encoded = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        render = self.resource.render
+
+        def renderJSON(request):
+            request.setHeader("content-type", "application/json")
+            return render(request)
+        self.resource.render = renderJSON
+        self.resource.result = encoded
+
+        body = yield self.client.get("/mydb/doc")
+        self.assertEquals(type(body), str)
+        self.assertEquals(body, encoded)
+        result = yield self.client.openDoc("mydb", "doc")
+        self.assertEquals(result, data)
+
+    @defer.inlineCallbacks
+    def test_textDecoded(self):
+        text = u"\u201cI\xf1t\xebrn\xe2ti\xf4n\xe0liz\xe6ti\xf8n\u201d"
+        render = self.resource.render
+
+        def renderText(request):
+            request.setHeader("content-type", "text/plain; charset=utf-8")
+            return render(request)
+        self.resource.render = renderText
+        self.resource.result = text.encode("utf-8")
+
+        body = yield self.client.get("/mydb/doc/text", isJson=False)
+        self.assertEquals(body, text)
+
+    @defer.inlineCallbacks
+    def test_unparsedJSONDecoded(self):
+        text = u'{"_id": "I\xf1t\xebrn\xe2ti\xf4n\xe0liz\xe6ti\xf8n"}'
+        render = self.resource.render
+
+        def renderJSON(request):
+            request.setHeader("content-type",
+                "application/json; charset=utf-8")
+            return render(request)
+        self.resource.render = renderJSON
+        self.resource.result = text.encode("utf-8")
+
+        body = yield self.client.openDoc("mydb", "doc", attachment="file")
+        self.assertEquals(type(body), unicode)
+        self.assertEquals(body, text)
+
+    def test_openAttachment(self):
+        from StringIO import StringIO
+        output = StringIO()
+        self.resource.result = util.eight_bit_test_string()
+        d = self.client.openAttachment("mydb", "mydoc", "file", output)
+
+        def cb(length):
+            self.assertEquals(length, len(self.resource.result))
+            self.assertEquals(output.getvalue(), self.resource.result)
+        return d.addCallback(cb)
+
+    def test_streamView(self):
+        rows = []
+        self.resource.result = json.dumps({"total_rows": 2, "offset": 0,
+            "rows": [{"id": "a", "key": "a", "value": None},
+                     {"id": "b", "key": "b", "value": None}]})
+        d = self.client.streamView("mydb", "viewdoc", "myview", rows.append)
+
+        def cb(result):
+            self.assertEquals(result, {"total_rows": 2, "offset": 0})
+            self.assertEquals([row["id"] for row in rows], ["a", "b"])
+        return d.addCallback(cb)
+
+
+class StalledCouchDBResource(resource.Resource):
+    """
+    Fake a couchDB resource sending the start of a body and nothing more.
+
+    @ivar requested: fired with each request received.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.requested = Deferred()
+
+    def render(self, request):
+        request.setHeader("content-type", "application/json")
+        request.write('{"rows": [')
+        self.requested.callback(request)
+        return server.NOT_DONE_YET
+
+
+class AbortTestCase(TestCase):
+    """
+    Test that deadlines and cancellation abort the connection.
+    """
+
+    def setUp(self):
+        from twisted.internet import task
+        self.resource = StalledCouchDBResource()
+        site = server.Site(self.resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.clock = task.Clock()
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port,
+            timeout=10, clock=self.clock)
+
+    def _abortWhileReceiving(self, d, abort):
+        from twisted.internet import error, task
+
+        def requested(request):
+            finished = request.notifyFinish()
+            # let the client receive the start of the body
+            task.deferLater(reactor, 0.1, abort)
+            return self.assertFailure(finished, error.ConnectionDone)
+        return defer.gatherResults([d,
+            self.resource.requested.addCallback(requested)])
+
+    def test_timeout(self):
+        d = self.client.listDoc("mydb")
+        self.assertFailure(d, client.RequestTimeout)
+        return self._abortWhileReceiving(d, lambda: self.clock.advance(10))
+
+    def test_cancel(self):
+        d = self.client.listDoc("mydb")
+        self.assertFailure(d, defer.CancelledError)
+        return self._abortWhileReceiving(d, d.cancel)
+
+    def test_cancelBeforeResponse(self):
+        d = self.client.listDoc("mydb")
+        d.cancel()
+        return self.assertFailure(d, defer.CancelledError)
+
+
+class ThreadedDecodingTestCase(TestCase):
+    """
+    Test C{CouchDB} decoding large results in threads.
+    """
+
+    def setUp(self):
+        self.resource = FakeCouchDBResource()
+        site = server.Site(self.resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port)
+        self.pool = self.client.enableThreadedDecoding(threshold=1000)
+        self.addCleanup(self.client.disableThreadedDecoding)
+
+    @defer.inlineCallbacks
+    def test_large(self):
+        data = {"total_rows": 100, "offset": 0, "rows": [
+            {"id": u"\xe9%d" % i, "key": i, "value": None}
+            for i in range(100)]}
+        self.resource.result = json.dumps(data)
+        result = yield self.client.listDoc("mydb")
+        self.assertEquals(result, data)
+        stats = self.client.getStats()
+        self.assertEquals(stats["threadDecodes"], 1)
+        self.failUnless("threadDecodeSeconds" in stats)
+        self.failIf("decodeSeconds" in stats)
+
+    @defer.inlineCallbacks
+    def test_small(self):
+        self.resource.result = json.dumps(["mydb"])
+        result = yield self.client.listDB()
+        self.assertEquals(result, ["mydb"])
+        stats = self.client.getStats()
+        self.failIf("threadDecodes" in stats)
+        self.failUnless("decodeSeconds" in stats)
+
+    def test_disable(self):
+        self.client.disableThreadedDecoding()
+        self.failIf(self.pool.started)
+        body = json.dumps(["x" * 1000])
+        self.assertEquals(self.client.parseResult(body), ["x" * 1000])
+
+
+class PersistentCouchDBTestCase(TestCase):
+    """
+    Test C{CouchDB} keeping connections alive in a pool.
+    """
+
+    def setUp(self):
+        self.resource = FakeCouchDBResource()
+        self.resource.result = json.dumps([u"mydb"])
+        site = server.Site(self.resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.port = port.getHost().port
+
+    def _client(self, **kwargs):
+        db = client.CouchDB("127.0.0.1", self.port, **kwargs)
+        self.addCleanup(db.pool.closeCachedConnections)
+        return db
+
+    def test_notPersistentByDefault(self):
+        db = client.CouchDB("127.0.0.1", self.port)
+        self.assertEquals(db.pool, None)
+        self.assertEquals(db.getStats(), {})
+
+    def test_poolOptions(self):
+        db = self._client(persistent=True, maxPersistentPerHost=5,
+            cachedConnectionTimeout=10)
+        self.assertEquals(db.pool.maxPersistentPerHost, 5)
+        self.assertEquals(db.pool.cachedConnectionTimeout, 10)
+
+    @defer.inlineCallbacks
+    def test_connectionReused(self):
+        db = self._client(persistent=True)
+        yield db.listDB()
+        yield db.listDB()
+        yield db.listDB()
+        stats = db.getStats()['pool']
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['cached'], 1)
+
+    @defer.inlineCallbacks
+    def test_sharedPool(self):
+        db = self._client(persistent=True)
+        other = client.CouchDB("127.0.0.1", self.port, pool=db.pool)
+        yield db.listDB()
+        result = yield other.listDB()
+        self.assertEquals(result, [u"mydb"])
+        self.assertEquals(other.getStats()['pool']['hits'], 1)
+
+    @defer.inlineCallbacks
+    def test_evictions(self):
+        db = self._client(persistent=True, maxPersistentPerHost=1)
+        # two concurrent requests need two connections, only one is kept
+        yield defer.gatherResults([db.listDB(), db.listDB()])
+        stats = db.getStats()['pool']
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['evictions'], 1)
+        self.assertEquals(stats['cached'], 1)
+
+
+class ETagCouchDBResource(FakeCouchDBResource):
+    """
+    Fake a couchDB resource sending an ETag and honouring If-None-Match.
+
+    @ivar requests: list of If-None-Match headers of the requests received.
+    """
+    etag = '"1-abc"'
+
+    def __init__(self):
+        FakeCouchDBResource.__init__(self)
+        self.requests = []
+
+    def render(self, request):
+        match = request.getHeader('if-none-match')
+        self.requests.append(match)
+        request.setHeader('etag', self.etag)
+        if match == self.etag:
+            request.setResponseCode(304)
+            return ''
+        return self.result
+
+
+class ConditionalCouchDBTestCase(TestCase):
+    """
+    Test revalidation of responses with their ETag.
+    """
+
+    def setUp(self):
+        self.resource = ETagCouchDBResource()
+        self.resource.result = json.dumps({"_id": "a", "list": [1]})
+        site = server.Site(self.resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.client = client.CouchDB("127.0.0.1", port.getHost().port)
+        self.client.enableConditionalRequests()
+
+    @defer.inlineCallbacks
+    def test_revalidated(self):
+        first = yield self.client.openDoc("mydb", "a")
+        second = yield self.client.openDoc("mydb", "a")
+        third = yield self.client.openDoc("mydb", "a")
+        self.assertEquals(self.resource.requests, [None, '"1-abc"',
+            '"1-abc"'])
+        self.assertEquals(second, {"_id": "a", "list": [1]})
+        self.assertEquals(self.client.getStats()["notModified"], 2)
+
+        # each caller gets its own copy
+        second["list"].append(2)
+        self.assertEquals(third, {"_id": "a", "list": [1]})
+        self.assertEquals(first, third)
+
+    @defer.inlineCallbacks
+    def test_changed(self):
+        yield self.client.openDoc("mydb", "a")
+        self.resource.etag = '"2-def"'
+        self.resource.result = json.dumps({"_id": "a", "list": [2]})
+        result = yield self.client.openDoc("mydb", "a")
+        self.assertEquals(result, {"_id": "a", "list": [2]})
+        yield self.client.openDoc("mydb", "a")
+        self.assertEquals(self.resource.requests[-1], '"2-def"')
+
+    @defer.inlineCallbacks
+    def test_notJSON(self):
+        yield self.client.openDoc("mydb", "a", attachment="file")
+        yield self.client.openDoc("mydb", "a", attachment="file")
+        self.assertEquals(self.resource.requests, [None, None])
+
+    def test_cachedBody(self):
+        body = client.CachedBody(u'{"a": "\u201c"}', '"1"')
+        self.assertEquals(body, '{"a": "\xe2\x80\x9c"}')
+        self.assertEquals(self.client.parseResult(body), {"a": u"\u201c"})
+
+
+class RecordingCouchDBResource(FakeCouchDBResource):
+    """
+    Fake a couchDB resource recording the requests it receives.
+
+    @ivar requests: list of (headers, content) of the requests received.
+    """
+
+    def __init__(self):
+        FakeCouchDBResource.__init__(self)
+        self.requests = []
+
+    def render(self, request):
+        self.requests.append((request.requestHeaders,
+            request.content.read()))
+        return self.result
+
+
+class CompressionCouchDBTestCase(TestCase):
+    """
+    Test C{CouchDB} compressing bodies.
+    """
+
+    def setUp(self):
+        self.resource = RecordingCouchDBResource()
+        self.resource.result = json.dumps({"rows": [{"key": "x" * 10}] * 100})
+        # render the wrapper for every path instead of traversing to the
+        # unwrapped resource
+        self.resource.isLeaf = True
+        site = server.Site(resource.EncodingResourceWrapper(self.resource,
+            [server.GzipEncoderFactory()]))
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.port = port.getHost().port
+
+    @defer.inlineCallbacks
+    def test_notByDefault(self):
+        db = client.CouchDB("127.0.0.1", self.port)
+        yield db.saveDoc("mydb", {"a": "x" * 5000})
+        headers, content = self.resource.requests[0]
+        self.failIf(headers.hasHeader("accept-encoding"))
+        self.failIf(headers.hasHeader("content-encoding"))
+        stats = db.getStats()
+        self.assertEquals(stats["bytesReceived"], stats["bytesReceivedWire"])
+        self.assertEquals(stats["bytesSent"], stats["bytesSentWire"])
+
+    @defer.inlineCallbacks
+    def test_responseDecoded(self):
+        db = client.CouchDB("127.0.0.1", self.port, compression=True)
+        result = yield db.listDoc("mydb")
+        self.assertEquals(len(result["rows"]), 100)
+        stats = db.getStats()
+        self.assertEquals(stats["bytesReceived"], len(self.resource.result))
+        self.failUnless(stats["bytesReceivedWire"] < stats["bytesReceived"])
+
+    @defer.inlineCallbacks
+    def test_requestCompressed(self):
+        import zlib
+        db = client.CouchDB("127.0.0.1", self.port, compression=True,
+            compressThreshold=100)
+        yield db.saveDoc("mydb", {"a": "x"}, "small")
+        yield db.saveDoc("mydb", {"a": "x" * 5000}, "large")
+
+        headers, content = self.resource.requests[0]
+        self.failIf(headers.hasHeader("content-encoding"))
+        headers, content = self.resource.requests[1]
+        self.assertEquals(headers.getRawHeaders("content-encoding"), ["gzip"])
+        self.assertEquals(json.loads(zlib.decompress(content,
+            16 + zlib.MAX_WBITS)), {"a": "x" * 5000})
+        stats = db.getStats()
+        self.failUnless(stats["bytesSentWire"] < stats["bytesSent"])
+
+
+class AttachmentUploadTestCase(TestCase):
+    """
+    Test C{CouchDB.putAttachment} streaming attachments.
+    """
+
+    data = util.eight_bit_test_string() * 10
+
+    def setUp(self):
+        self.resource = RecordingCouchDBResource()
+        self.resource.result = json.dumps(
+            {"ok": True, "id": "mydoc", "rev": "2-abc"})
+        self.resource.isLeaf = True
+        site = server.Site(self.resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.db = client.CouchDB("127.0.0.1", port.getHost().port)
+
+    def _checkUploaded(self, result):
+        self.assertEquals(result["rev"], "2-abc")
+        headers, content = self.resource.requests[0]
+        self.assertEquals(content, self.data)
+        self.assertEquals(headers.getRawHeaders("content-type"),
+            ["image/png"])
+        self.assertEquals(headers.getRawHeaders("content-length"),
+            [str(len(self.data))])
+
+    def test_string(self):
+        d = self.db.putAttachment("mydb", "mydoc", "file", self.data,
+            revision="1-abc", contentType="image/png")
+        return d.addCallback(self._checkUploaded)
+
+    def test_file(self):
+        from StringIO import StringIO
+        d = self.db.putAttachment("mydb", "mydoc", "file",
+            StringIO(self.data), revision="1-abc", contentType="image/png")
+        return d.addCallback(self._checkUploaded)
+
+    def test_iterable(self):
+        chunks = (self.data[i:i + 100] for i in range(0, len(self.data), 100))
+        d = self.db.putAttachment("mydb", "mydoc", "file", chunks,
+            revision="1-abc", contentType="image/png", length=len(self.data))
+        return d.addCallback(self._checkUploaded)
+
+    def test_iterableWithoutLength(self):
+        self.assertRaises(ValueError, self.db.putAttachment, "mydb", "mydoc",
+            "file", iter([self.data]))
+
+    def test_uri(self):
+        db = RequestRecordingCouchDB("localhost")
+        db.putAttachment("mydb", u"my doc", "my file.txt", "data",
+            revision="1-abc")
+        method, url, headers, d = db.requests[0]
+        self.assertEquals(method, "PUT")
+        self.assertEquals(url,
+            "http://localhost:5984/mydb/my%20doc/my%20file.txt?rev=1-abc")
+        self.assertEquals(headers["Content-Type"],
+            ["application/octet-stream"])
+
+    def test_saveDocWithAttachments(self):
+        import email
+        from StringIO import StringIO
+        d = self.db.saveDoc("mydb", {"a": 1}, "mydoc", attachments={
+            "b.png": ("image/png", StringIO(self.data)),
+            "a.txt": "text"})
+
+        def cb(result):
+            self.assertEquals(result["rev"], "2-abc")
+            headers, content = self.resource.requests[0]
+            contentType = headers.getRawHeaders("content-type")[0]
+            self.failUnless(contentType.startswith("multipart/related;"))
+            self.assertEquals(headers.getRawHeaders("content-length"),
+                [str(len(content))])
+
+            message = email.message_from_string(
+                "Content-Type: %s\r\n\r\n%s" % (contentType, content))
+            doc, first, second = message.get_payload()
+            self.assertEquals(doc.get_content_type(), "application/json")
+            doc = json.loads(doc.get_payload())
+            self.assertEquals(doc["a"], 1)
+            # stubs are in the order of the parts
+            self.failUnless(content.index('"a.txt"') <
+                content.index('"b.png"'))
+            self.assertEquals(doc["_attachments"]["b.png"], {
+                "follows": True, "content_type": "image/png",
+                "length": len(self.data)})
+            self.assertEquals(first.get_payload(), "text")
+            self.assertEquals(second.get_content_type(), "image/png")
+            self.assertEquals(second.get_payload(), self.data)
+        return d.addCallback(cb)
+
+    def test_replaceAttachment(self):
+        import email
+        contentType, producer = client.multipartRelated(
+            {"_attachments": {"b.png": {"stub": True}, "z": {"stub": True}}},
+            {"a.txt": "AAA", "b.png": "BBB"}, boundary="xyz")
+        content = "".join(producer._iterator)
+        message = email.message_from_string(
+            "Content-Type: %s\r\n\r\n%s" % (contentType, content))
+        doc, first, second = message.get_payload()
+        # parts match the stubs that follow, in order
+        names = sorted(["a.txt", "b.png", "z"],
+            key=lambda name: doc.get_payload().index('"%s"' % name))
+        self.assertEquals(names, ["z", "a.txt", "b.png"])
+        self.assertEquals(first.get_payload(), "AAA")
+        self.assertEquals(second.get_payload(), "BBB")
+
+    def test_saveDocWithAttachmentsWithoutId(self):
+        self.assertRaises(ValueError, self.db.saveDoc, "mydb", {"a": 1},
+            attachments={"a.txt": "text"})
+
+
+class IterableProducerTestCase(TestCase):
+
+    def setUp(self):
+        from twisted.internet import task
+        from twisted.test import proto_helpers
+        self.clock = task.Clock()
+        self.cooperator = task.Cooperator(scheduler=lambda f:
+            self.clock.callLater(0, f), started=True)
+        self.consumer = proto_helpers.StringTransport()
+
+    def _produce(self, chunks, length):
+        producer = client.IterableProducer(chunks, length,
+            cooperator=self.cooperator)
+        d = producer.startProducing(self.consumer)
+        for i in range(len(chunks) + 1):
+            self.clock.advance(0)
+        return d
+
+    def test_produce(self):
+        d = self._produce(["abc", "def"], 6)
+        self.assertEquals(self.consumer.value(), "abcdef")
+        return d
+
+    def test_wrongLength(self):
+        d = self._produce(["abc", "def"], 7)
+        return self.assertFailure(d, ValueError)
+
+    def test_tooLong(self):
+        d = self._produce(["abc", "def"], 4)
+        self.assertEquals(self.consumer.value(), "abc")
+        return self.assertFailure(d, ValueError)
+
 
 class RealCouchDBTestCase(util.CouchDBTestCase):
 
@@ -1029,3 +1910,127 @@ class ResponseReceiverTestCase(TestCase):
             rvr.dataReceived(c)
 
         rvr.connectionLost(Failure(ResponseDone()))
+
+
+class RowReceiverTestCase(TestCase):
+
+    result = (
+        '{"total_rows": 3, "offset": 1, "rows": [\r\n'
+        '{"id": "a", "key": ["[", "{"], "value": {"v": "\\"}]"}},\r\n'
+        '{"id": "b", "key": "\\\\", "value": [1, {"rows": []}]},\r\n'
+        '{"id": "\xe2\x80\x9c", "key": null, "value": null}\r\n'
+        '],\r\n"update_seq": 5}')
+
+    def _receive(self, chunkSize, result=None, rowCallback=None):
+        rows = []
+        d = defer.Deferred()
+        rvr = client.RowReceiver(d, rowCallback or rows.append)
+        result = result or self.result
+        for i in range(0, len(result), chunkSize):
+            rvr.dataReceived(result[i:i + chunkSize])
+        rvr.connectionLost(Failure(ResponseDone()))
+        return d, rows
+
+    def _check(self, chunkSize):
+        d, rows = self._receive(chunkSize)
+        self.assertEquals(rows, json.loads(self.result)["rows"])
+        self.assertEquals(type(rows[2]["id"]), unicode)
+        d.addCallback(self.assertEquals,
+            {"total_rows": 3, "offset": 1, "update_seq": 5})
+        return d
+
+    def test_wholeBody(self):
+        return self._check(len(self.result))
+
+    def test_byteByByte(self):
+        return self._check(1)
+
+    def test_chunks(self):
+        return self._check(7)
+
+    def test_rowsReleased(self):
+        """
+        Rows are passed on as soon as they are complete.
+        """
+        d = defer.Deferred()
+        rows = []
+        rvr = client.RowReceiver(d, rows.append)
+        rvr.dataReceived(self.result[:self.result.index('{"id": "b"')])
+        self.assertEquals(len(rows), 1)
+        self.assertEquals(rvr._row, [])
+
+    def test_notAView(self):
+        d, rows = self._receive(3, result='{"ok": true, "rows": 3}')
+        self.assertEquals(rows, [])
+        return d.addCallback(self.assertEquals, {"ok": True})
+
+    def test_callbackFailure(self):
+        from twisted.test import proto_helpers
+
+        def fail(row):
+            raise KeyError(row['id'])
+        d = defer.Deferred()
+        rvr = client.RowReceiver(d, fail)
+        rvr.makeConnection(proto_helpers.StringTransport())
+        rvr.dataReceived(self.result)
+        rvr.connectionLost(Failure(ResponseDone()))
+        return self.assertFailure(d, KeyError)
+
+
+class AttachmentReceiverTestCase(TestCase):
+
+    data = util.eight_bit_test_string()
+
+    def _receive(self, consumer, digest=None):
+        from twisted.test import proto_helpers
+        d = defer.Deferred()
+        rvr = client.AttachmentReceiver(d, consumer, digest=digest)
+        rvr.makeConnection(proto_helpers.StringTransport())
+        for i in range(0, len(self.data), 100):
+            rvr.dataReceived(self.data[i:i + 100])
+        rvr.connectionLost(Failure(ResponseDone()))
+        return d
+
+    def _digest(self, data):
+        import hashlib
+        return 'md5-' + hashlib.md5(data).digest().encode('base64').strip()
+
+    def test_callable(self):
+        chunks = []
+        d = self._receive(chunks.append)
+        self.assertEquals(''.join(chunks), self.data)
+        self.assertEquals(len(chunks), 6)
+        return d.addCallback(self.assertEquals, len(self.data))
+
+    def test_consumer(self):
+        from twisted.test import proto_helpers
+        consumer = proto_helpers.StringTransport()
+        d = defer.Deferred()
+        rvr = client.AttachmentReceiver(d, consumer)
+        transport = proto_helpers.StringTransport()
+        rvr.makeConnection(transport)
+        self.assertIdentical(consumer.producer, transport)
+        self.failUnless(consumer.streaming)
+        rvr.dataReceived(self.data)
+        rvr.connectionLost(Failure(ResponseDone()))
+        self.assertEquals(consumer.value(), self.data)
+        self.assertIdentical(consumer.producer, None)
+        return d
+
+    def test_digest(self):
+        d = self._receive(lambda data: None, digest=self._digest(self.data))
+        return d.addCallback(self.assertEquals, len(self.data))
+
+    def test_digestMismatch(self):
+        d = self._receive(lambda data: None, digest=self._digest('other'))
+        return self.assertFailure(d, client.DigestMismatch)
+
+    def test_unknownDigest(self):
+        self.assertRaises(ValueError, client.AttachmentReceiver,
+            defer.Deferred(), lambda data: None, digest='sha1-abc')
+
+    def test_consumerFailure(self):
+
+        def fail(data):
+            raise IOError("disk full")
+        return self.assertFailure(self._receive(fail), IOError)
@@ -30,3 +30,156 @@ class JSONTestCase(unittest.TestCase):
         u = json.loads(u'"str"')
         self.assertEquals(u, u'str')
         self.assertEquals(type(u), unicode)
+
+
+class StrictLoadsTestCase(unittest.TestCase):
+    """
+    Test the strict loads implementations, whichever is in use.
+    """
+
+    document = '{"_id": "abc", "list": ["x", 1, {"y": "\\u00e9t\\u00e9"}], ' \
+        '"utf8": "\xc3\xa9t\xc3\xa9"}'
+
+    def _checkUnicode(self, value):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                self._checkUnicode(k)
+                self._checkUnicode(v)
+        elif isinstance(value, list):
+            for v in value:
+                self._checkUnicode(v)
+        elif isinstance(value, basestring):
+            self.assertEquals(type(value), unicode)
+
+    def _check(self, loads):
+        result = loads(self.document)
+        self._checkUnicode(result)
+        self.assertEquals(result["list"][2]["y"], u"\xe9t\xe9")
+        self.assertEquals(result["utf8"], u"\xe9t\xe9")
+        self.assertEquals(loads(self.document.decode("utf-8")), result)
+
+    def testUnicodeLoads(self):
+        self._check(json._unicode_loads)
+
+    def testPyLoads(self):
+        self._check(json._make_py_loads())
+
+    def testEncoding(self):
+        self.assertEquals(json._unicode_loads('"\xe9"', encoding="latin-1"),
+            u"\xe9")
+
+
+class CodecTestCase(unittest.TestCase):
+    """
+    Base class for tests changing the codecs, which restores them.
+    """
+
+    def setUp(self):
+        codecs = dict(json._codecs)
+        chosen = json._chosen
+        strict = json.STRICT
+
+        def restore():
+            json._codecs.clear()
+            json._codecs.update(codecs)
+            json._chosen = chosen
+            json._select(strict)
+        self.addCleanup(restore)
+
+    def _registerFast(self):
+        import json as stdlib
+        calls = []
+
+        def loads(s, *args, **kwargs):
+            calls.append(s)
+            return stdlib.loads(s, *args, **kwargs)
+        json.register_codec('fast', loads, stdlib.dumps, priority=100)
+        return calls
+
+
+class CodecRegistryTestCase(CodecTestCase):
+
+    def testDefault(self):
+        self.assertEquals(json.CODEC, json.available_codecs()[0])
+        self.failUnless('json' in json.available_codecs())
+
+    def testPreferred(self):
+        calls = self._registerFast()
+        json.use_codec()
+        self.assertEquals(json.CODEC, 'fast')
+        self.assertEquals(json.available_codecs()[0], 'fast')
+        u = json.loads('"abc"')
+        self.assertEquals(type(u), unicode)
+        self.assertEquals(calls[-1], u'"abc"')
+
+    def testNotStrict(self):
+
+        def loads(s):
+            return str(s)
+        json.register_codec('broken', loads, repr, priority=100)
+        self.failIf('broken' in json.available_codecs(strict=True))
+        self.failUnless('broken' in json.available_codecs(strict=False))
+        json.use_codec()
+        self.assertNotEquals(json.CODEC, 'broken')
+        self.assertRaises(ValueError, json.use_codec, 'broken')
+
+    def testUseCodec(self):
+        self._registerFast()
+        json.use_codec('json')
+        self.assertEquals(json.CODEC, 'json')
+        json.set_strict(False)
+        self.assertEquals(json.CODEC, 'json')
+        self.assertEquals(json.STRICT, False)
+        json.set_strict(True)
+        self.assertEquals(json.STRICT, True)
+        self.assertEquals(type(json.loads('"str"')), unicode)
+
+    def testRegisterModule(self):
+        self.failIf(json.register_module('paisley_no_such_module'))
+        self.failUnless(json.register_module('json', priority=100))
+
+
+class LoadsInSlicesTestCase(CodecTestCase):
+
+    def _check(self, s):
+        result = json.loads_in_slices(s)
+        self.assertEquals(result, json.loads(s))
+        return result
+
+    def testView(self):
+        result = self._check('{"total_rows": 2, "offset": 0, "rows": [\r\n'
+            '{"id": "a", "key": ["a", 1], "value": {"rev": "1-a"}},\r\n'
+            '{"id": "\\u00e9", "key": null, "value": [1, 2]}\r\n]}\n')
+        self.assertEquals(type(result["rows"][1]["id"]), unicode)
+        self.assertEquals(type(result.keys()[0]), unicode)
+
+    def testArray(self):
+        self._check('[{"ok": true, "id": "a"}, {"id": "b", "error": "x"}]')
+
+    def testEmpty(self):
+        self._check('{}')
+        self._check(' [ ] ')
+        self._check('{"rows": []}')
+
+    def testScalar(self):
+        self._check('"\xc3\xa9"')
+        self._check('3')
+
+    def testInvalid(self):
+        for s in ['{"a": 1', '{"a" 1}', '[1, 2', '[1 2]', '{1: 2}',
+                  '{"a": 1} x', '']:
+            self.assertRaises(ValueError, json.loads_in_slices, s)
+
+    def testNotStrict(self):
+        json.use_codec('json')
+        json.set_strict(False)
+        s = '{"rows": ["abc"]}'
+        self.assertEquals(type(json.loads_in_slices(s)["rows"][0]),
+            type(json.loads(s)["rows"][0]))
+
+    def testOtherCodec(self):
+        calls = self._registerFast()
+        json.use_codec('fast')
+        del calls[:]
+        self._check('{"rows": [1]}')
+        self.assertEquals(len(calls), 2)
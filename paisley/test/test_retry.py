@@ -0,0 +1,166 @@
+# -*- Mode: Python; test-case-name: paisley.test.test_retry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Tests for retrying requests.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web import error as tw_error
+
+from paisley import retry
+from paisley.client import RequestTimeout
+
+from paisley.test.test_client import RequestRecordingCouchDB
+
+
+class BackoffTestCase(TestCase):
+
+    def test_exponential(self):
+        delays = [retry.backoff(i, jitter=0) for i in range(10)]
+        self.assertEquals(delays[:4], [0.1, 0.2, 0.4, 0.8])
+        self.assertEquals(delays[-1], 10)
+
+    def test_jitter(self):
+        self.assertAlmostEquals(
+            retry.backoff(1, jitter=1.0, random=lambda: 0.25), 0.15)
+        self.assertAlmostEquals(
+            retry.backoff(1, jitter=0.5, random=lambda: 1.0), 0.1)
+
+
+class RetryPolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.policy = retry.RetryPolicy()
+
+    def _fail(self, exception):
+        try:
+            raise exception
+        except:
+            return Failure()
+
+    def test_connectionErrors(self):
+        from twisted.web._newclient import ResponseNeverReceived
+        for exception in [error.ConnectionRefusedError(),
+                          error.ConnectionLost(),
+                          ResponseNeverReceived([])]:
+            self.failUnless(self.policy.shouldRetry('GET',
+                self._fail(exception)))
+
+    def test_statuses(self):
+        for status, body, expected in [
+                (503, '', True),
+                (502, '', True),
+                (500, '{"error": "timeout", "reason": "x"}', True),
+                (500, '{"error": "badarg"}', False),
+                (500, 'not json', False),
+                (404, '{"error": "not_found"}', False),
+                (409, '{"error": "conflict"}', False)]:
+            self.assertEquals(self.policy.shouldRetry('GET',
+                self._fail(tw_error.Error(status, body))), expected)
+
+    def test_methods(self):
+        failure = self._fail(error.ConnectionRefusedError())
+        self.failUnless(self.policy.shouldRetry('PUT', failure))
+        self.failIf(self.policy.shouldRetry('POST', failure))
+        self.failIf(self.policy.shouldRetry('DELETE', failure))
+
+    def test_notRetried(self):
+        for exception in [defer.CancelledError(), RequestTimeout(),
+                          ValueError()]:
+            self.failIf(self.policy.shouldRetry('GET',
+                self._fail(exception)))
+
+
+class RetryingCouchDBTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = RequestRecordingCouchDB("localhost", clock=self.clock,
+            retryPolicy=retry.RetryPolicy(maxRetries=2, jitter=0))
+
+    def _failRequest(self, index, exception=None):
+        if exception is None:
+            exception = error.ConnectionRefusedError()
+        self.client.requests[index][3].errback(exception)
+
+    def test_retried(self):
+        d = self.client.openDoc("mydb", "a")
+        self._failRequest(0)
+        self.assertEquals(len(self.client.requests), 1)
+        self.clock.advance(0.1)
+        self.assertEquals(len(self.client.requests), 2)
+        self._failRequest(1, tw_error.Error(503, ''))
+        self.clock.advance(0.2)
+        self.client.requests[2][3].callback('{"_id": "a"}')
+        self.assertEquals(self.client.getStats()["retries"], 2)
+        self.failIf("retriesExhausted" in self.client.getStats())
+        return d.addCallback(self.assertEquals, {"_id": "a"})
+
+    def test_exhausted(self):
+        d = self.client.openDoc("mydb", "a")
+        self._failRequest(0)
+        self.clock.advance(0.1)
+        self._failRequest(1)
+        self.clock.advance(0.2)
+        self._failRequest(2)
+        self.assertEquals(len(self.client.requests), 3)
+        stats = self.client.getStats()
+        self.assertEquals(stats["retries"], 2)
+        self.assertEquals(stats["retriesExhausted"], 1)
+        return self.assertFailure(d, error.ConnectionRefusedError)
+
+    def test_notRetryable(self):
+        d = self.client.openDoc("mydb", "a")
+        self._failRequest(0, tw_error.Error(404, '{"error": "not_found"}'))
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, tw_error.Error)
+
+    def test_post(self):
+        d = self.client.saveDoc("mydb", {})
+        self._failRequest(0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, error.ConnectionRefusedError)
+
+    def test_perRequest(self):
+        d = self.client.get("/mydb/a", retry=False)
+        self._failRequest(0)
+        self.assertFailure(d, error.ConnectionRefusedError)
+
+        d2 = self.client.post("/mydb/_all_docs", "{}",
+            retry=retry.RetryPolicy(methods=['POST'], jitter=0))
+        self._failRequest(1)
+        self.clock.advance(0.1)
+        self.assertEquals(len(self.client.requests), 3)
+        self.client.requests[2][3].callback('{}')
+        return defer.gatherResults([d, d2])
+
+    def test_cancelDuringDelay(self):
+        d = self.client.openDoc("mydb", "a")
+        self._failRequest(0)
+        d.cancel()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_cancelDuringAttempt(self):
+        d = self.client.openDoc("mydb", "a")
+        self._failRequest(0)
+        self.clock.advance(0.1)
+        d.cancel()
+        self.failUnless(self.client.requests[1][3].called)
+        return self.assertFailure(d, defer.CancelledError)
+
+    def test_deadlineCoversRetries(self):
+        self.client.timeout = 1
+        d = self.client.openDoc("mydb", "a")
+        self._failRequest(0)
+        self.clock.advance(0.1)
+        self._failRequest(1)
+        self.clock.advance(0.9)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, RequestTimeout)
@@ -53,9 +53,23 @@ def bench_saveDoc(server):
     return d
 
 
+@benchmarkDecorator
+def bench_saveDocs(server):
+    # same document as bench_saveDoc, 100 at a time through _bulk_docs
+    d = server.saveDocs('benchmarks', [{
+            "Subject": "I like Planktion",
+            "Author": "Rusty",
+            "PostedDate": "2006-08-15T17:30:12-04:00",
+            "Tags": ["plankton", "baseball", "decisions"],
+            "Body": "I decided today that I don't like baseball. "
+                    "I like plankton.",
+        }] * 100)
+    return d
+
+
 @inlineCallbacks
 def run_tests(server):
-    for bench in [bench_saveDoc]:
+    for bench in [bench_saveDoc, bench_saveDocs]:
         print "benchmarking %s" % (bench.__name__,)
         result = yield bench(server).addCallback(_printCb)
         print "    avg: %r" % (
@@ -0,0 +1,97 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Compare the speed of the registered JSON codecs, and of the strict
+decoders of the stdlib json, on CouchDB-like payloads.
+
+Usage: paisley_json_bench.py [number of runs]
+"""
+
+import sys
+import timeit
+
+from paisley import pjson
+
+
+def _doc(i):
+    return {
+        "_id": "doc-%06d" % i,
+        "_rev": "1-9dd776365618752ddfaf79d9079edf84",
+        "Subject": "I like Planktion",
+        "Author": u"Rusty \xe9",
+        "PostedDate": "2006-08-15T17:30:12-04:00",
+        "Tags": ["plankton", "baseball", "decisions"],
+        "Body": "I decided today that I don't like baseball. "
+                "I like plankton.",
+    }
+
+
+def payloads():
+    """
+    Return a list of (name, JSON-encoded str) of representative payloads.
+    """
+    doc = pjson.dumps(_doc(0))
+    rows = pjson.dumps({"total_rows": 1000, "offset": 0, "rows": [
+        {"id": "doc-%06d" % i, "key": "doc-%06d" % i,
+         "value": {"rev": "1-9dd776365618752ddfaf79d9079edf84"},
+         "doc": _doc(i)} for i in range(1000)]})
+    change = pjson.dumps({"seq": 1234, "id": "doc-000001",
+        "changes": [{"rev": "2-7051cbe5c8faecd085a3fa619e6e6337"}]})
+    return [("doc", doc), ("view rows", rows), ("change line", change)]
+
+
+def decoders():
+    """
+    Return a list of (name, loads) of the decoders to compare.
+    """
+    import json
+    ret = [
+        ("json.loads (not strict)", json.loads),
+        ("pjson.loads", pjson.loads),
+        ("python scanner", pjson._make_py_loads()),
+        ("unicode + C scanner", pjson._unicode_loads),
+    ]
+    for name in pjson.available_codecs(strict=False):
+        codec = pjson._codecs[name]
+        ret.append(("%s loads" % (name, ), codec.loads))
+        if codec.strictLoads is not None and \
+                codec.strictLoads is not codec.loads:
+            ret.append(("%s strict loads" % (name, ), codec.strictLoads))
+    return ret
+
+
+def encoders():
+    """
+    Return a list of (name, dumps) of the encoders to compare.
+    """
+    return [("%s dumps" % (name, ), pjson._codecs[name].dumps)
+        for name in pjson.available_codecs(strict=False)]
+
+
+def _time(function, data, number):
+    timer = timeit.Timer(lambda: function(data))
+    return min(timer.repeat(3, number)) / number
+
+
+def run(number):
+    print "codec in use: %s (strict: %r)" % (pjson.CODEC, pjson.STRICT)
+    for payload, data in payloads():
+        print "%s (%d bytes)" % (payload, len(data))
+        for name, loads in decoders():
+            print "    %-30s %10.1f us" % (name,
+                _time(loads, data, number) * 1000000)
+        value = pjson.loads(data)
+        for name, dumps in encoders():
+            print "    %-30s %10.1f us" % (name,
+                _time(dumps, value, number) * 1000000)
+
+
+if __name__ == '__main__':
+    number = 100
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    run(number)
@@ -0,0 +1,83 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Copyright (c) 2011
+# See LICENSE for details.
+
+"""
+Measure the peak memory used by a large listDoc(include_docs=True) against
+a CouchDB on localhost.
+
+Usage: paisley_memory_bench.py [--unicode] [number of documents]
+
+With --unicode, JSON response bodies are decoded to unicode before being
+parsed, as paisley used to do.  Run it with and without --unicode to
+compare; each run needs its own process, since the peak RSS only grows.
+"""
+
+import resource
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+import paisley
+from paisley import client
+
+DB = 'benchmarks_memory'
+
+
+class UnicodeResponseReceiver(client.ResponseReceiver):
+
+    def __init__(self, deferred, decode_utf8):
+        client.ResponseReceiver.__init__(self, deferred, True)
+
+
+def _peakRSS():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@inlineCallbacks
+def run(count):
+    server = paisley.CouchDB('localhost')
+    try:
+        yield server.createDB(DB)
+    except Exception:
+        pass
+
+    info = yield server.infoDB(DB)
+    if info['doc_count'] < count:
+        print "creating %d documents" % (count - info['doc_count'], )
+        docs = [{
+            "Subject": "I like Planktion",
+            "Author": u"Rusty \xe9",
+            "Tags": ["plankton", "baseball", "decisions"],
+            "Body": "I decided today that I don't like baseball. "
+                    "I like plankton.",
+        }] * (count - info['doc_count'])
+        yield server.saveDocs(DB, docs)
+
+    before = _peakRSS()
+    result = yield server.listDoc(DB, include_docs=True, limit=count)
+    after = _peakRSS()
+    print "%d rows, peak RSS %d kB before, %d kB after (+%d kB)" % (
+        len(result['rows']), before, after, after - before)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--unicode' in args:
+        args.remove('--unicode')
+        client.ResponseReceiver = UnicodeResponseReceiver
+    count = 100000
+    if args:
+        count = int(args[0])
+
+    def _run():
+        d = run(count)
+        d.addErrback(lambda failure: failure.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(_run)
+    reactor.run()